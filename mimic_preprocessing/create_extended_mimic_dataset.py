@@ -59,6 +59,9 @@ import pyllars.physionet_utils as physionet_utils
 import pyllars.shell_utils as shell_utils
 import pyllars.utils
 
+import mimic_preprocessing.mp_broadcast as mp_broadcast
+import mimic_preprocessing.mp_ts_matrix as mp_ts_matrix
+
 ADMISSIONS_COLS = [
     'ADMISSION_LOCATION',
     'ADMISSION_TYPE',
@@ -194,12 +197,14 @@ def main():
 
     it = more_itertools.chunked(all_episode_files, args.chunk_size)
 
+    # the column mappings are sent to each worker only once
     all_episode_df_chunks = dask_utils.apply_iter(
         it,
         dask_client,
         load_and_clean_episodes,
-        DIAGNOSES_TO_REPLACE,
-        EPISODE_COLS,
+        *mp_broadcast.broadcast_all(
+            dask_client, DIAGNOSES_TO_REPLACE, EPISODE_COLS
+        ),
         progress_bar=True
     )
 
@@ -236,7 +241,10 @@ def main():
 
     msg = "Adding time series features: '{}'".format(config['time_series_features'])
     logger.info(msg)
-    df_time_series = pd.read_csv(config['time_series_features'])
+    ts_features_format = mp_ts_matrix.get_ts_features_format(config)
+    df_time_series = mp_ts_matrix.read_ts_features(
+        config['time_series_features'], ts_features_format
+    )
     on = ['SUBJECT_ID', 'EPISODE']
     df_extended_episodes = df_extended_episodes.merge(df_time_series, on=on)
 
@@ -41,29 +41,46 @@
 """ Convert the notes in the NOTEEVENTS table to categorized bag-of-word
 representations for each episode.
 
-**N.B.** This processing includes one filtering step (Step 4) which is specific for
-the 2-day prediction task.
+This entails six steps.
 
-This entails five steps.
+    1. Read NOTEEVENTS in chunks and remove the discharge summaries and the
+       notes outside of the horizon. With `--dedup-notes`, notes with the same
+       text as an earlier note of the same admission are also removed.
 
-    1. Remove stop words, stem, etc., each note. This does not require any
+    2. Remove stop words, stem, etc., each note. This does not require any
        synchronization steps.
 
-    2. Create a CountVectorizer across all of the documents which converts
-       tokens to indices.
+    3. Create the vocabulary. The count vectorizer merges the document
+       frequencies of all chunks and prunes them with `min_df` and `max_df`.
+       The hashing vectorizer does not need a vocabulary.
 
-    3. Transform each note to a bag of words.
+    4. Transform each note to a bag of words and write it to the bag-of-words
+       store, which is partitioned by admission.
 
-    4. Combine the bags of words for each category and each episode. This step
-       also filters notes which occur more than args.episode_length after the
-       annotated beginning of the episode.
+    5. Combine the bags of words of each admission into its timeline, sorted
+       by chart time (see `mp_note_timeline`).
 
-    5. Convert the combined representation to a sparse (row) matrix for each
-       episode. This step also joins all of the notes for each episode and
-       filters those which occur.
+    6. Select the notes within the horizon (`--notes-horizon`) after the
+       admission time of each episode from the timelines and concatenate their
+       bags of words for each note category.
 
-The output is a data frame with one column giving the HADM_ID and the rest with
-the concatenated bags of words for each note category.
+The output is a data frame with the episodes and the concatenated bags of
+words for each note category, or, with `--notes-bow-format npz`, a sparse
+matrix of token counts for each note category (see `mp_notes_matrix`). With
+`--fused`, Steps 2 to 4 are done without writing the cleaned notes to disk.
+
+NOTEEVENTS is read in chunks (`--read-chunk-size`), and each chunk is filtered
+and sent to the workers before the next one is read.
+
+By default, notes which are not within the horizon (`--notes-horizon`, 48
+hours by default) of the admission time of any episode are removed in Step 1,
+so they are neither cleaned nor part of the vocabulary.
+
+The cleaned notes and their bags of words are written to sharded note stores
+(one parquet file for each chunk of notes and an index; see `mp_note_store`)
+rather than one file for each note. The bag-of-words store is partitioned by
+admission, and the chunks are written in batches of about
+`--partition-file-size` notes for each partition.
 
 Please note, this script was compiled from multiple jupyter notebooks, so it is
 not particularly efficient. Apologies in advance.
@@ -73,13 +90,13 @@ import pyllars.logging_utils as logging_utils
 logger = logging.getLogger(__name__)
 
 import argparse
+import hashlib
 import joblib
-import os
+import numpy as np
 import pandas as pd
+import scipy.sparse
 
-import pyllars.collection_utils as collection_utils
 import pyllars.dask_utils as dask_utils
-import pyllars.nlp_utils as nlp_utils
 import pyllars.pandas_utils as pd_utils
 import pyllars.physionet_utils as physionet_utils
 import pyllars.shell_utils as shell_utils
@@ -87,7 +104,12 @@ import pyllars.utils
 
 from pyllars.sklearn_transformers.incremental_count_vectorizer import IncrementalCountVectorizer
 
+import mimic_preprocessing.mp_broadcast as mp_broadcast
 import mimic_preprocessing.mp_filenames as mp_filenames
+import mimic_preprocessing.mp_note_store as mp_note_store
+import mimic_preprocessing.mp_note_timeline as mp_note_timeline
+import mimic_preprocessing.mp_notes_matrix as mp_notes_matrix
+import mimic_preprocessing.mp_notes_nlp as mp_notes_nlp
 
 # we only need the identifiers, not the actual text, since we will load that
 COUNT_VECTORIZER_COLS = [
@@ -103,6 +125,9 @@ COUNT_VECTORIZER_COLS = [
     "ISERROR"
 ]
 
+VALID_VECTORIZERS = ['count', 'hashing']
+DEFAULT_VECTORIZER = 'count'
+
 # the fields we will keep around
 
 # those related to the admission
@@ -168,309 +193,1339 @@ NOTE_TYPE_MAPPINGS = {
 }
 
 ZERO_DAYS = pd.Timedelta(0, 'D')
-TWO_DAYS = pd.Timedelta(2, 'D')
+
+# only notes within this many hours after admission are added to the records
+DEFAULT_NOTES_HORIZON = 48
 
 NOTE_CLEANED = "cleaned"
 NOTE_CLEANED_BOW = "cleaned-bow"
-NOTE_CLEANED_BOW_COMBINED = "cleaned-bow.combined"
+NOTE_CLEANED_TOKENS = "cleaned-tokens"
+NOTE_CLEANED_BOW_TIMELINE = "cleaned-bow.timeline"
+
+# the (approximate) number of notes in each file of the bag-of-words store
+DEFAULT_PARTITION_FILE_SIZE = 1000
 
 ###
-# Cleaning up the notes
+# Filtering notes outside of the horizon
 ###
-def clean_row(row, config):
-    
+def get_notes_horizon(args, config):
+    """ Get the horizon for the notes as a `pd.Timedelta`
+
+    The horizon (in hours) is given by `--notes-horizon`, the (optional)
+    `notes_horizon` key in the config or `DEFAULT_NOTES_HORIZON`, in that
+    order.
+    """
+    horizon = getattr(args, 'notes_horizon', None)
+
+    if horizon is None:
+        horizon = config.get('notes_horizon', DEFAULT_NOTES_HORIZON)
+
+    horizon = pd.Timedelta(horizon, 'h')
+    return horizon
+
+def filter_notes_by_horizon(df_notes, df_episodes, horizon):
+    """ Remove the notes which are not within `horizon` of the admission time
+    of any episode
+
+    This uses the same criterion as `add_text`, so it does not change which
+    notes are added to the records. The notes which are removed do not need
+    to be cleaned or vectorized.
+    """
+    admit_times = pd.to_datetime(df_episodes['ADMITTIME'])
+    admit_times = admit_times.groupby(df_episodes['HADM_ID']).max()
+
+    chart_times = df_notes['CHARTTIME'].fillna(df_notes['CHARTDATE'])
+    chart_times = pd.to_datetime(chart_times)
+
+    # notes without an episode get a missing admission time and are removed
+    note_admit_times = df_notes['HADM_ID'].map(admit_times)
+    m_horizon = (chart_times - note_admit_times) < horizon
+
+    df_notes = df_notes[m_horizon]
+    return df_notes
+
+###
+# Filtering the notes
+###
+NOTE_COLUMNS = COUNT_VECTORIZER_COLS + ['TEXT']
+
+def filter_notes(df_notes, df_episodes, horizon=None):
+    """ Remove the notes without an admission and, if a horizon is given, the
+    notes which are not within the horizon of any episode (of a subject in
+    `df_episodes`)
+    """
     # only keep notes associated of admissions
-    if pd.isnull(row['HADM_ID']):
-        return None
-    
-    if pd.isnull(row['CHARTTIME']):
-        row['CHARTTIME'] = row['CHARTDATE']
-        
-    row['TEXT'] = nlp_utils.clean_doc(row['TEXT'])
-    
-    subject_id = row['SUBJECT_ID']
-    hadm_id = int(row['HADM_ID'])
-    row_id = int(row['ROW_ID'])
+    df_notes = df_notes[~df_notes['HADM_ID'].isnull()]
 
-    f = mp_filenames.get_note_event_filename(
-        config['analysis_basepath'],
-        subject_id,
-        hadm_id,
-        row_id,
-        note=NOTE_CLEANED
+    if horizon is not None:
+        m_subject_ids = df_notes['SUBJECT_ID'].isin(df_episodes['SUBJECT_ID'])
+        df_notes = df_notes[m_subject_ids]
+        df_notes = filter_notes_by_horizon(df_notes, df_episodes, horizon)
+
+    return df_notes
+
+def prepare_notes(df):
+    """ Remove the notes without an admission, use the `CHARTDATE` for notes
+    without a `CHARTTIME` and convert the identifiers to ints
+    """
+    # only keep notes associated of admissions
+    df = df[~df['HADM_ID'].isnull()].copy()
+
+    m_charttime = df['CHARTTIME'].isnull()
+    df.loc[m_charttime, 'CHARTTIME'] = df.loc[m_charttime, 'CHARTDATE']
+
+    df['SUBJECT_ID'] = df['SUBJECT_ID'].astype(int)
+    df['HADM_ID'] = df['HADM_ID'].astype(int)
+    df['ROW_ID'] = df['ROW_ID'].astype(int)
+
+    return df
+
+###
+# Removing duplicate notes
+###
+def get_text_key(hadm_id, text):
+    """ Get a (16-byte) key for the text of a note of an admission
+
+    The text is not normalized further since the tokenizer treats spaces,
+    other whitespace and quotes differently; thus, only notes with the same
+    text are guaranteed to have the same tokens.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str(int(hadm_id)).encode('utf-8'))
+    h.update(b'\0')
+    h.update(text.encode('utf-8'))
+    return h.digest()
+
+class NoteDeduplicator:
+    """ Remove notes with the same text as an earlier note of the same
+    admission (e.g., copy-forward notes)
+
+    Only the first note with each text (the "representative") is cleaned and
+    vectorized. The other notes are kept without their text, along with the
+    `ROW_ID` of the representative (`REP_ROW_ID`), so that they can be added
+    to the bags of words with the tokens of the representative.
+
+    The keys (see `get_text_key`) and the `ROW_ID` of the representatives are
+    kept in sorted arrays rather than a dictionary, so they take 24 bytes for
+    each representative on the driver.
+    """
+    def __init__(self):
+        self.keys = np.zeros(0, dtype='S16')
+        self.rep_row_ids = np.zeros(0, dtype=np.int64)
+        self.all_duplicates = []
+
+        self.num_notes = 0
+        self.num_duplicates = 0
+        self.num_characters = 0
+        self.num_duplicate_characters = 0
+
+    def get_representatives(self, keys, row_ids):
+        """ Get the `ROW_ID` of the representative of each note, and add the
+        new representatives
+        """
+        # the first note with each key in the chunk
+        unique_keys, first, inverse = np.unique(
+            keys, return_index=True, return_inverse=True
+        )
+        unique_rep_row_ids = row_ids[first]
+
+        positions = np.searchsorted(self.keys, unique_keys)
+        m_found = positions < len(self.keys)
+        m_found[m_found] = self.keys[positions[m_found]] == unique_keys[m_found]
+        unique_rep_row_ids[m_found] = self.rep_row_ids[positions[m_found]]
+
+        # the positions are sorted, so the keys stay sorted
+        m_new = ~m_found
+        self.keys = np.insert(self.keys, positions[m_new], unique_keys[m_new])
+        self.rep_row_ids = np.insert(
+            self.rep_row_ids, positions[m_new], unique_rep_row_ids[m_new]
+        )
+
+        return unique_rep_row_ids[inverse.ravel()]
+
+    def remove_duplicates(self, df_notes):
+        """ Remove the duplicates from `df_notes` and keep track of them
+        """
+        text_lengths = df_notes['TEXT'].str.len().values
+
+        keys = np.array([
+            get_text_key(hadm_id, text)
+                for hadm_id, text in zip(df_notes['HADM_ID'], df_notes['TEXT'])
+        ], dtype='S16')
+
+        row_ids = df_notes['ROW_ID'].values.astype(np.int64)
+        rep_row_ids = self.get_representatives(keys, row_ids)
+
+        m_duplicate = rep_row_ids != df_notes['ROW_ID'].values
+
+        df_duplicates = df_notes[m_duplicate].drop(columns=['TEXT'])
+        df_duplicates = prepare_notes(df_duplicates)
+        df_duplicates['REP_ROW_ID'] = rep_row_ids[m_duplicate]
+        self.all_duplicates.append(df_duplicates)
+
+        self.num_notes += len(df_notes)
+        self.num_duplicates += len(df_duplicates)
+        self.num_characters += text_lengths.sum()
+        self.num_duplicate_characters += text_lengths[m_duplicate].sum()
+
+        return df_notes[~m_duplicate]
+
+    def get_duplicates(self):
+        """ Get the duplicate notes (without text) and their representatives
+        """
+        if len(self.all_duplicates) == 0:
+            return pd.DataFrame(columns=NOTE_COLUMNS + ['NOTE_ROW', 'REP_ROW_ID'])
+
+        df_duplicates = pd.concat(self.all_duplicates)
+        df_duplicates = df_duplicates.reset_index(drop=True)
+        return df_duplicates
+
+    def log_report(self):
+        frac_notes = self.num_duplicates / max(1, self.num_notes)
+        frac_characters = (
+            self.num_duplicate_characters / max(1, self.num_characters)
+        )
+
+        msg = ("Removed {} duplicate notes of {} ({:.1%}). The duplicates "
+            "account for {} of {} characters ({:.1%}) which are not cleaned "
+            "or vectorized.".format(self.num_duplicates, self.num_notes,
+            frac_notes, self.num_duplicate_characters, self.num_characters,
+            frac_characters))
+        logger.info(msg)
+
+def get_duplicate_lookup(df_duplicates):
+    """ Index the duplicate notes by their representative
+
+    The lookup is created once (on the driver), so each chunk only looks up
+    the representatives of its own notes rather than scanning all duplicates.
+
+    Returns
+    -------
+    duplicates: dict
+        A dictionary with the following keys:
+
+        * `notes`: the duplicates (see `NoteDeduplicator.get_duplicates`),
+          sorted by `REP_ROW_ID`. The (pandas) index is the original order.
+        * `representatives`: a data frame indexed by `REP_ROW_ID`, with the
+          number of duplicates (`NUM_DUPLICATES`) and the position of the
+          first one in `notes` (`START`)
+    """
+    df_notes = df_duplicates.sort_values('REP_ROW_ID', kind='stable')
+
+    num_duplicates = df_notes['REP_ROW_ID'].value_counts(sort=False)
+    num_duplicates = num_duplicates.sort_index()
+
+    df_representatives = pd.DataFrame({
+        'NUM_DUPLICATES': num_duplicates.values,
+        'START': mp_note_timeline.get_offsets(num_duplicates.values)[:-1]
+    }, index=num_duplicates.index)
+
+    duplicates = {
+        'notes': df_notes,
+        'representatives': df_representatives
+    }
+    return duplicates
+
+def get_duplicate_counts(row_ids, duplicates):
+    """ Get the number of notes (including duplicates) with the text of each
+    note in `row_ids`
+    """
+    num_duplicates = duplicates['representatives']['NUM_DUPLICATES']
+    counts = 1 + num_duplicates.reindex(row_ids, fill_value=0).values
+    return counts
+
+def add_duplicate_notes(df_notes, chunk_tokens, duplicates):
+    """ Add the duplicates of the notes in `df_notes` (a chunk) to the notes
+    and the tokens of the chunk, using the tokens of the representatives
+    """
+    df_representatives = duplicates['representatives'].reindex(
+        df_notes['ROW_ID'], fill_value=0
     )
-    
-    shell_utils.ensure_path_to_file_exists(f)
-    joblib.dump(row, f)
+    num_duplicates = df_representatives['NUM_DUPLICATES'].values
+
+    if num_duplicates.sum() == 0:
+        return df_notes, chunk_tokens
+
+    # the positions of the representative and the duplicate of each new note
+    rep_positions = np.repeat(np.arange(len(df_notes)), num_duplicates)
+    starts = df_representatives['START'].values
+    positions = mp_note_timeline.get_segment_indices(
+        starts, starts + num_duplicates
+    )
+
+    # keep the duplicates in their original order
+    df_duplicates = duplicates['notes'].iloc[positions]
+    order = np.argsort(df_duplicates.index.values, kind='stable')
+    df_duplicates = df_duplicates.iloc[order]
+    rep_positions = rep_positions[order]
+
+    columns = [c for c in df_notes.columns if c != 'TEXT']
+    df_notes = pd.concat(
+        [df_notes, df_duplicates[columns]], ignore_index=True
+    )
+
+    token_ids = list(chunk_tokens['token_ids'])
+    token_ids.extend(token_ids[p] for p in rep_positions)
+
+    chunk_tokens = {
+        'vocabulary': chunk_tokens['vocabulary'],
+        'token_ids': token_ids
+    }
+    return df_notes, chunk_tokens
+
+###
+# Reading the notes
+###
+def iterate_note_chunks(args, config, df_episodes, subject_ids,
+        deduplicator=None, known_row_ids=None):
+    """ Read NOTEEVENTS in chunks and yield the filtered notes in chunks of
+    about `args.chunk_size` notes
+
+    Only the `NOTE_COLUMNS` are read, and only one chunk of
+    `args.read_chunk_size` notes is in memory at a time. The (pandas) index of
+    each yielded chunk is the row of the notes in NOTEEVENTS.
+
+    As a side effect, the subjects of all notes other than discharge
+    summaries are added to `subject_ids`. If a `NoteDeduplicator` is given,
+    duplicate notes are removed with it, and the row of each note is also
+    kept in the `NOTE_ROW` column, so that the notes can be put back into
+    their original order. Notes with one of the `known_row_ids` (e.g., those
+    which have already been processed) are skipped.
+    """
+    horizon = None
+    if not args.keep_late_notes:
+        horizon = get_notes_horizon(args, config)
+
+    reader = physionet_utils.get_notes(
+        config['mimic_basepath'],
+        usecols=NOTE_COLUMNS,
+        chunksize=args.read_chunk_size,
+        nrows=args.num_notes
+    )
+
+    num_notes = 0
+    num_kept_notes = 0
+
+    for df_notes in reader:
+        # We do this because the first ~60k notes are discharge summaries.
+        # Since we always discard those, it makes testing difficult.
+        m_discharge = df_notes['CATEGORY'] == 'Discharge summary'
+        df_notes = df_notes[~m_discharge]
+
+        subject_ids.update(df_notes['SUBJECT_ID'])
+        num_notes += len(df_notes)
+
+        df_notes = filter_notes(df_notes, df_episodes, horizon)
+
+        if known_row_ids is not None:
+            m_known = df_notes['ROW_ID'].isin(known_row_ids)
+            df_notes = df_notes[~m_known]
+
+        num_kept_notes += len(df_notes)
+
+        if deduplicator is not None:
+            df_notes = df_notes.copy()
+            df_notes['NOTE_ROW'] = df_notes.index
+            df_notes = deduplicator.remove_duplicates(df_notes)
+
+        if len(df_notes) == 0:
+            continue
+
+        num_groups = max(1, len(df_notes) // args.chunk_size)
+        g_notes = pd_utils.split_df(df_notes, num_groups=num_groups)
+
+        for _, df_chunk in g_notes:
+            yield df_chunk
+
+    msg = "Kept {} of {} notes (other than discharge summaries)".format(
+        num_kept_notes, num_notes)
+    logger.info(msg)
+
+    if deduplicator is not None:
+        deduplicator.log_report()
+
+###
+# Cleaning up the notes
+###
+def log_stem_cache_stats(client):
+    """ Log the statistics of the stemming cache of each worker """
+    all_stats = client.run(mp_notes_nlp.get_stem_cache_stats)
+
+    for worker, stats in sorted(all_stats.items()):
+        msg = ("Stemming cache of worker {}: {} hits, {} misses, {} words, "
+            "hit rate: {:.3f}".format(worker, stats['hits'], stats['misses'],
+            stats['size'], stats['hit_rate']))
+        logger.info(msg)
+
+def get_note_store_path(config, note):
+    note_store_path = mp_filenames.get_note_store_path(
+        config['analysis_basepath'], note
+    )
+    return note_store_path
 
-def process_chunk_clean_row(df, config):
-    pd_utils.apply(df, clean_row, config)
+def process_chunk_clean(df, config):
+    """ Clean the notes in `df` and write them to one shard of the cleaned
+    note store
+    """
+    # use the (data frame) index of the first note to identify the shard
+    shard = int(df.index[0])
+    df = prepare_notes(df)
+
+    all_tokens = mp_notes_nlp.clean_docs_tokens(df['TEXT'])
+    df['TEXT'] = [' '.join(tokens) for tokens in all_tokens]
+
+    note_store_path = get_note_store_path(config, NOTE_CLEANED)
+    df_index = mp_note_store.write_note_shard(df, note_store_path, shard)
+    return df_index
 
-def clean_notes(df_notes, args, config, client):    
-    g_notes = pd_utils.split_df(df_notes, chunk_size=args.chunk_size)
+def clean_notes(note_chunks, args, config, client):
+    """ Clean each chunk of notes (e.g., from `iterate_note_chunks`) """
+    note_store_path = get_note_store_path(config, NOTE_CLEANED)
+    mp_note_store.remove_note_store(note_store_path)
 
-    _ = dask_utils.apply_groups(
-        g_notes,
+    index_futures = mp_broadcast.submit_iter(
+        note_chunks,
         client,
-        process_chunk_clean_row,
-        config,
+        process_chunk_clean,
+        mp_broadcast.broadcast(client, config),
         progress_bar=True
     )
+    all_index_dfs = dask_utils.collect_results(index_futures,
+        finished_only=False)
 
-    return None
+    df_index = mp_note_store.write_note_index(all_index_dfs, note_store_path)
+    return df_index
 
 ###
 # Creating the count vectorizer
 ###
-def create_count_vectorizer(df_notes):
-    df_notes = df_notes[COUNT_VECTORIZER_COLS]
-
-def get_tokens(file):
-    doc = joblib.load(file)
-    tokens = doc['TEXT']
-    tokens = tokens.split(' ')
+def get_tokens(text):
+    tokens = text.split(' ')
     return tokens
 
-def process_chunk_count_vectorizer(df, config):
-    
-    filenames = df.apply(
-        mp_filenames.get_note_event_filename_row,
-        axis=1,
-        args=(config,NOTE_CLEANED)
+def get_vectorizer_filename(args, config):
+    if args.vectorizer == 'hashing':
+        f = mp_filenames.get_mimic_notes_hashing_vectorizer_filename(
+            config['analysis_basepath']
+        )
+    else:
+        f = mp_filenames.get_mimic_notes_count_vectorizer_filename(
+            config['analysis_basepath']
+        )
+    return f
+
+def write_vectorizer(vectorizer, args, config):
+    f = get_vectorizer_filename(args, config)
+    shell_utils.ensure_path_to_file_exists(f)
+    joblib.dump(vectorizer, f)
+
+def count_chunk_tokens(chunk_tokens, weights=None):
+    """ Create an (unpruned) count vectorizer with the document frequencies
+    of the tokens in the chunk. `weights` gives the number of (duplicate)
+    documents for each document in the chunk.
+    """
+    token_count = mp_notes_nlp.get_document_frequencies(
+        chunk_tokens, weights=weights
     )
-    filenames = list(filenames)
-    filenames = collection_utils.remove_nones(filenames)
-    
+
+    num_docs = len(chunk_tokens['token_ids'])
+    if weights is not None:
+        num_docs = int(np.sum(weights))
+
+    icv = IncrementalCountVectorizer(
+        num_docs=num_docs,
+        prune=False,
+        create_mapping=False,
+        token_count=token_count
+    )
+    return icv
+
+def process_chunk_count_vectorizer(df_shard, config, duplicates=None):
+    shard = df_shard['SHARD'].iloc[0]
+    note_store_path = get_note_store_path(config, NOTE_CLEANED)
+    df_cleaned = mp_note_store.read_note_shard(
+        note_store_path, shard, columns=['ROW_ID', 'TEXT']
+    )
+
+    if duplicates is not None:
+        # count the duplicates of each note, too
+        tokens = [get_tokens(text) for text in df_cleaned['TEXT']]
+        chunk_tokens = mp_notes_nlp.get_chunk_tokens(tokens)
+        weights = get_duplicate_counts(df_cleaned['ROW_ID'], duplicates)
+        return count_chunk_tokens(chunk_tokens, weights)
+
     icv = IncrementalCountVectorizer(
         prune=False,
         create_mapping=False,
         get_tokens=get_tokens
     )
-    
-    icv_fit = icv.fit(filenames)
-    
+
+    icv_fit = icv.fit(df_cleaned['TEXT'].tolist())
+
+    return icv_fit
+
+def merge_count_vectorizers(*icvs, min_df=0, max_df=1, final=False,
+        document_frequencies_filename=None):
+    """ Merge partial count vectorizers
+
+    Intermediate merges only sum the document frequencies. The final merge
+    also writes the raw document frequencies (if a filename is given), prunes
+    the tokens and creates the mapping.
+    """
+    icv = IncrementalCountVectorizer.merge(
+        icvs,
+        min_df=min_df,
+        max_df=max_df,
+        prune=False,
+        create_mapping=False
+    )
+
+    if final:
+        if document_frequencies_filename is not None:
+            mp_notes_nlp.write_document_frequencies(
+                icv, document_frequencies_filename
+            )
+
+        icv.prune_tokens()
+        icv.create_token_mapping()
+
+    return icv
+
+def tree_merge_count_vectorizers(icv_futures, config, client, fan_in=2,
+        final=True):
+    """ Merge the (futures of) fit count vectorizers on the workers
+
+    The vectorizers are merged `fan_in` at a time, so only the final, pruned
+    vectorizer is sent to the driver, and the depth of the reduction is
+    logarithmic in the number of chunks. The last merge also writes the raw
+    document frequencies (see `prune_mimic_notes_bow`) and then prunes them.
+
+    If `final` is False, then the merged vectorizer is neither pruned nor
+    written (see `update_mimic_notes_bow`).
+    """
+    level = list(icv_futures)
+    if len(level) == 0:
+        msg = ("There are no notes to count. Please check that NOTEEVENTS "
+            "includes notes within the horizon of the episodes.")
+        raise ValueError(msg)
+
+    # the last merge combines the remaining (at most `fan_in`) vectorizers
+    while len(level) > fan_in:
+        level = [
+            client.submit(merge_count_vectorizers, *level[i:i+fan_in])
+                for i in range(0, len(level), fan_in)
+        ]
+
+    if final:
+        f = mp_filenames.get_mimic_notes_document_frequencies_filename(
+            config['analysis_basepath']
+        )
+        shell_utils.ensure_path_to_file_exists(f)
+
+        icv_future = client.submit(
+            merge_count_vectorizers,
+            *level,
+            min_df=config['min_df'],
+            max_df=config['max_df'],
+            final=True,
+            document_frequencies_filename=f
+        )
+    elif len(level) > 1:
+        icv_future = client.submit(merge_count_vectorizers, *level)
+    else:
+        icv_future = level[0]
+
+    icv_fit = icv_future.result()
+
+    # the function pointer from the workers cannot be pickled on the driver
+    icv_fit.get_tokens = get_tokens
     return icv_fit
 
-def create_count_vectorizer(df_notes, args, config, client):
-    g_notes = pd_utils.split_df(df_notes, chunk_size=args.chunk_size)
+def create_count_vectorizer(df_index, args, config, client,
+        duplicates=None):
+    if args.vectorizer == 'hashing':
+        # the hashing vectorizer does not need to see the notes
+        hv = mp_notes_nlp.HashingTokenVectorizer(args.num_hash_buckets)
+        write_vectorizer(hv, args, config)
+        return
+
+    # fit one vectorizer for each shard of cleaned notes
+    g_shards = df_index.groupby('SHARD')
+
+    # the config and duplicates are sent to each worker only once
+    shared_config, duplicates = mp_broadcast.broadcast_all(
+        client, config, duplicates
+    )
 
     # create independent vectorizers for each group
-    fit_icvs = dask_utils.apply_groups(
-        g_notes,
+    icv_futures = dask_utils.apply_groups(
+        g_shards,
         client,
         process_chunk_count_vectorizer,
-        config,
-        progress_bar=True
+        shared_config,
+        duplicates,
+        return_futures=True
     )
 
-    # merge them
-    icv_fit = IncrementalCountVectorizer.merge(
-        fit_icvs,
-        min_df=config['min_df'],
-        max_df=config['max_df'],
-        get_tokens=get_tokens
-    )
+    # merge them on the workers
+    icv_fit = tree_merge_count_vectorizers(icv_futures, config, client)
 
     # and write to disk
-    f = mp_filenames.get_mimic_notes_count_vectorizer_filename(
-        config['analysis_basepath']
-    )
-    
-    shell_utils.ensure_path_to_file_exists(f)
-    joblib.dump(icv_fit, f)
+    write_vectorizer(icv_fit, args, config)
 
 ###
 # Create BoW with the count vectorizer
 ###
-def transform_row(row, config, icv_fit):
-    
-    in_fn = mp_filenames.get_note_event_filename_row(row, config, NOTE_CLEANED)
-    out_fn = mp_filenames.get_note_event_filename_row(row, config, NOTE_CLEANED_BOW)
-    
-    if in_fn is None:
-        return None
-        
-    row = joblib.load(in_fn)
-    
-    row['SUBJECT_ID'] = int(row['SUBJECT_ID'])
-    row['HADM_ID'] = int(row['HADM_ID'])
-    row['ROW_ID'] = int(row['ROW_ID'])
-    
-    text = [row['TEXT']]    
-    row['TEXT'] = icv_fit.transform(text)
-    row['TEXT'] = row['TEXT'][0]
-    
-    shell_utils.ensure_path_to_file_exists(out_fn)
-    joblib.dump(row, out_fn)
+def write_token_shard(df_notes, chunk_tokens, config, shard):
+    """ Write the chunk-local token ids and the vocabulary of one shard of the
+    token store
+
+    The token store keeps all (unpruned) tokens, so the bags of words can be
+    recreated for other thresholds without cleaning the notes again.
+    """
+    df_notes = df_notes.copy()
+    df_notes['TEXT'] = [ids.tolist() for ids in chunk_tokens['token_ids']]
+
+    note_store_path = get_note_store_path(config, NOTE_CLEANED_TOKENS)
+    df_index = mp_note_store.write_note_shard(df_notes, note_store_path, shard)
+    mp_note_store.write_note_vocabulary(
+        chunk_tokens['vocabulary'], note_store_path, shard
+    )
+    return df_index
+
+def get_token_mapping(vectorizer):
+    """ Get the token mapping of a fitted count vectorizer, or the
+    `CompactVocabulary` itself
+    """
+    if isinstance(vectorizer, mp_notes_nlp.CompactVocabulary):
+        return vectorizer
+    return vectorizer.token_mapping_
+
+def get_shared_vectorizer(vectorizer, client):
+    """ Send the vectorizer for transforming the notes to each worker once
+
+    For the count vectorizer, only its vocabulary is sent, as a
+    `CompactVocabulary`.
+    """
+    if isinstance(vectorizer, IncrementalCountVectorizer):
+        vectorizer = mp_notes_nlp.get_compact_vocabulary(vectorizer)
+
+    return mp_broadcast.broadcast(client, vectorizer)
+
+def transform_chunk(df_notes, chunk_tokens, config, shard, vectorizer,
+        duplicates=None):
+    """ Convert the tokens of a chunk to bags of words with either
+    vectorizer. For the count vectorizer, the tokens are also written to one
+    shard of the token store.
+
+    The duplicates of the notes in the chunk (if any) are added to the chunk.
+
+    Returns
+    -------
+    df_notes: pd.DataFrame
+        The notes, with the bags of words in `TEXT`
+
+    df_token_index: pd.DataFrame
+        The index entries of the notes in the token store (or None for the
+        hashing vectorizer)
+    """
+    df_notes = df_notes.copy()
+
+    if duplicates is not None:
+        df_notes, chunk_tokens = add_duplicate_notes(
+            df_notes, chunk_tokens, duplicates
+        )
+
+    df_token_index = None
+    if isinstance(vectorizer, mp_notes_nlp.HashingTokenVectorizer):
+        df_notes['TEXT'] = vectorizer.transform_chunk(chunk_tokens)
+    else:
+        df_token_index = write_token_shard(df_notes, chunk_tokens, config, shard)
+        df_notes['TEXT'] = mp_notes_nlp.transform_chunk_tokens(
+            chunk_tokens, get_token_mapping(vectorizer)
+        )
+
+    return df_notes, df_token_index
+
+def write_bow_batch(all_transformed, config, batch, num_partitions=1):
+    """ Write the bags of words of a batch of chunks to the bag-of-words
+    store
+
+    The bag-of-words store is partitioned by `HADM_ID` into `num_partitions`
+    partitions, so the notes of each admission can later be combined by
+    reading a single partition. All chunks of the batch are written together,
+    so each partition of the batch is a single file.
+
+    Parameters
+    ----------
+    all_transformed: list of 2-tuples
+        The results of `transform_chunk` for each chunk, in the order of their
+        shards
+
+    batch: int
+        The identifier of the batch, that is, its first shard
+
+    Returns
+    -------
+    df_index, df_token_index: pd.DataFrames
+        The index entries of the notes in the bag-of-words store and the token
+        store (or None for the hashing vectorizer)
+    """
+    df_notes = pd.concat(
+        [transformed[0] for transformed in all_transformed],
+        ignore_index=True
+    )
+
+    note_store_path = get_note_store_path(config, NOTE_CLEANED_BOW)
+    df_index = mp_note_store.write_note_partitions(
+        df_notes, note_store_path, batch, num_partitions
+    )
+
+    df_token_index = None
+    token_index_dfs = [transformed[1] for transformed in all_transformed]
+    if token_index_dfs[0] is not None:
+        df_token_index = pd.concat(token_index_dfs, ignore_index=True)
+
+    return df_index, df_token_index
+
+def get_num_partitions(args, client):
+    """ Get the number of partitions of the bag-of-words store
 
-def process_chunk_transform(df, config, icv_fit):
-    pd_utils.apply(df, transform_row, config, icv_fit)
+    By default, there is one partition for each thread of the workers.
+    """
+    num_partitions = args.num_partitions
+    if num_partitions is None:
+        num_partitions = max(1, sum(client.nthreads().values()))
+    return num_partitions
+
+def get_batch_num_chunks(args):
+    """ Get the number of chunks in each batch of the bag-of-words store, so
+    each file has about `args.partition_file_size` notes
+    """
+    num_notes = args.partition_file_size * args.num_partitions
+    return max(1, num_notes // args.chunk_size)
+
+def iterate_batches(items, num_items):
+    """ Yield lists of (up to) `num_items` consecutive items """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == num_items:
+            yield batch
+            batch = []
+
+    if len(batch) > 0:
+        yield batch
+
+def write_bow_index(all_indices, args, config):
+    """ Write the index of the bag-of-words store and, for the count
+    vectorizer, the token store
+
+    `all_indices` are the results of `transform_chunk`.
+    """
+    note_store_path = get_note_store_path(config, NOTE_CLEANED_BOW)
+    df_index = mp_note_store.write_note_index(
+        [index[0] for index in all_indices], note_store_path
+    )
+
+    if args.vectorizer == 'count':
+        note_store_path = get_note_store_path(config, NOTE_CLEANED_TOKENS)
+        mp_note_store.write_note_index(
+            [index[1] for index in all_indices], note_store_path
+        )
+
+    return df_index
+
+def remove_bow_stores(config):
+    for note in [NOTE_CLEANED_BOW, NOTE_CLEANED_TOKENS]:
+        note_store_path = get_note_store_path(config, note)
+        mp_note_store.remove_note_store(note_store_path)
+
+def process_batch_transform(df_batch, config, icv_fit, duplicates=None,
+        num_partitions=1):
+    """ Transform the notes in a batch of shards of the cleaned note store to
+    bags of words and write them to the bag-of-words store
+    """
+    note_store_path = get_note_store_path(config, NOTE_CLEANED)
+
+    all_transformed = []
+    for shard in np.unique(df_batch['SHARD']):
+        shard = int(shard)
+        df_notes = mp_note_store.read_note_shard(note_store_path, shard)
 
-def create_bow(df_notes, args, config, client):
-    g_notes = pd_utils.split_df(df_notes, chunk_size=args.chunk_size)
+        tokens = [get_tokens(text) for text in df_notes['TEXT']]
+        chunk_tokens = mp_notes_nlp.get_chunk_tokens(tokens)
 
-    f = mp_filenames.get_mimic_notes_count_vectorizer_filename(
-        config['analysis_basepath']
+        transformed = transform_chunk(
+            df_notes, chunk_tokens, config, shard, icv_fit, duplicates
+        )
+        all_transformed.append(transformed)
+
+    batch = int(df_batch['SHARD'].min())
+    index = write_bow_batch(all_transformed, config, batch, num_partitions)
+    return index
+
+def create_bow(df_index, args, config, client, duplicates=None):
+    remove_bow_stores(config)
+
+    g_batches = mp_note_store.get_batch_groups(
+        df_index, get_batch_num_chunks(args)
     )
 
+    f = get_vectorizer_filename(args, config)
     icv_fit_load = joblib.load(f)
     
-    # make sure to erase the function pointer for loading tokens
-    icv_fit_load.get_tokens = None
+    # the large, read-only objects are sent to each worker only once
+    vectorizer = get_shared_vectorizer(icv_fit_load, client)
+    shared_config, duplicates = mp_broadcast.broadcast_all(
+        client, config, duplicates
+    )
 
-    _ = dask_utils.apply_groups(
-        g_notes,
+    all_indices = dask_utils.apply_groups(
+        g_batches,
         client,
-        process_chunk_transform,
-        config,
-        icv_fit_load,
+        process_batch_transform,
+        shared_config,
+        vectorizer,
+        duplicates,
+        args.num_partitions,
         progress_bar=True
     )
 
+    df_index = write_bow_index(all_indices, args, config)
+
+    if (args.vectorizer == 'hashing') and args.prune_hashed:
+        prune_hashed_bow(df_index, args, config, client)
+
+    return df_index
+
 ###
-# Create combined BoW
+# Prune the buckets of the hashing vectorizer
 ###
-def process_group(g, config):
-    note_files = g.apply(
-        mp_filenames.get_note_event_filename_row,
-        axis=1,
-        args=(config, NOTE_CLEANED_BOW)
-    )
-    df_cleaned_notes = [joblib.load(f) for f in note_files]
-    df_cleaned_notes = pd.DataFrame(df_cleaned_notes)
-    
-    subject_id = int(g.iloc[0]['SUBJECT_ID'])
-    hadm_id = int(g.iloc[0]['HADM_ID'])
-    
-    df_cleaned_notes['CHARTTIME'] = pd.to_datetime(df_cleaned_notes['CHARTTIME'])
-    
-    out_f = mp_filenames.get_note_event_filename(
-        config['analysis_basepath'],
-        subject_id,
-        hadm_id,
-        note=NOTE_CLEANED_BOW_COMBINED
+def process_chunk_bucket_frequencies(df_shard, config):
+    """ Count the document frequencies of the buckets in one shard of the
+    bag-of-words store
+    """
+    shard, partition = mp_note_store.get_shard_key(df_shard)
+    note_store_path = get_note_store_path(config, NOTE_CLEANED_BOW)
+    df_bow = mp_note_store.read_note_shard(
+        note_store_path, shard, columns=['TEXT'], partition=partition
     )
-    
-    shell_utils.ensure_path_to_file_exists(out_f)
-    joblib.dump(df_cleaned_notes, out_f)
 
-def process_group_chunk(chunk, config):
-    groups = chunk.groupby(['SUBJECT_ID', 'HADM_ID'], as_index=False)
-    groups.apply(process_group, config)
-    
-def combine_episode_notes(df_notes, args, config, client):
-    # group all notes by hadm id
-    g_notes = pd_utils.group_and_chunk_df(df_notes, 'HADM_ID', args.chunk_size)
+    buckets, counts = mp_notes_nlp.get_bucket_document_frequencies(
+        df_bow['TEXT']
+    )
+
+    ret = {
+        'buckets': buckets,
+        'counts': counts,
+        'num_docs': len(df_bow)
+    }
+    return ret
+
+def process_chunk_prune(df_shard, config, pruned_buckets):
+    """ Remove the pruned buckets from the bags of words in one shard of the
+    bag-of-words store
+    """
+    shard, partition = mp_note_store.get_shard_key(df_shard)
+    note_store_path = get_note_store_path(config, NOTE_CLEANED_BOW)
+    df_bow = mp_note_store.read_note_shard(
+        note_store_path, shard, partition=partition
+    )
+
+    df_bow['TEXT'] = [
+        np.asarray(bag)[~np.isin(bag, pruned_buckets)].tolist()
+            for bag in df_bow['TEXT']
+    ]
+
+    mp_note_store.write_note_shard(df_bow, note_store_path, shard, partition)
+
+def prune_hashed_bow(df_index, args, config, client):
+    """ Remove the buckets with too low or too high document frequencies from
+    the (hashed) bag-of-words store
+
+    The thresholds are `min_df` and `max_df` from the config, as for the count
+    vectorizer. The pruned buckets are also saved with the vectorizer.
+    """
+    g_shards = mp_note_store.get_shard_groups(df_index)
+    shared_config = mp_broadcast.broadcast(client, config)
+
+    msg = "Counting the document frequencies of the buckets"
+    logger.info(msg)
+    all_frequencies = dask_utils.apply_groups(
+        g_shards,
+        client,
+        process_chunk_bucket_frequencies,
+        shared_config,
+        progress_bar=True
+    )
 
-    _ = dask_utils.apply_groups(
-        g_notes,
+    doc_freqs = np.zeros(args.num_hash_buckets, dtype=np.int64)
+    num_docs = 0
+    for frequencies in all_frequencies:
+        doc_freqs[frequencies['buckets']] += frequencies['counts']
+        num_docs += frequencies['num_docs']
+
+    pruned_buckets = mp_notes_nlp.get_pruned_buckets(
+        doc_freqs, num_docs, min_df=config['min_df'], max_df=config['max_df']
+    )
+
+    msg = "Pruning {} of {} used buckets".format(
+        len(pruned_buckets), np.count_nonzero(doc_freqs)
+    )
+    logger.info(msg)
+
+    dask_utils.apply_groups(
+        g_shards,
         client,
-        process_group_chunk,
-        config,
+        process_chunk_prune,
+        shared_config,
+        mp_broadcast.broadcast(client, pruned_buckets),
         progress_bar=True
     )
 
-    return None
+    hv = mp_notes_nlp.HashingTokenVectorizer(
+        args.num_hash_buckets, pruned_buckets=pruned_buckets
+    )
+    write_vectorizer(hv, args, config)
 
 ###
-# Create the final, combined data record for each episode
+# Fused: clean, count and transform each chunk on the same worker
 ###
-def update_note_type(bow_row, episode_record):
-    note_type = bow_row['CATEGORY'].strip()
-    note_type = NOTE_TYPE_MAPPINGS[note_type]
-    episode_record[note_type].extend(bow_row['TEXT'])
+def process_chunk_clean_tokens(df, config):
+    """ Clean the notes in `df` and keep their tokens (as chunk-local ids) in
+    the memory of the worker
+    """
+    # use the (data frame) index of the first note to identify the shard
+    shard = int(df.index[0])
+    df = prepare_notes(df)
+
+    all_tokens = mp_notes_nlp.clean_docs_tokens(df['TEXT'])
+    df = df.drop(columns=['TEXT'])
+
+    chunk = {
+        'shard': shard,
+        'notes': df,
+        'tokens': mp_notes_nlp.get_chunk_tokens(all_tokens)
+    }
+    return chunk
+
+def process_chunk_count_tokens(chunk, duplicates=None):
+    """ Count the document frequencies of the tokens in the chunk """
+    weights = None
+    if duplicates is not None:
+        weights = get_duplicate_counts(chunk['notes']['ROW_ID'], duplicates)
+
+    icv = count_chunk_tokens(chunk['tokens'], weights)
+    return icv
+
+def process_batch_transform_tokens(chunks, config, vectorizer,
+        duplicates=None, num_partitions=1):
+    """ Convert the tokens of a batch of chunks to bags of words and write
+    them to the bag-of-words store
+    """
+    all_transformed = [
+        transform_chunk(
+            chunk['notes'], chunk['tokens'], config, chunk['shard'],
+            vectorizer, duplicates
+        ) for chunk in chunks
+    ]
+
+    batch = chunks[0]['shard']
+    index = write_bow_batch(all_transformed, config, batch, num_partitions)
+    return index
+
+def process_batch_clean_hash(dfs, config, hv, num_partitions=1):
+    """ Clean the notes in a batch of chunks and write their hashed bags of
+    words
+    """
+    chunks = [process_chunk_clean_tokens(df, config) for df in dfs]
+    index = process_batch_transform_tokens(
+        chunks, config, hv, num_partitions=num_partitions
+    )
+    return index
 
-def add_text(episode_record, df_notes):
-    
-    # and now only those within the first two days
-    m_two_days = df_notes['Hours'] < TWO_DAYS
-    df_notes = df_notes[m_two_days]
-    
-    # then add the remaining notes
-    df_notes.apply(update_note_type, axis=1, args=(episode_record,))
+def transform_chunk_batches(chunk_futures, args, client, **kwargs):
+    """ Transform the chunks (from `process_chunk_clean_tokens`) which are
+    held by the workers in batches (see `get_batch_num_chunks`)
+
+    The tokens of each batch are moved to the worker which writes it. The
+    `kwargs` are passed to `process_batch_transform_tokens`.
+    """
+    index_futures = [
+        client.submit(process_batch_transform_tokens, batch, **kwargs)
+            for batch in iterate_batches(
+                chunk_futures, get_batch_num_chunks(args)
+            )
+    ]
+
+    all_indices = dask_utils.collect_results(index_futures,
+        finished_only=False, progress_bar=True)
+    return all_indices
+
+def create_bow_fused(note_chunks, args, config, client, deduplicator=None):
+    """ Clean the notes, create the count vectorizer and transform the notes
+    to bags of words without writing the cleaned notes to disk
+
+    The tokens of each chunk stay in the memory of the worker which cleaned
+    them until the vocabulary is fixed. The (partial) document frequencies are
+    merged on the workers, so only the final vocabulary is sent to the driver.
+
+    With the hashing vectorizer, each batch of chunks is transformed directly
+    after it is cleaned, and any pruning happens afterwards. If duplicate notes are
+    removed (with `deduplicator`), the chunks are only transformed after all
+    notes are read, since the duplicates of a chunk may come from later
+    chunks.
+    """
+    remove_bow_stores(config)
+    shared_config = mp_broadcast.broadcast(client, config)
+
+    if args.vectorizer == 'hashing':
+        hv = mp_notes_nlp.HashingTokenVectorizer(args.num_hash_buckets)
+        write_vectorizer(hv, args, config)
+
+    if (args.vectorizer == 'hashing') and (deduplicator is None):
+        msg = "Cleaning, tokenizing and hashing the notes"
+        logger.info(msg)
+        note_batches = iterate_batches(note_chunks, get_batch_num_chunks(args))
+        index_futures = mp_broadcast.submit_iter(
+            note_batches,
+            client,
+            process_batch_clean_hash,
+            shared_config,
+            mp_broadcast.broadcast(client, hv),
+            args.num_partitions,
+            progress_bar=True
+        )
+        all_indices = dask_utils.collect_results(index_futures,
+            finished_only=False)
+        df_index = write_bow_index(all_indices, args, config)
+
+        if args.prune_hashed:
+            prune_hashed_bow(df_index, args, config, client)
+
+        return df_index
+
+    msg = "Cleaning and tokenizing the notes"
+    logger.info(msg)
+    chunk_futures = mp_broadcast.submit_iter(
+        note_chunks,
+        client,
+        process_chunk_clean_tokens,
+        shared_config,
+        progress_bar=True
+    )
+
+    # all notes have been read, so all duplicates are known
+    duplicates = None
+    if deduplicator is not None:
+        duplicates = get_duplicate_lookup(deduplicator.get_duplicates())
+        duplicates = mp_broadcast.broadcast(client, duplicates)
 
-def get_final_record(
-        row,
+    if args.vectorizer == 'hashing':
+        vectorizer = mp_broadcast.broadcast(client, hv)
+    else:
+        msg = "Counting the tokens"
+        logger.info(msg)
+        icv_futures = client.map(
+            process_chunk_count_tokens,
+            chunk_futures,
+            duplicates=duplicates
+        )
+        icv_fit = tree_merge_count_vectorizers(icv_futures, config, client)
+
+        write_vectorizer(icv_fit, args, config)
+        vectorizer = get_shared_vectorizer(icv_fit, client)
+
+    msg = "Transforming the tokens to bags of words"
+    logger.info(msg)
+    all_indices = transform_chunk_batches(
+        chunk_futures,
         args,
-        config,
-        return_record=False):
-    """ Merge the text with the other data about the episode
+        client,
+        config=shared_config,
+        vectorizer=vectorizer,
+        duplicates=duplicates,
+        num_partitions=args.num_partitions
+    )
+
+    # release the tokens on the workers
+    client.cancel(chunk_futures)
+
+    df_index = write_bow_index(all_indices, args, config)
+
+    if (args.vectorizer == 'hashing') and args.prune_hashed:
+        prune_hashed_bow(df_index, args, config, client)
+
+    return df_index
+
+###
+# Create the timelines of the combined BoW
+###
+def process_partition(df_partition, config):
+    """ Write the bags of words of all notes in one partition of the
+    bag-of-words store to the same part of the timeline store
     """
-    subject_id = int(row['SUBJECT_ID'])
-    hadm_id = int(row['HADM_ID'])
-    episode_id = row['EPISODE']
-    
-    episode_record = row.copy()
-    
-    # and add the text
-    
-    # create empty list for each type of note
-    for nt in NOTE_TYPES:
-        episode_record[nt] = []
-        
-    # extend the lists with the observed notes
-    note_events = mp_filenames.get_note_event_filename(
-        config['analysis_basepath'],
-        subject_id,
-        hadm_id,
-        note=NOTE_CLEANED_BOW_COMBINED
+    part = int(df_partition['PARTITION'].iloc[0])
+
+    # only the files of this partition are read, one shard at a time
+    note_store_path = get_note_store_path(config, NOTE_CLEANED_BOW)
+    df_notes = mp_note_store.read_notes(note_store_path, df_partition)
+
+    # put the duplicate notes (if any) back into their original order
+    if 'NOTE_ROW' in df_notes.columns:
+        df_notes = df_notes.sort_values('NOTE_ROW', kind='stable')
+        df_notes = df_notes.drop(columns=['NOTE_ROW'])
+
+    df_notes['NOTE_TYPE'] = get_note_type_codes(df_notes['CATEGORY'])
+
+    note_timeline_path = get_note_store_path(config, NOTE_CLEANED_BOW_TIMELINE)
+    df_index = mp_note_timeline.write_note_timeline_part(
+        df_notes, NOTE_TYPES, note_timeline_path, part
     )
+    return df_index
     
-    if os.path.exists(note_events):
-        df_notes = joblib.load(note_events)
-        
-        # fix the datetime data types
-        admit_time = pd.to_datetime(episode_record['ADMITTIME'])
-        df_notes['CHARTTIME'] = pd.to_datetime(df_notes['CHARTTIME'])
-        df_notes['Hours'] = df_notes['CHARTTIME'] - admit_time
-        
-        # and add them to the record
-        add_text(episode_record, df_notes)
+def combine_episode_notes(df_index, args, config, client, partitions=None):
+    """ Combine the bags of words of the notes of each admission into the
+    timeline store (see `mp_note_timeline`)
+
+    If `partitions` are given, then only those parts of the timeline store
+    are (re-)created, and the rest are kept.
+    """
+    note_timeline_path = get_note_store_path(config, NOTE_CLEANED_BOW_TIMELINE)
+
+    kept_index_dfs = []
+    if partitions is None:
+        mp_note_store.remove_note_store(note_timeline_path)
     else:
-        pass
+        df_index = df_index[df_index['PARTITION'].isin(partitions)]
+
+        df_timeline_index = load_note_timeline_index(config)
+        m_kept = ~df_timeline_index['PART'].isin(partitions)
+        kept_index_dfs.append(df_timeline_index[m_kept])
+
+    # the notes of each admission are all in the same partition
+    g_partitions = df_index.groupby('PARTITION')
+
+    all_index_dfs = dask_utils.apply_groups(
+        g_partitions,
+        client,
+        process_partition,
+        mp_broadcast.broadcast(client, config),
+        progress_bar=True
+    )
 
+    df_timeline_index = mp_note_timeline.write_note_timeline_index(
+        kept_index_dfs + all_index_dfs, note_timeline_path
+    )
+    return df_timeline_index
+
+###
+# Create the final, combined data record for each episode
+###
+def get_note_type_codes(categories):
+    """ Map the note categories to their index in `NOTE_TYPES`
+    """
+    note_types = categories.str.strip().map(NOTE_TYPE_MAPPINGS)
+
+    m_unknown = note_types.isnull()
+    if m_unknown.any():
+        unknown = categories[m_unknown].unique()
+        msg = "Unknown note categories: {}".format(unknown)
+        raise KeyError(msg)
+
+    codes = pd.Categorical(note_types, categories=NOTE_TYPES).codes
+    return codes
+
+def load_note_timeline_index(config):
+    note_timeline_path = get_note_store_path(config, NOTE_CLEANED_BOW_TIMELINE)
+    df_timeline_index = mp_note_timeline.load_note_timeline_index(
+        note_timeline_path
+    )
+    return df_timeline_index
+
+def aggregate_episode_notes(df, args, config, df_timeline_index=None):
+    """ Concatenate the token ids of all notes in the horizon for each episode
+
+    The notes of the episodes are selected from the timelines of their
+    admissions by binary search on the chart time, and the token ids are
+    concatenated per (note type, episode) in one pass over each part of the
+    timeline store. Within each group, the notes are in their order in
+    NOTEEVENTS, as before the timelines.
+
+    Returns
+    -------
+    groups: list of np.arrays
+        The token ids for note type `t` and the `i`th episode in `df` are at
+        `groups[t*len(df) + i]`
+    """
+    if df_timeline_index is None:
+        df_timeline_index = load_note_timeline_index(config)
+
+    num_episodes = len(df)
+    empty = np.zeros(0, dtype=np.int64)
+    groups = [empty] * (len(NOTE_TYPES) * num_episodes)
+
+    hadm_ids = df['HADM_ID'].values.astype(np.int64)
+    hadm_parts = df_timeline_index.set_index('HADM_ID')['PART']
+    parts = pd.Series(hadm_ids).map(hadm_parts).values
+
+    horizon = get_notes_horizon(args, config)
+    admit_times = pd.to_datetime(df['ADMITTIME']).values
+    note_timeline_path = get_note_store_path(config, NOTE_CLEANED_BOW_TIMELINE)
+
+    # episodes of admissions without notes are not in the index
+    for part in pd.unique(parts[~pd.isnull(parts)]):
+        positions = np.where(parts == part)[0]
+
+        timeline = mp_note_timeline.read_note_timeline_part(
+            note_timeline_path, int(part)
+        )
+        token_ids, group_sizes = timeline.get_horizon_groups(
+            hadm_ids[positions], admit_times[positions], horizon
+        )
+
+        part_groups = np.split(token_ids, np.cumsum(group_sizes)[:-1])
+        for t in range(len(NOTE_TYPES)):
+            for i, position in enumerate(positions):
+                groups[t*num_episodes + position] = (
+                    part_groups[t*len(positions) + i]
+                )
+
+    return groups
+
+def write_final_record(episode_record, config):
     f = mp_filenames.get_record_filename(
         config['analysis_basepath'],
-        row['SPLIT'],
-        subject_id,
-        episode_id
+        episode_record['SPLIT'],
+        int(episode_record['SUBJECT_ID']),
+        episode_record['EPISODE']
     )
     
     shell_utils.ensure_path_to_file_exists(f)
     joblib.dump(episode_record, f)
-    
-    ret = None
-    if return_record:
-        ret = episode_record
 
-    return ret
+def get_final_records(df, args, config, df_timeline_index=None):
+    """ Create and write the final records for all episodes in `df`
+    """
+    groups = aggregate_episode_notes(df, args, config, df_timeline_index)
+    num_episodes = len(df)
 
-def process_chunk_final_record(df, args, config):
-    records = pd_utils.apply(
-        df, get_final_record, args, config, return_record=True
-    )
+    records = []
+    for position, (_, row) in enumerate(df.iterrows()):
+        episode_record = row.copy()
+
+        for t, nt in enumerate(NOTE_TYPES):
+            episode_record[nt] = groups[t*num_episodes + position].tolist()
+
+        write_final_record(episode_record, config)
+        records.append(episode_record)
+
+    return records
+
+def process_chunk_final_record(df, args, config, num_features=None,
+        df_timeline_index=None):
+    records = get_final_records(df, args, config, df_timeline_index)
     df_records = pd.DataFrame(records)
+
+    # convert the lists to sparse matrices on the worker
+    if num_features is not None:
+        return mp_notes_matrix.get_bow_matrices(
+            df_records, NOTE_TYPES, num_features
+        )
+
     return df_records
     
 
 
-def create_all_combined_records(df_episodes, args, config, client):
-    g_episodes = pd_utils.split_df(df_episodes, chunk_size=args.chunk_size)
+def create_all_combined_records(df_episodes, args, config, client,
+        num_features=None):
+    """ Create the final records for all episodes
+
+    If `num_features` is given, then the result is the episodes and a sparse
+    matrix for each note type (see `mp_notes_matrix.get_bow_matrices`).
+    Otherwise, it is a data frame with the lists of token ids.
+    """
+    num_groups = max(1, len(df_episodes) // args.chunk_size)
+    g_episodes = pd_utils.split_df(df_episodes, num_groups=num_groups)
+
+    # the config and the index of the timelines are the same for all chunks
+    df_timeline_index = load_note_timeline_index(config)
+    shared_config, df_timeline_index = mp_broadcast.broadcast_all(
+        client, config, df_timeline_index
+    )
 
-     # this completes
     all_record_dfs = dask_utils.apply_groups(
-    #all_record_dfs = pd_utils.apply_groups(
         g_episodes,
-        client,    
+        client,
         process_chunk_final_record,
         args,
-        config,
+        shared_config,
+        num_features,
+        df_timeline_index,
         progress_bar=True
     )
+
+    if num_features is not None:
+        df_all_episodes = pd.concat([r[0] for r in all_record_dfs])
+        bow_matrices = {
+            nt: scipy.sparse.vstack(
+                [r[1][nt] for r in all_record_dfs], format='csr'
+            ) for nt in NOTE_TYPES
+        }
+        return df_all_episodes, bow_matrices
     
     df_all_records = pd.concat(all_record_dfs)
     return df_all_records
 
+def get_num_features(args, config):
+    """ Get the number of tokens (or hash buckets) of the vectorizer """
+    f = get_vectorizer_filename(args, config)
+    vectorizer = joblib.load(f)
+
+    if isinstance(vectorizer, mp_notes_nlp.HashingTokenVectorizer):
+        return vectorizer.num_buckets
+
+    return len(vectorizer.token_mapping_)
+
+def write_complete_dataset(df_episodes, args, config, client):
+    """ Create the final records for all episodes and write them in the
+    format from `--notes-bow-format` or the config
+    """
+    notes_bow_format = args.notes_bow_format
+    if notes_bow_format is None:
+        notes_bow_format = mp_notes_matrix.get_notes_bow_format(config)
+
+    if notes_bow_format == 'npz':
+        num_features = get_num_features(args, config)
+
+        msg = "Creating the final, sparse bag-of-words matrices"
+        logger.info(msg)
+        df_all_episodes, bow_matrices = create_all_combined_records(
+            df_episodes, args, config, client, num_features
+        )
+
+        metadata = {
+            'vectorizer': args.vectorizer,
+            'vectorizer_file': get_vectorizer_filename(args, config)
+        }
+
+        msg = "Writing the sparse matrices to disk: '{}'".format(
+            mp_filenames.get_notes_bow_matrix_filename(
+                config['complete_episodes'], "metadata"))
+        logger.info(msg)
+        mp_notes_matrix.write_bow_matrices(df_all_episodes, bow_matrices,
+            config['complete_episodes'], metadata)
+        return
+
+    msg = "Creating the final, combined data frame"
+    logger.info(msg)
+    df_all_records = create_all_combined_records(df_episodes, args, config, client)
+
+    msg = "Writing complete dataset to disk: '{}'".format(config['complete_episodes'])
+    logger.info(msg)
+    joblib.dump(df_all_records, config['complete_episodes'])
+
 ###
 # The main program
 ###
@@ -490,6 +1545,67 @@ def parse_arguments() -> argparse.Namespace:
     parser.add_argument('--num-notes', type=int, default=None, help="The "
         "number of notes to read in. This is mostly for debugging purposes.")
 
+    parser.add_argument('--read-chunk-size', type=int, default=100000,
+        help="The number of rows of NOTEEVENTS to read at a time. The notes "
+        "are filtered and sent to the workers one chunk at a time.")
+
+    parser.add_argument('--fused', action='store_true', help="If this flag "
+        "is given, then each worker cleans and tokenizes its chunk of notes, "
+        "counts the tokens and, once the vocabulary is fixed, transforms the "
+        "tokens it still holds in memory to bags of words. The cleaned notes "
+        "are not written to disk.")
+
+    parser.add_argument('--vectorizer', choices=VALID_VECTORIZERS,
+        default=DEFAULT_VECTORIZER, help="The way to map tokens to ids. "
+        "\"count\" uses a vocabulary of all tokens from all notes (pruned with "
+        "min_df and max_df from the config). \"hashing\" maps each token to "
+        "one of --num-hash-buckets buckets, so it does not need a pass over "
+        "all notes before transforming them.")
+
+    parser.add_argument('--num-hash-buckets', type=int,
+        default=mp_notes_nlp.DEFAULT_NUM_HASH_BUCKETS, help="The number of "
+        "buckets for the hashing vectorizer")
+
+    parser.add_argument('--prune-hashed', action='store_true', help="If this "
+        "flag is given with the hashing vectorizer, then the buckets with a "
+        "document frequency outside [min_df, max_df] (from the config) are "
+        "removed from the bags of words afterwards.")
+
+    parser.add_argument('--notes-horizon', type=float, default=None,
+        help="Only notes within this many hours after the admission time are "
+        "added to the records. Default: notes_horizon from the config, or {} "
+        "hours.".format(DEFAULT_NOTES_HORIZON))
+
+    parser.add_argument('--keep-late-notes', action='store_true', help="If "
+        "this flag is given, then all notes are cleaned and used for the "
+        "vocabulary, and the horizon is only applied when creating the "
+        "records. Otherwise, notes outside of the horizon of all episodes "
+        "are removed before cleaning.")
+
+    parser.add_argument('--notes-bow-format', default=None,
+        choices=mp_notes_matrix.VALID_FORMATS, help="The format of the "
+        "complete dataset. \"jpkl\" is a data frame with a list of token ids "
+        "for each note type. \"npz\" is a sparse matrix of token counts for "
+        "each note type, aligned with a csv file of the episodes. Default: "
+        "notes_bow_format from the config, or \"jpkl\".")
+
+    parser.add_argument('--num-partitions', type=int, default=None,
+        help="The number of partitions (by HADM_ID) of the bag-of-words "
+        "store. The notes of each partition are combined by a single task. "
+        "Default: one partition for each thread of the dask workers.")
+
+    parser.add_argument('--partition-file-size', type=int,
+        default=DEFAULT_PARTITION_FILE_SIZE, help="The (approximate) number "
+        "of notes in each file of the bag-of-words store. The chunks are "
+        "transformed and written in batches which are large enough for this.")
+
+    parser.add_argument('--dedup-notes', action='store_true', help="If this "
+        "flag is given, then notes with the same text as an earlier note of "
+        "the same admission are not cleaned or vectorized; they get the bag "
+        "of words of the earlier note instead. The driver keeps a 24-byte "
+        "key for each distinct note and all duplicate notes (without their "
+        "text) in memory until the bags of words are created.")
+
     dask_utils.add_dask_options(parser)
     logging_utils.add_logging_options(parser)
     args = parser.parse_args()
@@ -504,54 +1620,58 @@ def main():
     logger.info(msg)
     client, cluster = dask_utils.connect(args)
 
-    msg = "Loading notes... this may be slow."
-    logger.info(msg)
-    df_notes = physionet_utils.get_notes(
-        config['mimic_basepath'], nrows=args.num_notes
-    )
-    
-    msg = "Removing discharge summaries"
-    logger.info(msg)
-    
-    # We do this because the first ~60k notes are discharge summaries. Since
-    # we always discard those, it makes testing difficult.
-    m_discharge = df_notes['CATEGORY'] == 'Discharge summary'
-    df_notes = df_notes[~m_discharge]
-
     msg = "Loading the episode information"
     logger.info(msg)
     df_episodes = pd.read_csv(config['extended_episodes'])
-    
+    args.num_partitions = get_num_partitions(args, client)
+
+    deduplicator = None
+    if args.dedup_notes:
+        deduplicator = NoteDeduplicator()
+
+    # the notes are read in chunks while they are processed
+    subject_ids = set()
+    note_chunks = iterate_note_chunks(
+        args, config, df_episodes, subject_ids, deduplicator
+    )
+
+    if args.fused:
+        msg = ("Cleaning notes, creating the count vectorizer and the "
+            "bag-of-words in a single pass")
+        logger.info(msg)
+        df_index = create_bow_fused(
+            note_chunks, args, config, client, deduplicator
+        )
+        log_stem_cache_stats(client)
+    else:
+        msg = "Cleaning notes"
+        logger.info(msg)
+        df_index = clean_notes(note_chunks, args, config, client)
+        log_stem_cache_stats(client)
+
+        duplicates = None
+        if deduplicator is not None:
+            duplicates = get_duplicate_lookup(deduplicator.get_duplicates())
+
+        msg = "Creating count vectorizer for notes"
+        logger.info(msg)
+        create_count_vectorizer(df_index, args, config, client, duplicates)
+
+        msg = "Creating the bag-of-words for the notes"
+        logger.info(msg)
+        df_index = create_bow(df_index, args, config, client, duplicates)
+
     msg = ("Filtering the list file to only include subjects for which we have "
         "some notes")
     logger.info(msg)
-    subject_ids = set(df_notes['SUBJECT_ID'])
     m_subject_ids = df_episodes['SUBJECT_ID'].isin(subject_ids)
     df_episodes = df_episodes[m_subject_ids]
 
-    msg = "Cleaning notes"
-    logger.info(msg)
-    clean_notes(df_notes, args, config, client)
-
-    msg = "Creating count vectorizer for notes"
-    logger.info(msg)
-    create_count_vectorizer(df_notes, args, config, client)
-
-    msg = "Creating the bag-of-words for the notes"
-    logger.info(msg)
-    create_bow(df_notes, args, config, client)
-
     msg = "Combining bag-of-words types per episode"
     logger.info(msg)
-    combine_episode_notes(df_notes, args, config, client)
-
-    msg = "Creating the final, combined data frame"
-    logger.info(msg)
-    df_all_records = create_all_combined_records(df_episodes, args, config, client)
+    combine_episode_notes(df_index, args, config, client)
 
-    msg = "Writing complete dataset to disk: '{}'".format(config['complete_episodes'])
-    logger.info(msg)
-    joblib.dump(df_all_records, config['complete_episodes'])
+    write_complete_dataset(df_episodes, args, config, client)
 
 if __name__ == '__main__':
         main()
\ No newline at end of file
@@ -0,0 +1,164 @@
+###
+# 
+# NAME OF THE PROGRAM THIS FILE BELONGS TO 
+#  
+# file: mimic-preprocessing
+#  
+# Authors: Brandon Malone (Brandon.malone@neclab.eu
+#               Jun Cheng (jun.cheng@neclab.eu)
+# 
+# NEC Laboratories Europe GmbH, Copyright (c) 2020, All rights reserved. 
+#     THIS HEADER MAY NOT BE EXTRACTED OR MODIFIED IN ANY WAY.
+#  
+#     PROPRIETARY INFORMATION --- 
+# 
+# SOFTWARE LICENSE AGREEMENT
+# ACADEMIC OR NON-PROFIT ORGANIZATION NONCOMMERCIAL RESEARCH USE ONLY
+# BY USING OR DOWNLOADING THE SOFTWARE, YOU ARE AGREEING TO THE TERMS OF THIS LICENSE AGREEMENT.  IF YOU DO NOT AGREE WITH THESE TERMS, YOU MAY NOT USE OR DOWNLOAD THE SOFTWARE.
+# 
+# This is a license agreement ("Agreement") between your academic institution or non-profit organization or self (called "Licensee" or "You" in this Agreement) and NEC Laboratories Europe GmbH (called "Licensor" in this Agreement).  All rights not specifically granted to you in this Agreement are reserved for Licensor. 
+# RESERVATION OF OWNERSHIP AND GRANT OF LICENSE: Licensor retains exclusive ownership of any copy of the Software (as defined below) licensed under this Agreement and hereby grants to Licensee a personal, non-exclusive, non-transferable license to use the Software for noncommercial research purposes, without the right to sublicense, pursuant to the terms and conditions of this Agreement. NO EXPRESS OR IMPLIED LICENSES TO ANY OF LICENSOR’S PATENT RIGHTS ARE GRANTED BY THIS LICENSE. As used in this Agreement, the term "Software" means (i) the actual copy of all or any portion of code for program routines made accessible to Licensee by Licensor pursuant to this Agreement, inclusive of backups, updates, and/or merged copies permitted hereunder or subsequently supplied by Licensor,  including all or any file structures, programming instructions, user interfaces and screen formats and sequences as well as any and all documentation and instructions related to it, and (ii) all or any derivatives and/or modifications created or made by You to any of the items specified in (i).
+# CONFIDENTIALITY/PUBLICATIONS: Licensee acknowledges that the Software is proprietary to Licensor, and as such, Licensee agrees to receive all such materials and to use the Software only in accordance with the terms of this Agreement.  Licensee agrees to use reasonable effort to protect the Software from unauthorized use, reproduction, distribution, or publication. All publication materials mentioning features or use of this software must explicitly include an acknowledgement the software was developed by NEC Laboratories Europe GmbH.
+# COPYRIGHT: The Software is owned by Licensor.  
+# PERMITTED USES:  The Software may be used for your own noncommercial internal research purposes. You understand and agree that Licensor is not obligated to implement any suggestions and/or feedback you might provide regarding the Software, but to the extent Licensor does so, you are not entitled to any compensation related thereto.
+# DERIVATIVES: You may create derivatives of or make modifications to the Software, however, You agree that all and any such derivatives and modifications will be owned by Licensor and become a part of the Software licensed to You under this Agreement.  You may only use such derivatives and modifications for your own noncommercial internal research purposes, and you may not otherwise use, distribute or copy such derivatives and modifications in violation of this Agreement.
+# BACKUPS:  If Licensee is an organization, it may make that number of copies of the Software necessary for internal noncommercial use at a single site within its organization provided that all information appearing in or on the original labels, including the copyright and trademark notices are copied onto the labels of the copies.
+# USES NOT PERMITTED:  You may not distribute, copy or use the Software except as explicitly permitted herein. Licensee has not been granted any trademark license as part of this Agreement. Neither the name of NEC Laboratories Europe GmbH nor the names of its contributors may be used to endorse or promote products derived from this Software without specific prior written permission.
+# You may not sell, rent, lease, sublicense, lend, time-share or transfer, in whole or in part, or provide third parties access to prior or present versions (or any parts thereof) of the Software.
+# ASSIGNMENT: You may not assign this Agreement or your rights hereunder without the prior written consent of Licensor. Any attempted assignment without such consent shall be null and void.
+# TERM: The term of the license granted by this Agreement is from Licensee's acceptance of this Agreement by downloading the Software or by using the Software until terminated as provided below.
+# The Agreement automatically terminates without notice if you fail to comply with any provision of this Agreement.  Licensee may terminate this Agreement by ceasing using the Software.  Upon any termination of this Agreement, Licensee will delete any and all copies of the Software. You agree that all provisions which operate to protect the proprietary rights of Licensor shall remain in force should breach occur and that the obligation of confidentiality described in this Agreement is binding in perpetuity and, as such, survives the term of the Agreement.
+# FEE: Provided Licensee abides completely by the terms and conditions of this Agreement, there is no fee due to Licensor for Licensee's use of the Software in accordance with this Agreement.
+# DISCLAIMER OF WARRANTIES:  THE SOFTWARE IS PROVIDED "AS-IS" WITHOUT WARRANTY OF ANY KIND INCLUDING ANY WARRANTIES OF PERFORMANCE OR MERCHANTABILITY OR FITNESS FOR A PARTICULAR USE OR PURPOSE OR OF NON-INFRINGEMENT.  LICENSEE BEARS ALL RISK RELATING TO QUALITY AND PERFORMANCE OF THE SOFTWARE AND RELATED MATERIALS.
+# SUPPORT AND MAINTENANCE: No Software support or training by the Licensor is provided as part of this Agreement.  
+# EXCLUSIVE REMEDY AND LIMITATION OF LIABILITY: To the maximum extent permitted under applicable law, Licensor shall not be liable for direct, indirect, special, incidental, or consequential damages or lost profits related to Licensee's use of and/or inability to use the Software, even if Licensor is advised of the possibility of such damage.
+# EXPORT REGULATION: Licensee agrees to comply with any and all applicable export control laws, regulations, and/or other laws related to embargoes and sanction programs administered by law.
+# SEVERABILITY: If any provision(s) of this Agreement shall be held to be invalid, illegal, or unenforceable by a court or other tribunal of competent jurisdiction, the validity, legality and enforceability of the remaining provisions shall not in any way be affected or impaired thereby.
+# NO IMPLIED WAIVERS: No failure or delay by Licensor in enforcing any right or remedy under this Agreement shall be construed as a waiver of any future or other exercise of such right or remedy by Licensor.
+# GOVERNING LAW: This Agreement shall be construed and enforced in accordance with the laws of Germany without reference to conflict of laws principles.  You consent to the personal jurisdiction of the courts of this country and waive their rights to venue outside of Germany.
+# ENTIRE AGREEMENT AND AMENDMENTS: This Agreement constitutes the sole and entire agreement between Licensee and Licensor as to the matter set forth herein and supersedes any previous agreements, understandings, and arrangements between the parties relating hereto.
+###
+""" Convert the `*_timeseries.csv` files created by the benchmark scripts from
+Harutyunyan et al. to a columnar (parquet) store partitioned by split.
+
+This only needs to be performed once. Afterwards, the time series features
+can be extracted from the store (see the `--use-ts-store` option of
+`extract-mimic-time-series-features`) rather than re-parsing all of the csv
+files.
+"""
+import logging
+import pyllars.logging_utils as logging_utils
+logger = logging.getLogger(__name__)
+
+import argparse
+import numpy as np
+import os
+import pandas as pd
+import pyllars.dask_utils as dask_utils
+import pyllars.pandas_utils as pd_utils
+import pyllars.shell_utils as shell_utils
+import pyllars.utils
+import shutil
+
+import mimic_preprocessing.mp_broadcast as mp_broadcast
+import mimic_preprocessing.mp_filenames as mp_filenames
+import mimic_preprocessing.mp_ts_normalization as mp_ts_normalization
+import mimic_preprocessing.mp_ts_store as mp_ts_store
+
+###
+# The main program
+###
+def parse_arguments() -> argparse.Namespace:
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description=__doc__
+    )
+
+    parser.add_argument('config', help="The path to the yaml configuration "
+        "file.")
+
+    parser.add_argument('--chunk-size', type=int, default=1000, help="The "
+        "number of episodes in each chunk. Each chunk is written to one part "
+        "file for each split.")
+
+    parser.add_argument('--num-episodes', type=int, default=None, help="The "
+        "number of episodes to process. Omit this argument to process all "
+        "episodes. This is mostly intended for debugging.")
+
+    parser.add_argument('--overwrite', action='store_true', help="If this "
+        "flag is given, then an existing store will be removed. Otherwise, "
+        "an existing store results in an error.")
+
+    dask_utils.add_dask_options(parser)
+    logging_utils.add_logging_options(parser)
+    args = parser.parse_args()
+    logging_utils.update_logging(args)
+    return args
+
+def main():
+    args = parse_arguments()
+    config = pyllars.utils.load_config(args.config, required_keys=['ts_store'])
+
+    data_path = mp_filenames.get_ts_store_data_path(config['ts_store'])
+    if os.path.exists(data_path):
+        if not args.overwrite:
+            msg = ("The time series store already exists: '{}'. Please use "
+                "--overwrite to replace it.".format(config['ts_store']))
+            raise FileExistsError(msg)
+
+        msg = "Removing the existing time series store: '{}'".format(data_path)
+        logger.warning(msg)
+        shutil.rmtree(data_path)
+
+    msg = "Connecting to dask client"
+    logger.info(msg)
+    client, cluster = dask_utils.connect(args)
+
+    msg = "Loading the list file"
+    logger.info(msg)
+    df_listfile = pd.read_csv(config['complete_listfile'])
+
+    if args.num_episodes is not None:
+        df_listfile = df_listfile.head(args.num_episodes)
+
+    df_listfile = df_listfile.reset_index(drop=True)
+    df_listfile['STAY_ID'] = np.arange(len(df_listfile), dtype=np.int32)
+
+    msg = "Finding the kinds of time series"
+    logger.info(msg)
+    row = df_listfile.iloc[0]
+    ts_file = mp_filenames.get_benchmark_ts_raw_filename(
+        benchmark_base=config['benchmark_base'],
+        split=row['SPLIT'],
+        subject_id=row['SUBJECT_ID'],
+        episode_id=row['EPISODE']
+    )
+    kinds = mp_ts_store.get_kinds(ts_file)
+
+    # all kinds with value mappings are kept as text in the store
+    text_kinds = list(mp_ts_normalization.get_value_mappings(config).keys())
+
+    msg = "Writing the time series data to the store"
+    logger.info(msg)
+    chunks = pd_utils.split_df(df_listfile, chunk_size=args.chunk_size)
+    all_num_rows = dask_utils.apply_groups(
+        chunks,
+        client,
+        mp_ts_store.write_store_chunk,
+        *mp_broadcast.broadcast_all(client, config, kinds, text_kinds),
+        progress_bar=True
+    )
+
+    df_num_rows = pd.concat(all_num_rows)
+    df_stay_index = df_listfile.merge(df_num_rows, on='STAY_ID')
+    df_stay_index = df_stay_index[mp_ts_store.STAY_INDEX_COLUMNS]
+
+    f = mp_filenames.get_ts_store_index_filename(config['ts_store'])
+    msg = "Writing the stay index: '{}'".format(f)
+    logger.info(msg)
+    shell_utils.ensure_path_to_file_exists(f)
+    df_stay_index.to_csv(f, index=False)
+
+if __name__ == '__main__':
+    main()
@@ -45,7 +45,9 @@ import pyllars.logging_utils as logging_utils
 logger = logging.getLogger(__name__)
 
 import argparse
+import functools
 import numpy as np
+import os
 import pandas as pd
 import pyllars.dask_utils as dask_utils
 import pyllars.pandas_utils as pd_utils
@@ -53,122 +55,180 @@ import pyllars.shell_utils as shell_utils
 import pyllars.utils
 import toolz.dicttoolz
 
+import mimic_preprocessing.mp_broadcast as mp_broadcast
 import mimic_preprocessing.mp_filenames as mp_filenames
+import mimic_preprocessing.mp_ts_manifest as mp_ts_manifest
+import mimic_preprocessing.mp_ts_matrix as mp_ts_matrix
+import mimic_preprocessing.mp_ts_features as mp_ts_features
+import mimic_preprocessing.mp_ts_normalization as mp_ts_normalization
+import mimic_preprocessing.mp_ts_store as mp_ts_store
 
 ###
 # Load the raw time series data
 ###
-def get_stacked_df(row, config):
-    
-    subject_id = row['SUBJECT_ID']
-    episode_id = row['EPISODE']
-    stay = row['stay']
-    
+def get_normalized_stacked_df(row, config, value_table):
+    """ Load the raw time series for the episode in `row` and convert the text
+    values to numbers (`num_value`) while stacking
+
+    Please see `mp_ts_normalization.stack_normalized_ts_data` for details.
+    """
     ts_path = mp_filenames.get_benchmark_ts_raw_filename(
         benchmark_base=config['benchmark_base'],
         split=row['SPLIT'],
         subject_id=row['SUBJECT_ID'],
         episode_id=row['EPISODE']
     )
-    
-    
-    df = pd.read_csv(ts_path)
-    df = pd.melt(df, id_vars=['Hours'], var_name="kind", value_name="value")
-    df = df.dropna(subset=['value'])
-    df = df.reset_index(drop=True)
-    df['stay'] = stay
-    df['SUBJECT_ID'] = subject_id
-    df['EPISODE'] = episode_id
-    return df
 
+    # keep the original text for all kinds with mappings
+    dtype = {kind: str for kind in value_table}
+    df = pd.read_csv(ts_path, dtype=dtype)
+    df = mp_ts_normalization.stack_normalized_ts_data(df, ['Hours'], value_table)
+    df['stay'] = row['stay']
+    df['SUBJECT_ID'] = row['SUBJECT_ID']
+    df['EPISODE'] = row['EPISODE']
+    return df
 
-def process_chunk(df, config):
-    df_chunk = pd_utils.apply(df, get_stacked_df, config)
-    df_chunk = pd.concat(df_chunk)
+def process_chunk_normalized(df, config, value_table, use_ts_store=False):
+    """ Load the time series for each episode in `df` with the text values
+    already converted to numbers (please see `mp_ts_normalization`). The
+    result does not include the `value` column.
+    """
+    if use_ts_store:
+        df_chunk = mp_ts_store.read_normalized_stacked_ts_data(
+            config['ts_store'], df['stay'], value_table
+        )
+    else:
+        df_chunk = pd_utils.apply(df, get_normalized_stacked_df, config,
+            value_table)
+        df_chunk = pd.concat(df_chunk)
     return df_chunk
 
 def load_raw_ts_data(df_listfile, args, config, client) -> pd.DataFrame:
+    """ Load the long-format time series data for all episodes
+
+    The text values are converted to numbers while parsing (please see
+    `mp_ts_normalization`), so the result includes the `num_value` column.
+
+    If `args.compact` is True, then the result is in the compact
+    representation (please see `get_compact_ts_data`). In that case,
+    `df_listfile` must include the `STAY_ID` column.
+    """
+    process_func = process_chunk_normalized
+    if args.compact:
+        process_func = process_chunk_compact
+
+    value_table = mp_ts_normalization.get_value_table(config)
+
+    # the config and value table are sent to each worker only once
+    shared_config, value_table = mp_broadcast.broadcast_all(
+        client, config, value_table
+    )
+
     chunks = pd_utils.split_df(df_listfile, chunk_size=args.chunk_size)
     stacked_dfs = dask_utils.apply_groups(
         chunks,
         client,
-        process_chunk,
-        config,
+        process_func,
+        shared_config,
+        value_table,
+        args.use_ts_store,
         progress_bar=True
     )
 
-    stacked_df = pd.concat(stacked_dfs)
-    stacked_df = stacked_df.reset_index(drop=True)
+    if args.compact:
+        stacked_df = concat_compact_ts_data(stacked_dfs)
+    else:
+        stacked_df = pd.concat(stacked_dfs)
+        stacked_df = stacked_df.reset_index(drop=True)
 
     return stacked_df
 
 ###
-# Cleaning up the text fields
+# The compact representation of the long-format data
 ###
-EYE_MAPPING = {   
-    '1 No Response': 1,
-    '2 To pain': 2,
-    '3 To speech': 3,
-    '4 Spontaneously': 4,
-    'None': 1,
-    'Spontaneously': 4,
-    'To Pain': 2,
-    'To Speech': 3
-}
-
-MOTOR_MAPPING = {
-    '1 No Response': 1,
-    '2 Abnorm extensn': 2,
-    '3 Abnorm flexion': 3,
-    '4 Flex-withdraws': 4,
-    '5 Localizes Pain': 5,
-    '6 Obeys Commands': 6,
-    'Abnormal Flexion': 3,
-    'Abnormal extension': 2,
-    'Flex-withdraws': 4,
-    'Localizes Pain': 5,
-    'No response': 1,
-    'Obeys Commands': 6
-}
-
-VERBAL_MAPPING = {
-    '1 No Response': 1,
-    '1.0 ET/Trach': 1,
-    '2 Incomp sounds': 2,
-    '3 Inapprop words': 3,
-    '4 Confused': 4,
-    '5 Oriented': 5,
-    'Confused': 4,
-    'Inappropriate Words': 3,
-    'Incomprehensible sounds': 2,
-    'No Response': 1,
-    'No Response-ETT': 1,
-    'Oriented': 5
-}
-    
-def update_values(stacked_df, kind, mapping):
-    m = stacked_df['kind'] == kind
-    vals = stacked_df.loc[m, 'value']
-    mapped_vals = vals.map(mapping)
-    stacked_df.loc[m, 'value'] = mapped_vals
-
-def clean_text_fields(df_ts_data) -> pd.DataFrame:
-    kind = 'Glascow coma scale eye opening'
-    update_values(df_ts_data, kind, EYE_MAPPING)
-
-    kind = 'Glascow coma scale motor response'
-    update_values(df_ts_data, kind, MOTOR_MAPPING)
+COMPACT_ID_COLUMNS = ['STAY_ID', 'SUBJECT_ID', 'EPISODE', 'stay']
+
+def get_stay_table(df_listfile) -> pd.DataFrame:
+    """ Assign an integer `STAY_ID` to each episode in the list file
+    """
+    df_stays = df_listfile.reset_index(drop=True)
+    df_stays['STAY_ID'] = np.arange(len(df_stays), dtype=np.int32)
+    return df_stays
+
+def get_compact_ts_data(df_ts_data, df_stays) -> pd.DataFrame:
+    """ Convert the (numeric) long-format data to a compact representation
+
+    The compact data frame contains the following columns:
+
+        * `STAY_ID` (int32): the identifier of the stay in `df_stays`
+        * `kind` (category)
+        * `Hours` (float32)
+        * `num_value` (float32)
+
+    The `stay`, `SUBJECT_ID` and `EPISODE` of each stay are only kept in
+    `df_stays`.
+
+    Parameters
+    ----------
+    df_ts_data: pd.DataFrame
+        The long-format data, including the `num_value` column
+
+    df_stays: pd.DataFrame
+        A data frame containing (at least) the `stay` and `STAY_ID` of each
+        stay in `df_ts_data`. Please see `get_stay_table`.
+
+    Returns
+    -------
+    df_compact: pd.DataFrame
+        The compact representation of `df_ts_data`
+    """
+    stay_ids = pd.Series(
+        df_stays['STAY_ID'].values, index=df_stays['stay'].values
+    )
+    stay_ids = df_ts_data['stay'].map(stay_ids)
+
+    df_compact = pd.DataFrame({
+        'STAY_ID': stay_ids.values.astype(np.int32),
+        'kind': pd.Categorical(df_ts_data['kind']),
+        'Hours': df_ts_data['Hours'].values.astype(np.float32),
+        'num_value': df_ts_data['num_value'].values.astype(np.float32)
+    })
+
+    return df_compact
+
+def concat_compact_ts_data(compact_dfs) -> pd.DataFrame:
+    """ Concatenate compact data frames, taking the union of the `kind`
+    categories
+    """
+    kinds = pd.api.types.union_categoricals(
+        [df['kind'] for df in compact_dfs],
+        sort_categories=True
+    )
 
-    kind = 'Glascow coma scale verbal response'
-    update_values(df_ts_data, kind, VERBAL_MAPPING)
+    df_compact = pd.concat(
+        [df.drop(columns=['kind']) for df in compact_dfs],
+        ignore_index=True
+    )
+    df_compact['kind'] = kinds
+    df_compact = df_compact[['STAY_ID', 'kind', 'Hours', 'num_value']]
 
-    df_ts_data['num_value'] = pd.to_numeric(df_ts_data['value'])
+    return df_compact
 
-    return df_ts_data
+def process_chunk_compact(df, config, value_table, use_ts_store=False):
+    """ Load the (normalized) time series for each episode in `df` and convert
+    the result to the compact representation
+    """
+    df_ts_data = process_chunk_normalized(df, config, value_table, use_ts_store)
+    df_compact = get_compact_ts_data(df_ts_data, df)
+    return df_compact
 
 ###
 # Feature extraction
 ###
+def interquartile_range(values):
+    iqr = values.quantile(0.75) - values.quantile(0.25)
+    return iqr
+
 FEATURE_EXTRACTORS = {
     "KURTOSIS": pd.Series.kurt,
     "MAX_ABSOLUTE_DEVIATION": pd.Series.mad,
@@ -178,7 +238,12 @@ FEATURE_EXTRACTORS = {
     "MIN": pd.Series.min,
     "SKEW": pd.Series.skew,
     "STD": pd.Series.std,
-    "COUNT": pd.Series.count
+    "COUNT": pd.Series.count,
+    "PERCENTILE_5": functools.partial(pd.Series.quantile, q=0.05),
+    "PERCENTILE_25": functools.partial(pd.Series.quantile, q=0.25),
+    "PERCENTILE_75": functools.partial(pd.Series.quantile, q=0.75),
+    "PERCENTILE_95": functools.partial(pd.Series.quantile, q=0.95),
+    "INTERQUARTILE_RANGE": interquartile_range
 }
 
 
@@ -227,13 +292,17 @@ def extract_time_series_features(
 def extract_episode_time_series_features(
         df_episode,
         subsequence_timepoints,
-        name_column='kind'):
+        name_column='kind',
+        stay_column='stay',
+        id_columns=['SUBJECT_ID', 'EPISODE']):
     
-    subject_id = df_episode.iloc[0]['SUBJECT_ID']
-    episode_id = df_episode.iloc[0]['EPISODE']
-    stay = df_episode.iloc[0]['stay']
+    ids = {
+        c: df_episode.iloc[0][c] for c in id_columns
+    }
+    stay = df_episode.iloc[0][stay_column]
     
-    kind_groups = df_episode.groupby(name_column)    
+    # "observed" skips the empty groups of categorical kinds
+    kind_groups = df_episode.groupby(name_column, observed=True)
     kind_stats = pd_utils.apply_groups(
         kind_groups,
         extract_time_series_features,
@@ -241,49 +310,300 @@ def extract_episode_time_series_features(
     )
     kind_stats = toolz.dicttoolz.merge(*kind_stats)
     
-    kind_stats['SUBJECT_ID'] = subject_id
-    kind_stats['EPISODE'] = episode_id
-    kind_stats['stay'] = stay
+    kind_stats.update(ids)
+    kind_stats[stay_column] = stay
     
     return kind_stats
 
 def extract_all_episode_time_series_features(
         df_episodes,
         subsequence_timepoints,
-        name_column='kind'):
+        name_column='kind',
+        stay_column='stay',
+        id_columns=['SUBJECT_ID', 'EPISODE']):
     
-    episode_groups = df_episodes.groupby('stay')
+    episode_groups = df_episodes.groupby(stay_column)
     all_ts_features = pd_utils.apply_groups(
         episode_groups,
         extract_episode_time_series_features,
         subsequence_timepoints,
-        name_column
+        name_column,
+        stay_column,
+        id_columns
     )
     
     df_ts_features = pd.DataFrame(all_ts_features)
     return df_ts_features
 
-def extract_all_time_series_features(df_ts_data, args, dask_client,
-        subsequence_timepoints=SUBSEQUENCE_TIMEPOINTS) -> pd.DataFrame:
+def extract_all_episode_time_series_features_vectorized(
+        df_episodes,
+        subsequence_timepoints,
+        name_column='kind',
+        stay_column='stay',
+        id_columns=['SUBJECT_ID', 'EPISODE']):
+    """ Calculate the same features as `extract_all_episode_time_series_features`
+    using numpy segment reductions over all stays in `df_episodes` at once
+    """
+    df_ts_features = mp_ts_features.extract_all_time_series_features(
+        df_episodes,
+        subsequence_timepoints,
+        feature_names=list(FEATURE_EXTRACTORS.keys()),
+        name_column=name_column,
+        stay_column=stay_column,
+        id_columns=id_columns
+    )
+
+    return df_ts_features
 
+FEATURE_ENGINES = {
+    "vectorized": extract_all_episode_time_series_features_vectorized,
+    "pandas": extract_all_episode_time_series_features
+}
+
+DEFAULT_FEATURE_ENGINE = "vectorized"
+
+def extract_all_time_series_features(df_ts_data, args, dask_client,
+        subsequence_timepoints=SUBSEQUENCE_TIMEPOINTS,
+        df_stays=None) -> pd.DataFrame:
+    """ Extract the features for all stays in `df_ts_data`
+
+    If `args.compact` is True, then `df_ts_data` must use the compact
+    representation, and `df_stays` is used to add the `SUBJECT_ID`, `EPISODE`
+    and `stay` of each stay to the features.
+    """
     groupby_field = 'stay'
+    id_columns = ['SUBJECT_ID', 'EPISODE']
+
+    if args.compact:
+        groupby_field = 'STAY_ID'
+        id_columns = []
+
     stay_chunks = pd_utils.group_and_chunk_df(
         df_ts_data, groupby_field, args.chunk_size
     )
 
+    feature_engine = FEATURE_ENGINES[args.feature_engine]
+
     all_ts_features = dask_utils.apply_groups(
         stay_chunks,
         dask_client,
-        extract_all_episode_time_series_features,
+        feature_engine,
         subsequence_timepoints,
+        stay_column=groupby_field,
+        id_columns=id_columns,
         progress_bar=True,
         return_futures=False
     )
 
     df_all_ts_features = pd.concat(all_ts_features)
 
+    if args.compact:
+        df_all_ts_features = df_all_ts_features.merge(
+            df_stays[COMPACT_ID_COLUMNS], on='STAY_ID'
+        )
+        df_all_ts_features = df_all_ts_features.drop(columns=['STAY_ID'])
+
     return df_all_ts_features
 
+###
+# Streaming: load, clean and extract the features on the workers
+###
+def process_chunk_streaming(df, config, value_table, subsequence_timepoints,
+        feature_engine=DEFAULT_FEATURE_ENGINE, use_ts_store=False):
+    """ Load the (normalized) time series for each episode in `df` and extract
+    the features. Only the features leave the worker.
+    """
+    df_ts_data = process_chunk_normalized(df, config, value_table, use_ts_store)
+
+    feature_engine = FEATURE_ENGINES[feature_engine]
+    df_ts_features = feature_engine(df_ts_data, subsequence_timepoints)
+
+    return df_ts_features
+
+def extract_all_time_series_features_streaming(df_listfile, args, config,
+        dask_client, subsequence_timepoints=SUBSEQUENCE_TIMEPOINTS) -> pd.DataFrame:
+    """ Extract the features for all episodes in `df_listfile` without
+    gathering the long-format time series data on the driver
+    """
+    value_table = mp_ts_normalization.get_value_table(config)
+    shared_config, value_table = mp_broadcast.broadcast_all(
+        dask_client, config, value_table
+    )
+    chunks = pd_utils.split_df(df_listfile, chunk_size=args.chunk_size)
+
+    all_ts_features = dask_utils.apply_groups(
+        chunks,
+        dask_client,
+        process_chunk_streaming,
+        shared_config,
+        value_table,
+        subsequence_timepoints,
+        args.feature_engine,
+        args.use_ts_store,
+        progress_bar=True,
+        return_futures=False
+    )
+
+    df_all_ts_features = pd.concat(all_ts_features)
+
+    return df_all_ts_features
+
+###
+# Rolling features: extract the features at many prediction times
+###
+def process_chunk_rolling(df, config, value_table, prediction_times=None,
+        hourly=False, subsequences=SUBSEQUENCES, use_ts_store=False):
+    """ Load the (normalized) time series for each episode in `df` and extract
+    the features at each prediction time. Only the features leave the worker.
+    """
+    df_ts_data = process_chunk_normalized(df, config, value_table, use_ts_store)
+
+    df_ts_features = mp_ts_features.extract_all_rolling_time_series_features(
+        df_ts_data,
+        subsequences,
+        prediction_times=prediction_times,
+        hourly=hourly,
+        feature_names=list(FEATURE_EXTRACTORS.keys()),
+        name_column='kind',
+        time_column='Hours',
+        value_column='num_value',
+        stay_column='stay',
+        id_columns=['SUBJECT_ID', 'EPISODE']
+    )
+
+    return df_ts_features
+
+def extract_all_rolling_time_series_features(df_listfile, args, config,
+        dask_client, subsequences=SUBSEQUENCES) -> pd.DataFrame:
+    """ Extract the features for all episodes in `df_listfile` at each of
+    `args.prediction_times` and/or every hour (`args.hourly`)
+
+    Each worker sorts the time series of its episodes once and calculates the
+    features for all prediction times from the same sorted data. Please see
+    `mp_ts_features.extract_rolling_window_features` for details.
+    """
+    value_table = mp_ts_normalization.get_value_table(config)
+    shared_config, value_table = mp_broadcast.broadcast_all(
+        dask_client, config, value_table
+    )
+    num_groups = max(1, len(df_listfile) // args.chunk_size)
+    chunks = pd_utils.split_df(df_listfile, num_groups=num_groups)
+
+    all_ts_features = dask_utils.apply_groups(
+        chunks,
+        dask_client,
+        process_chunk_rolling,
+        shared_config,
+        value_table,
+        args.prediction_times,
+        args.hourly,
+        subsequences,
+        args.use_ts_store,
+        progress_bar=True,
+        return_futures=False
+    )
+
+    df_all_ts_features = pd.concat(all_ts_features)
+
+    return df_all_ts_features
+
+###
+# Incremental extraction: only process new or changed stays
+###
+def get_feature_config_hash(config):
+    """ Get a hash of everything which affects the feature values
+    """
+    feature_config = {
+        'SUBSEQUENCE_TIMEPOINTS': SUBSEQUENCE_TIMEPOINTS.tolist(),
+        'FEATURE_EXTRACTORS': list(FEATURE_EXTRACTORS.keys()),
+        'PERIOD_LENGTH': PERIOD_LENGTH,
+        'value_mappings': mp_ts_normalization.get_value_mappings(config)
+    }
+
+    config_hash = mp_ts_manifest.get_config_hash(feature_config)
+    return config_hash
+
+def get_episode_fingerprint(row, config):
+    ts_path = mp_filenames.get_benchmark_ts_raw_filename(
+        benchmark_base=config['benchmark_base'],
+        split=row['SPLIT'],
+        subject_id=row['SUBJECT_ID'],
+        episode_id=row['EPISODE']
+    )
+
+    fingerprint = mp_ts_manifest.get_fingerprint(ts_path)
+    return fingerprint
+
+def process_chunk_incremental(df, config, value_table, subsequence_timepoints,
+        feature_engine=DEFAULT_FEATURE_ENGINE, use_ts_store=False):
+    """ Extract the features for each episode in `df` and write them, along
+    with the fingerprints in `df`, to a pending part
+    """
+    df_ts_features = process_chunk_streaming(
+        df, config, value_table, subsequence_timepoints, feature_engine,
+        use_ts_store
+    )
+
+    # use the (listfile) index of the first episode to identify the part
+    part = int(df.index[0])
+    mp_ts_manifest.write_pending_part(
+        df_ts_features, df, config['time_series_features'], part
+    )
+
+def update_all_time_series_features(df_listfile, args, config, dask_client,
+        subsequence_timepoints=SUBSEQUENCE_TIMEPOINTS) -> None:
+    """ Extract the features for all new or changed episodes in `df_listfile`
+    and merge them into the existing time series features file
+    """
+    time_series_features = config['time_series_features']
+    shell_utils.ensure_path_to_file_exists(time_series_features)
+
+    msg = "Merging the pending features of previous runs"
+    logger.info(msg)
+    mp_ts_manifest.merge_pending_parts(time_series_features)
+
+    msg = "Finding new and changed episodes"
+    logger.info(msg)
+    fingerprints = pd_utils.apply(df_listfile, get_episode_fingerprint, config)
+    df_fingerprints = pd.DataFrame(fingerprints, index=df_listfile.index)
+    df_fingerprints['CONFIG_HASH'] = get_feature_config_hash(config)
+    df_listfile = pd.concat([df_listfile, df_fingerprints], axis=1)
+
+    df_manifest = mp_ts_manifest.load_manifest(time_series_features)
+    m_stale = mp_ts_manifest.get_stale_stays(df_listfile, df_manifest)
+    df_stale = df_listfile[m_stale]
+
+    msg = "Found {} new or changed episodes (of {})".format(
+        len(df_stale), len(df_listfile))
+    logger.info(msg)
+
+    if len(df_stale) == 0:
+        return
+
+    value_table = mp_ts_normalization.get_value_table(config)
+    shared_config, value_table = mp_broadcast.broadcast_all(
+        dask_client, config, value_table
+    )
+    num_groups = max(1, len(df_stale) // args.chunk_size)
+    chunks = pd_utils.split_df(df_stale, num_groups=num_groups)
+
+    dask_utils.apply_groups(
+        chunks,
+        dask_client,
+        process_chunk_incremental,
+        shared_config,
+        value_table,
+        subsequence_timepoints,
+        args.feature_engine,
+        args.use_ts_store,
+        progress_bar=True,
+        return_futures=False
+    )
+
+    msg = "Merging the new features: '{}'".format(time_series_features)
+    logger.info(msg)
+    mp_ts_manifest.merge_pending_parts(time_series_features)
+
 
 ###
 # The main program
@@ -305,6 +625,49 @@ def parse_arguments() -> argparse.Namespace:
         "number of episodes to process. Omit this argument to process all "
         "episodes. This is mostly intended for debugging.")
 
+    parser.add_argument('--feature-engine', default=DEFAULT_FEATURE_ENGINE,
+        choices=sorted(FEATURE_ENGINES.keys()), help="The implementation "
+        "used to calculate the features. \"vectorized\" calculates the "
+        "features for all stays in a chunk at once, while \"pandas\" calls "
+        "the `pd.Series` methods for each stay, kind and window.")
+
+    parser.add_argument('--streaming', action='store_true', help="If this "
+        "flag is given, then each worker loads and cleans the time series of "
+        "its episodes and only returns the extracted features. Otherwise, "
+        "all of the raw time series data is first collected on the driver.")
+
+    parser.add_argument('--use-ts-store', action='store_true', help="If this "
+        "flag is given, then the time series are read from the columnar store "
+        "given by `ts_store` in the config file rather than from the "
+        "benchmark csv files. Please see `create-mimic-ts-store`.")
+
+    parser.add_argument('--compact', action='store_true', help="If this "
+        "flag is given, then the long-format data uses integer stay "
+        "identifiers, a categorical kind and float32 times and values. This "
+        "reduces the memory on the driver, but the features are calculated "
+        "from float32 values. This flag has no effect with --streaming.")
+
+    parser.add_argument('--incremental', action='store_true', help="If this "
+        "flag is given, then only episodes whose time series file or feature "
+        "configuration changed since the last (incremental) run are "
+        "processed, and their features are merged into the existing "
+        "features file. Each chunk is written as soon as it is finished, so "
+        "an interrupted run can be resumed. The episodes are processed as "
+        "with --streaming.")
+
+    parser.add_argument('--prediction-times', type=float, nargs='+',
+        default=None, help="If given, the features are extracted at each of "
+        "these prediction times (in hours, e.g., 24 48 72) rather than only "
+        "for the first {} hours. The windows are the same fractions of each "
+        "prediction time. The features are written to the \"rolling\" "
+        "version of `time_series_features`, with one row for each stay and "
+        "prediction time.".format(PERIOD_LENGTH))
+
+    parser.add_argument('--hourly', action='store_true', help="If this flag "
+        "is given, then the features are extracted at every hour of each "
+        "stay, as for the decompensation and length-of-stay benchmark "
+        "problems. This can be combined with --prediction-times.")
+
     dask_utils.add_dask_options(parser)
     logging_utils.add_logging_options(parser)
     args = parser.parse_args()
@@ -326,24 +689,82 @@ def main():
     if args.num_episodes is not None:
         df_listfile = df_listfile.head(args.num_episodes)
 
-    msg = "Loading the raw time series data"
-    logger.info(msg)
-    df_ts_data = load_raw_ts_data(df_listfile, args, config, client)
-
-    msg = "Cleaning the text time series features"
-    logger.info(msg)
-    df_ts_data = clean_text_fields(df_ts_data)
-
-    msg = "Extracting hand-crafted time series features"
-    logger.info(msg)
-    df_all_ts_features = extract_all_time_series_features(df_ts_data, args,
-        client, subsequence_timepoints=SUBSEQUENCE_TIMEPOINTS)
+    ts_features_format = mp_ts_matrix.get_ts_features_format(config)
+
+    if (args.prediction_times is not None) or args.hourly:
+        rolling_ts_features = mp_filenames.get_rolling_ts_features_filename(
+            config['time_series_features']
+        )
+
+        msg = "Extracting hand-crafted time series features at each prediction time"
+        logger.info(msg)
+        df_all_ts_features = extract_all_rolling_time_series_features(
+            df_listfile, args, config, client, subsequences=SUBSEQUENCES
+        )
+
+        msg = "Writing features to disk: '{}'".format(rolling_ts_features)
+        logger.info(msg)
+
+        shell_utils.ensure_path_to_file_exists(rolling_ts_features)
+        mp_ts_matrix.write_ts_features(df_all_ts_features, rolling_ts_features,
+            ts_features_format)
+        return
+
+    if args.incremental:
+        msg = "Updating the hand-crafted time series features incrementally"
+        logger.info(msg)
+        update_all_time_series_features(df_listfile, args, config, client,
+            subsequence_timepoints=SUBSEQUENCE_TIMEPOINTS)
+
+        # the incremental updates are always merged into the csv file
+        if ts_features_format != 'csv':
+            msg = "Converting the features to the {} format".format(
+                ts_features_format)
+            logger.info(msg)
+            df_all_ts_features = pd.read_csv(config['time_series_features'])
+            mp_ts_matrix.write_ts_features(df_all_ts_features,
+                config['time_series_features'], ts_features_format)
+        return
+
+    if args.streaming:
+        msg = ("Loading, cleaning and extracting hand-crafted time series "
+            "features on the workers")
+        logger.info(msg)
+        df_all_ts_features = extract_all_time_series_features_streaming(
+            df_listfile, args, config, client,
+            subsequence_timepoints=SUBSEQUENCE_TIMEPOINTS
+        )
+    else:
+        df_stays = None
+        if args.compact:
+            df_listfile = df_stays = get_stay_table(df_listfile)
+
+        msg = ("Loading the raw time series data and converting the text "
+            "values to numbers")
+        logger.info(msg)
+        df_ts_data = load_raw_ts_data(df_listfile, args, config, client)
+
+        msg = "Extracting hand-crafted time series features"
+        logger.info(msg)
+        df_all_ts_features = extract_all_time_series_features(df_ts_data,
+            args, client, subsequence_timepoints=SUBSEQUENCE_TIMEPOINTS,
+            df_stays=df_stays)
     
     msg = "Writing features to disk: '{}'".format(config['time_series_features'])
     logger.info(msg)
 
     shell_utils.ensure_path_to_file_exists(config['time_series_features'])
-    df_all_ts_features.to_csv(config['time_series_features'], index=False)
+    mp_ts_matrix.write_ts_features(df_all_ts_features,
+        config['time_series_features'], ts_features_format)
+
+    # the manifest of a previous incremental run no longer matches the file
+    f = mp_filenames.get_ts_features_manifest_filename(
+        config['time_series_features']
+    )
+    if os.path.exists(f):
+        msg = "Removing the outdated manifest: '{}'".format(f)
+        logger.info(msg)
+        os.remove(f)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,148 @@
+###
+# 
+# NAME OF THE PROGRAM THIS FILE BELONGS TO 
+#  
+# file: mimic-preprocessing
+#  
+# Authors: Brandon Malone (Brandon.malone@neclab.eu
+#               Jun Cheng (jun.cheng@neclab.eu)
+# 
+# NEC Laboratories Europe GmbH, Copyright (c) 2020, All rights reserved. 
+#     THIS HEADER MAY NOT BE EXTRACTED OR MODIFIED IN ANY WAY.
+#  
+#     PROPRIETARY INFORMATION --- 
+# 
+# SOFTWARE LICENSE AGREEMENT
+# ACADEMIC OR NON-PROFIT ORGANIZATION NONCOMMERCIAL RESEARCH USE ONLY
+# BY USING OR DOWNLOADING THE SOFTWARE, YOU ARE AGREEING TO THE TERMS OF THIS LICENSE AGREEMENT.  IF YOU DO NOT AGREE WITH THESE TERMS, YOU MAY NOT USE OR DOWNLOAD THE SOFTWARE.
+# 
+# This is a license agreement ("Agreement") between your academic institution or non-profit organization or self (called "Licensee" or "You" in this Agreement) and NEC Laboratories Europe GmbH (called "Licensor" in this Agreement).  All rights not specifically granted to you in this Agreement are reserved for Licensor. 
+# RESERVATION OF OWNERSHIP AND GRANT OF LICENSE: Licensor retains exclusive ownership of any copy of the Software (as defined below) licensed under this Agreement and hereby grants to Licensee a personal, non-exclusive, non-transferable license to use the Software for noncommercial research purposes, without the right to sublicense, pursuant to the terms and conditions of this Agreement. NO EXPRESS OR IMPLIED LICENSES TO ANY OF LICENSOR’S PATENT RIGHTS ARE GRANTED BY THIS LICENSE. As used in this Agreement, the term "Software" means (i) the actual copy of all or any portion of code for program routines made accessible to Licensee by Licensor pursuant to this Agreement, inclusive of backups, updates, and/or merged copies permitted hereunder or subsequently supplied by Licensor,  including all or any file structures, programming instructions, user interfaces and screen formats and sequences as well as any and all documentation and instructions related to it, and (ii) all or any derivatives and/or modifications created or made by You to any of the items specified in (i).
+# CONFIDENTIALITY/PUBLICATIONS: Licensee acknowledges that the Software is proprietary to Licensor, and as such, Licensee agrees to receive all such materials and to use the Software only in accordance with the terms of this Agreement.  Licensee agrees to use reasonable effort to protect the Software from unauthorized use, reproduction, distribution, or publication. All publication materials mentioning features or use of this software must explicitly include an acknowledgement the software was developed by NEC Laboratories Europe GmbH.
+# COPYRIGHT: The Software is owned by Licensor.  
+# PERMITTED USES:  The Software may be used for your own noncommercial internal research purposes. You understand and agree that Licensor is not obligated to implement any suggestions and/or feedback you might provide regarding the Software, but to the extent Licensor does so, you are not entitled to any compensation related thereto.
+# DERIVATIVES: You may create derivatives of or make modifications to the Software, however, You agree that all and any such derivatives and modifications will be owned by Licensor and become a part of the Software licensed to You under this Agreement.  You may only use such derivatives and modifications for your own noncommercial internal research purposes, and you may not otherwise use, distribute or copy such derivatives and modifications in violation of this Agreement.
+# BACKUPS:  If Licensee is an organization, it may make that number of copies of the Software necessary for internal noncommercial use at a single site within its organization provided that all information appearing in or on the original labels, including the copyright and trademark notices are copied onto the labels of the copies.
+# USES NOT PERMITTED:  You may not distribute, copy or use the Software except as explicitly permitted herein. Licensee has not been granted any trademark license as part of this Agreement. Neither the name of NEC Laboratories Europe GmbH nor the names of its contributors may be used to endorse or promote products derived from this Software without specific prior written permission.
+# You may not sell, rent, lease, sublicense, lend, time-share or transfer, in whole or in part, or provide third parties access to prior or present versions (or any parts thereof) of the Software.
+# ASSIGNMENT: You may not assign this Agreement or your rights hereunder without the prior written consent of Licensor. Any attempted assignment without such consent shall be null and void.
+# TERM: The term of the license granted by this Agreement is from Licensee's acceptance of this Agreement by downloading the Software or by using the Software until terminated as provided below.
+# The Agreement automatically terminates without notice if you fail to comply with any provision of this Agreement.  Licensee may terminate this Agreement by ceasing using the Software.  Upon any termination of this Agreement, Licensee will delete any and all copies of the Software. You agree that all provisions which operate to protect the proprietary rights of Licensor shall remain in force should breach occur and that the obligation of confidentiality described in this Agreement is binding in perpetuity and, as such, survives the term of the Agreement.
+# FEE: Provided Licensee abides completely by the terms and conditions of this Agreement, there is no fee due to Licensor for Licensee's use of the Software in accordance with this Agreement.
+# DISCLAIMER OF WARRANTIES:  THE SOFTWARE IS PROVIDED "AS-IS" WITHOUT WARRANTY OF ANY KIND INCLUDING ANY WARRANTIES OF PERFORMANCE OR MERCHANTABILITY OR FITNESS FOR A PARTICULAR USE OR PURPOSE OR OF NON-INFRINGEMENT.  LICENSEE BEARS ALL RISK RELATING TO QUALITY AND PERFORMANCE OF THE SOFTWARE AND RELATED MATERIALS.
+# SUPPORT AND MAINTENANCE: No Software support or training by the Licensor is provided as part of this Agreement.  
+# EXCLUSIVE REMEDY AND LIMITATION OF LIABILITY: To the maximum extent permitted under applicable law, Licensor shall not be liable for direct, indirect, special, incidental, or consequential damages or lost profits related to Licensee's use of and/or inability to use the Software, even if Licensor is advised of the possibility of such damage.
+# EXPORT REGULATION: Licensee agrees to comply with any and all applicable export control laws, regulations, and/or other laws related to embargoes and sanction programs administered by law.
+# SEVERABILITY: If any provision(s) of this Agreement shall be held to be invalid, illegal, or unenforceable by a court or other tribunal of competent jurisdiction, the validity, legality and enforceability of the remaining provisions shall not in any way be affected or impaired thereby.
+# NO IMPLIED WAIVERS: No failure or delay by Licensor in enforcing any right or remedy under this Agreement shall be construed as a waiver of any future or other exercise of such right or remedy by Licensor.
+# GOVERNING LAW: This Agreement shall be construed and enforced in accordance with the laws of Germany without reference to conflict of laws principles.  You consent to the personal jurisdiction of the courts of this country and waive their rights to venue outside of Germany.
+# ENTIRE AGREEMENT AND AMENDMENTS: This Agreement constitutes the sole and entire agreement between Licensee and Licensor as to the matter set forth herein and supersedes any previous agreements, understandings, and arrangements between the parties relating hereto.
+###
+""" This module contains helpers to send large, read-only objects (e.g., the
+vocabulary, the config or the value tables) to the dask workers only once.
+
+Arguments of `dask_utils.apply_groups` (and `client.submit`) are serialized
+into every task. A broadcast object is instead sent to each worker once and
+kept in its memory; the tasks only reference it by the key of its future.
+Dask replaces the future with the object before calling the function, so the
+functions themselves do not change.
+
+Similarly, `submit_iter` sends each item of a (large) stream, such as the
+chunks of NOTEEVENTS, directly to a worker, and only reads the next item
+when few enough tasks are pending.
+"""
+import dask.distributed
+import tqdm
+
+def broadcast(client, obj):
+    """ Send `obj` to all workers and get a future which refers to it
+
+    Parameters
+    ----------
+    client: dask.distributed.Client, or None
+        The client. If it is None, then `obj` is returned unchanged (e.g., for
+        local processing).
+
+    obj: any picklable object, or None
+        The object. Unlike `client.scatter`, dicts and lists are sent as a
+        single object rather than element-wise. None is not sent.
+
+    Returns
+    -------
+    future: dask.distributed.Future
+        The future which refers to `obj` on the workers. It can be passed to
+        tasks in place of `obj`.
+    """
+    if (client is None) or (obj is None):
+        return obj
+
+    # `hash=False` avoids tokenizing (that is, hashing) large objects
+    [future] = client.scatter([obj], broadcast=True, hash=False)
+    return future
+
+def broadcast_all(client, *objs):
+    """ Broadcast each of `objs` (see `broadcast`) and return their futures
+    in the same order
+    """
+    futures = tuple(broadcast(client, obj) for obj in objs)
+    return futures
+
+def submit_iter(it, client, func, *args, max_pending=None,
+        progress_bar=False, **kwargs):
+    """ Submit `func` for each item of `it`, with at most `max_pending`
+    unfinished tasks at a time
+
+    Unlike `dask_utils.apply_iter`, the items are not read faster than the
+    workers process them. Each item is scattered to a worker rather than
+    embedded in its task, and the driver keeps no reference to it, so it is
+    released as soon as its task finishes. Thus, only about `max_pending`
+    items are in memory at a time.
+
+    Parameters
+    ----------
+    it: iterable
+        The (lazy) inputs for `func`
+
+    client: dask.distributed.Client
+        The client
+
+    func: callable
+        The function to apply to each item of `it`
+
+    args, kwargs
+        Additional arguments to pass to `func`
+
+    max_pending: int, or None
+        The maximum number of unfinished tasks. By default, twice the number
+        of threads of the workers.
+
+    progress_bar: bool
+        Whether to show a progress bar for the submitted items
+
+    Returns
+    -------
+    futures: list of dask.distributed.Futures
+        The future of the result for each item, in the order of `it`
+    """
+    if max_pending is None:
+        num_threads = sum(client.nthreads().values())
+        max_pending = 2 * max(num_threads, 1)
+
+    if progress_bar:
+        it = tqdm.tqdm(it)
+
+    futures = []
+    pending = dask.distributed.as_completed()
+
+    for item in it:
+        # wait for a task to finish before reading more items
+        if pending.count() >= max_pending:
+            next(pending)
+
+        [item_future] = client.scatter([item], hash=False)
+        future = client.submit(func, item_future, *args, **kwargs)
+
+        futures.append(future)
+        pending.add(future)
+
+    return futures
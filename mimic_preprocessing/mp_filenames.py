@@ -398,6 +398,51 @@ def get_mimic_notes_count_vectorizer_filename(base_path):
     fname = os.path.join(base_path, 'processed-note-events', fname)
     return fname
 
+def get_mimic_notes_document_frequencies_filename(base_path):
+    """ Get the path to a file containing the raw (unpruned) document
+    frequencies of all tokens in the notes.
+
+    Parameters
+    ----------
+    base_path: path-like (e.g., a string)
+        The path to the base data directory
+
+    Returns
+    -------
+    mimic_notes_document_frequencies_filename: string
+        The path to the document frequencies file
+    """
+    fname = [
+        "notes-bow-document-frequencies",
+        ".jpkl.gz"
+    ]
+    fname = ''.join(fname)
+    fname = os.path.join(base_path, 'processed-note-events', fname)
+    return fname
+
+def get_mimic_notes_hashing_vectorizer_filename(base_path):
+    """ Get the path to a file containing the
+    `mp_notes_nlp.HashingTokenVectorizer` for the notes, including any pruned
+    buckets.
+
+    Parameters
+    ----------
+    base_path: path-like (e.g., a string)
+        The path to the base data directory
+
+    Returns
+    -------
+    mimic_notes_hashing_vectorizer_filename: string
+        The path to the vectorizer file
+    """
+    fname = [
+        "notes-bow-hashing-vectorizer",
+        ".jpkl.gz"
+    ]
+    fname = ''.join(fname)
+    fname = os.path.join(base_path, 'processed-note-events', fname)
+    return fname
+
 def get_note_event_filename(base_path, subject_id, hadm_id, row_id=None,
         compression_type="gz", note=None):
     """ Get the path to a processed NOTEEVENT file
@@ -496,4 +541,380 @@ def get_record_filename(base_path, split,
     ]
 
     f = os.path.join(*f)
-    return f
\ No newline at end of file
+    return f
+
+###
+# The columnar time series store
+###
+def get_ts_store_index_filename(ts_store):
+    """ Get the path to the file containing the stay index for the columnar
+    time series store
+
+    Parameters
+    ----------
+    ts_store: path-like (e.g., a string)
+        The path to the base directory of the store
+
+    Returns
+    -------
+    index_filename: string
+        The path to the stay index file
+    """
+    fname = os.path.join(ts_store, "stays.csv")
+    return fname
+
+def get_ts_store_data_path(ts_store):
+    """ Get the path to the (partitioned) parquet dataset containing the time
+    series data in the columnar time series store
+
+    Parameters
+    ----------
+    ts_store: path-like (e.g., a string)
+        The path to the base directory of the store
+
+    Returns
+    -------
+    data_path: string
+        The path to the dataset
+    """
+    data_path = os.path.join(ts_store, "data")
+    return data_path
+
+def get_ts_store_part_filename(ts_store, split, part):
+    """ Get the path to one part of the time series data in the columnar
+    time series store
+
+    The parts are partitioned by split following the "hive" convention, i.e.,
+    `data/SPLIT=<split>/part-<part>.parquet`.
+
+    Parameters
+    ----------
+    ts_store: path-like (e.g., a string)
+        The path to the base directory of the store
+
+    split: string
+        The split. Please see `VALID_BENCHMARK_SPLITS` for
+        a list of all valid splits
+
+    part: int
+        The identifier for the part
+
+    Returns
+    -------
+    part_filename: string
+        The path to the part file
+    """
+    _validate_split(split)
+
+    fname = "part-{:06d}.parquet".format(part)
+    fname = os.path.join(
+        get_ts_store_data_path(ts_store),
+        "SPLIT={}".format(split),
+        fname
+    )
+    return fname
+
+###
+# Incremental time series feature extraction
+###
+def get_ts_features_manifest_filename(time_series_features):
+    """ Get the path to the manifest for the time series features file
+
+    The manifest contains the fingerprint of the time series file and the
+    feature configuration used for each stay in `time_series_features`.
+
+    Parameters
+    ----------
+    time_series_features: path-like (e.g., a string)
+        The path to the time series features file
+
+    Returns
+    -------
+    manifest_filename: string
+        The path to the manifest file
+    """
+    base, ext = os.path.splitext(str(time_series_features))
+    fname = "".join([base, ".manifest", ext])
+    return fname
+
+def get_ts_features_pending_filename(time_series_features, part, note):
+    """ Get the path to the file containing the features (or manifest) for
+    one chunk of stays which have not yet been merged into the time series
+    features file
+
+    Parameters
+    ----------
+    time_series_features: path-like (e.g., a string)
+        The path to the time series features file
+
+    part: int
+        The identifier for the chunk
+
+    note: string
+        The type of the file. This should be either "features" or "manifest".
+
+    Returns
+    -------
+    pending_filename: string
+        The path to the pending file
+    """
+    base, ext = os.path.splitext(str(time_series_features))
+    fname = "part-{:06d}{}{}".format(part, _get_note_str(note), ext)
+    fname = os.path.join(base + ".pending", fname)
+    return fname
+
+###
+# Rolling time series features
+###
+def get_rolling_ts_features_filename(time_series_features):
+    """ Get the path to the file containing the time series features at
+    each prediction time, such as those used for the decompensation and
+    length-of-stay benchmark problems
+
+    Parameters
+    ----------
+    time_series_features: path-like (e.g., a string)
+        The path to the time series features file
+
+    Returns
+    -------
+    rolling_ts_features_filename: string
+        The path to the rolling features file
+    """
+    base, ext = os.path.splitext(str(time_series_features))
+    fname = "".join([base, ".rolling", ext])
+    return fname
+
+###
+# Hourly-binned time series tensors
+###
+def get_ts_tensor_filename(ts_tensor, note):
+    """ Get the path to one of the (memory-mapped) arrays of the hourly-binned
+    time series tensors
+
+    Parameters
+    ----------
+    ts_tensor: path-like (e.g., a string)
+        The path to the base directory of the tensors
+
+    note: string
+        The array. This should be either "values" or "mask".
+
+    Returns
+    -------
+    tensor_filename: string
+        The path to the (.npy) array file
+    """
+    fname = "ts-tensor{}.npy".format(_get_note_str(note))
+    fname = os.path.join(ts_tensor, fname)
+    return fname
+
+def get_ts_tensor_index_filename(ts_tensor):
+    """ Get the path to the file containing the stay index for the
+    hourly-binned time series tensors. The index gives the row of each stay
+    in the arrays.
+
+    Parameters
+    ----------
+    ts_tensor: path-like (e.g., a string)
+        The path to the base directory of the tensors
+
+    Returns
+    -------
+    index_filename: string
+        The path to the stay index file
+    """
+    fname = os.path.join(ts_tensor, "stays.csv")
+    return fname
+
+def get_ts_tensor_kinds_filename(ts_tensor):
+    """ Get the path to the file containing the kinds of time series, in the
+    order of the last axis of the hourly-binned time series tensors
+
+    Parameters
+    ----------
+    ts_tensor: path-like (e.g., a string)
+        The path to the base directory of the tensors
+
+    Returns
+    -------
+    kinds_filename: string
+        The path to the kinds file
+    """
+    fname = os.path.join(ts_tensor, "kinds.csv")
+    return fname
+
+###
+# Binary (float32 matrix) time series features
+###
+def get_ts_features_matrix_filename(time_series_features, note):
+    """ Get the path to one of the files of the binary version of the time
+    series features
+
+    Parameters
+    ----------
+    time_series_features: path-like (e.g., a string)
+        The path to the time series features file
+
+    note: string
+        The file. This should be one of "matrix" (the float32 features),
+        "columns" (the names of the columns of the matrix) or "stays" (the
+        identifiers of the rows of the matrix).
+
+    Returns
+    -------
+    matrix_filename: string
+        The path to the file
+    """
+    base, ext = os.path.splitext(str(time_series_features))
+
+    ext = ".csv"
+    if note == "matrix":
+        ext = ".npy"
+
+    fname = "".join([base, _get_note_str(note), ext])
+    return fname
+
+def get_notes_bow_matrix_filename(complete_episodes, note):
+    """ Get the path to one of the files of the sparse version of the bags of
+    words in the complete dataset
+
+    Parameters
+    ----------
+    complete_episodes: path-like (e.g., a string)
+        The path to the complete dataset
+
+    note: string
+        The file. This should be either a note type (the sparse matrix for
+        that type), "episodes" (the episode of each row of the matrices) or
+        "metadata".
+
+    Returns
+    -------
+    matrix_filename: string
+        The path to the file
+    """
+    base, ext = os.path.splitext(str(complete_episodes))
+
+    ext = ".npz"
+    if note == "episodes":
+        ext = ".csv"
+    elif note == "metadata":
+        ext = ".json"
+
+    fname = "".join([base, _get_note_str(note), ext])
+    return fname
+
+###
+# The sharded note store
+###
+def get_note_store_path(base_path, note):
+    """ Get the path to the base directory of a sharded note store
+
+    Parameters
+    ----------
+    base_path: path-like (e.g., a string)
+        The path to the base data directory
+
+    note: string
+        The processing step of the notes in the store (e.g., "cleaned" or
+        "cleaned-bow")
+
+    Returns
+    -------
+    note_store_path: string
+        The path to the directory of the store
+    """
+    note_store_path = os.path.join(base_path, 'processed-note-events', note)
+    return note_store_path
+
+def get_note_store_shard_filename(note_store_path, shard, partition=None):
+    """ Get the path to one shard of a note store
+
+    Parameters
+    ----------
+    note_store_path: path-like (e.g., a string)
+        The path to the directory of the store, e.g., from
+        `get_note_store_path`
+
+    shard: int
+        The identifier of the shard
+
+    partition: int, or None
+        For partitioned stores, the partition. The files of each partition
+        are in their own directory.
+
+    Returns
+    -------
+    shard_filename: string
+        The path to the (parquet) shard file
+    """
+    fname = "shard-{:08d}.parquet".format(shard)
+
+    if partition is not None:
+        partition_dir = "partition-{:05d}".format(partition)
+        fname = os.path.join(partition_dir, fname)
+
+    fname = os.path.join(note_store_path, fname)
+    return fname
+
+def get_note_store_vocabulary_filename(note_store_path, shard):
+    """ Get the path to the (chunk-local) vocabulary of one shard of a note
+    store
+
+    Parameters
+    ----------
+    note_store_path: path-like (e.g., a string)
+        The path to the directory of the store, e.g., from
+        `get_note_store_path`
+
+    shard: int
+        The identifier of the shard
+
+    Returns
+    -------
+    vocabulary_filename: string
+        The path to the (parquet) vocabulary file
+    """
+    fname = "shard-{:08d}.vocabulary.parquet".format(shard)
+    fname = os.path.join(note_store_path, fname)
+    return fname
+
+def get_note_timeline_part_filename(note_timeline_path, part):
+    """ Get the path to one part of a note timeline store
+
+    Parameters
+    ----------
+    note_timeline_path: path-like (e.g., a string)
+        The path to the directory of the store, e.g., from
+        `get_note_store_path`
+
+    part: int
+        The identifier of the part
+
+    Returns
+    -------
+    part_filename: string
+        The path to the (npz) part file
+    """
+    fname = "part-{:08d}.npz".format(part)
+    fname = os.path.join(note_timeline_path, fname)
+    return fname
+
+def get_note_store_index_filename(note_store_path):
+    """ Get the path to the index of a note store. The index gives the shard
+    and offset of each note.
+
+    Parameters
+    ----------
+    note_store_path: path-like (e.g., a string)
+        The path to the directory of the store, e.g., from
+        `get_note_store_path`
+
+    Returns
+    -------
+    index_filename: string
+        The path to the index file
+    """
+    fname = os.path.join(note_store_path, "index.csv")
+    return fname
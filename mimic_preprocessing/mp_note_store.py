@@ -0,0 +1,358 @@
+###
+# 
+# NAME OF THE PROGRAM THIS FILE BELONGS TO 
+#  
+# file: mimic-preprocessing
+#  
+# Authors: Brandon Malone (Brandon.malone@neclab.eu
+#               Jun Cheng (jun.cheng@neclab.eu)
+# 
+# NEC Laboratories Europe GmbH, Copyright (c) 2020, All rights reserved. 
+#     THIS HEADER MAY NOT BE EXTRACTED OR MODIFIED IN ANY WAY.
+#  
+#     PROPRIETARY INFORMATION --- 
+# 
+# SOFTWARE LICENSE AGREEMENT
+# ACADEMIC OR NON-PROFIT ORGANIZATION NONCOMMERCIAL RESEARCH USE ONLY
+# BY USING OR DOWNLOADING THE SOFTWARE, YOU ARE AGREEING TO THE TERMS OF THIS LICENSE AGREEMENT.  IF YOU DO NOT AGREE WITH THESE TERMS, YOU MAY NOT USE OR DOWNLOAD THE SOFTWARE.
+# 
+# This is a license agreement ("Agreement") between your academic institution or non-profit organization or self (called "Licensee" or "You" in this Agreement) and NEC Laboratories Europe GmbH (called "Licensor" in this Agreement).  All rights not specifically granted to you in this Agreement are reserved for Licensor. 
+# RESERVATION OF OWNERSHIP AND GRANT OF LICENSE: Licensor retains exclusive ownership of any copy of the Software (as defined below) licensed under this Agreement and hereby grants to Licensee a personal, non-exclusive, non-transferable license to use the Software for noncommercial research purposes, without the right to sublicense, pursuant to the terms and conditions of this Agreement. NO EXPRESS OR IMPLIED LICENSES TO ANY OF LICENSOR’S PATENT RIGHTS ARE GRANTED BY THIS LICENSE. As used in this Agreement, the term "Software" means (i) the actual copy of all or any portion of code for program routines made accessible to Licensee by Licensor pursuant to this Agreement, inclusive of backups, updates, and/or merged copies permitted hereunder or subsequently supplied by Licensor,  including all or any file structures, programming instructions, user interfaces and screen formats and sequences as well as any and all documentation and instructions related to it, and (ii) all or any derivatives and/or modifications created or made by You to any of the items specified in (i).
+# CONFIDENTIALITY/PUBLICATIONS: Licensee acknowledges that the Software is proprietary to Licensor, and as such, Licensee agrees to receive all such materials and to use the Software only in accordance with the terms of this Agreement.  Licensee agrees to use reasonable effort to protect the Software from unauthorized use, reproduction, distribution, or publication. All publication materials mentioning features or use of this software must explicitly include an acknowledgement the software was developed by NEC Laboratories Europe GmbH.
+# COPYRIGHT: The Software is owned by Licensor.  
+# PERMITTED USES:  The Software may be used for your own noncommercial internal research purposes. You understand and agree that Licensor is not obligated to implement any suggestions and/or feedback you might provide regarding the Software, but to the extent Licensor does so, you are not entitled to any compensation related thereto.
+# DERIVATIVES: You may create derivatives of or make modifications to the Software, however, You agree that all and any such derivatives and modifications will be owned by Licensor and become a part of the Software licensed to You under this Agreement.  You may only use such derivatives and modifications for your own noncommercial internal research purposes, and you may not otherwise use, distribute or copy such derivatives and modifications in violation of this Agreement.
+# BACKUPS:  If Licensee is an organization, it may make that number of copies of the Software necessary for internal noncommercial use at a single site within its organization provided that all information appearing in or on the original labels, including the copyright and trademark notices are copied onto the labels of the copies.
+# USES NOT PERMITTED:  You may not distribute, copy or use the Software except as explicitly permitted herein. Licensee has not been granted any trademark license as part of this Agreement. Neither the name of NEC Laboratories Europe GmbH nor the names of its contributors may be used to endorse or promote products derived from this Software without specific prior written permission.
+# You may not sell, rent, lease, sublicense, lend, time-share or transfer, in whole or in part, or provide third parties access to prior or present versions (or any parts thereof) of the Software.
+# ASSIGNMENT: You may not assign this Agreement or your rights hereunder without the prior written consent of Licensor. Any attempted assignment without such consent shall be null and void.
+# TERM: The term of the license granted by this Agreement is from Licensee's acceptance of this Agreement by downloading the Software or by using the Software until terminated as provided below.
+# The Agreement automatically terminates without notice if you fail to comply with any provision of this Agreement.  Licensee may terminate this Agreement by ceasing using the Software.  Upon any termination of this Agreement, Licensee will delete any and all copies of the Software. You agree that all provisions which operate to protect the proprietary rights of Licensor shall remain in force should breach occur and that the obligation of confidentiality described in this Agreement is binding in perpetuity and, as such, survives the term of the Agreement.
+# FEE: Provided Licensee abides completely by the terms and conditions of this Agreement, there is no fee due to Licensor for Licensee's use of the Software in accordance with this Agreement.
+# DISCLAIMER OF WARRANTIES:  THE SOFTWARE IS PROVIDED "AS-IS" WITHOUT WARRANTY OF ANY KIND INCLUDING ANY WARRANTIES OF PERFORMANCE OR MERCHANTABILITY OR FITNESS FOR A PARTICULAR USE OR PURPOSE OR OF NON-INFRINGEMENT.  LICENSEE BEARS ALL RISK RELATING TO QUALITY AND PERFORMANCE OF THE SOFTWARE AND RELATED MATERIALS.
+# SUPPORT AND MAINTENANCE: No Software support or training by the Licensor is provided as part of this Agreement.  
+# EXCLUSIVE REMEDY AND LIMITATION OF LIABILITY: To the maximum extent permitted under applicable law, Licensor shall not be liable for direct, indirect, special, incidental, or consequential damages or lost profits related to Licensee's use of and/or inability to use the Software, even if Licensor is advised of the possibility of such damage.
+# EXPORT REGULATION: Licensee agrees to comply with any and all applicable export control laws, regulations, and/or other laws related to embargoes and sanction programs administered by law.
+# SEVERABILITY: If any provision(s) of this Agreement shall be held to be invalid, illegal, or unenforceable by a court or other tribunal of competent jurisdiction, the validity, legality and enforceability of the remaining provisions shall not in any way be affected or impaired thereby.
+# NO IMPLIED WAIVERS: No failure or delay by Licensor in enforcing any right or remedy under this Agreement shall be construed as a waiver of any future or other exercise of such right or remedy by Licensor.
+# GOVERNING LAW: This Agreement shall be construed and enforced in accordance with the laws of Germany without reference to conflict of laws principles.  You consent to the personal jurisdiction of the courts of this country and waive their rights to venue outside of Germany.
+# ENTIRE AGREEMENT AND AMENDMENTS: This Agreement constitutes the sole and entire agreement between Licensee and Licensor as to the matter set forth herein and supersedes any previous agreements, understandings, and arrangements between the parties relating hereto.
+###
+""" This module contains helpers to write and read the sharded note stores.
+
+Each step of the notes processing (e.g., cleaning and transforming to bags of
+words) writes one shard for each chunk of notes rather than one file for each
+note. A store consists of:
+
+    * the shards. Each shard is a parquet file with one row for each note in
+      the chunk and the same columns as the NOTEEVENTS table. Depending on the
+      step, `TEXT` is either the cleaned text or the list of token ids.
+
+    * an index (csv) with the `ROW_ID`, `SUBJECT_ID`, `HADM_ID`, `SHARD` and
+      `OFFSET` of each note. `OFFSET` is the row of the note in its shard.
+
+    * optionally, a vocabulary (parquet) for each shard. In this case, `TEXT`
+      is the list of ids of the tokens in the vocabulary of the shard.
+
+A store may also be partitioned by (a hash of) `HADM_ID`. Then, the notes of
+a batch of consecutive chunks are written together and split into one file
+for each partition, all notes of an admission are in the same partition, and
+the index also has a `PARTITION` column. `SHARD` is the first shard of the
+batch, and `OFFSET` is the row of the note in the file of its batch and
+partition. The notes of a partition can be read without touching the files of
+any other partition.
+"""
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import mimic_preprocessing.mp_filenames as mp_filenames
+
+NOTE_STORE_INDEX_COLUMNS = [
+    'ROW_ID',
+    'SUBJECT_ID',
+    'HADM_ID',
+    'SHARD',
+    'OFFSET'
+]
+
+NOTE_STORE_PARTITION_COLUMN = 'PARTITION'
+
+def get_note_partitions(hadm_ids, num_partitions) -> np.ndarray:
+    """ Get the partition of each admission
+
+    The partitions are based on a (deterministic) hash of the ids, so they do
+    not depend on the order or the chunks of the notes.
+    """
+    hadm_ids = np.asarray(hadm_ids, dtype=np.int64)
+    hashes = pd.util.hash_array(hadm_ids)
+    partitions = (hashes % np.uint64(num_partitions)).astype(np.int64)
+    return partitions
+
+def get_shard_groups(df_index):
+    """ Group the index entries by the file of the store which contains them,
+    that is, by shard and, if the store is partitioned, partition
+    """
+    keys = ['SHARD']
+    if NOTE_STORE_PARTITION_COLUMN in df_index.columns:
+        keys.append(NOTE_STORE_PARTITION_COLUMN)
+
+    return df_index.groupby(keys, sort=False)
+
+def get_batch_groups(df_index, num_shards):
+    """ Group the index entries into batches of (up to) `num_shards`
+    consecutive shards, in the order of the shards
+    """
+    shards = np.unique(df_index['SHARD'])
+    batches = np.searchsorted(shards, df_index['SHARD']) // num_shards
+    return df_index.groupby(batches, sort=True)
+
+def get_shard_key(df_shard):
+    """ Get the shard and partition (or None) of a group of index entries from
+    `get_shard_groups`
+    """
+    shard = int(df_shard['SHARD'].iloc[0])
+
+    partition = None
+    if NOTE_STORE_PARTITION_COLUMN in df_shard.columns:
+        partition = int(df_shard[NOTE_STORE_PARTITION_COLUMN].iloc[0])
+
+    return shard, partition
+
+###
+# Writing the store
+###
+def remove_note_store(note_store_path):
+    """ Remove all shards and the index of an existing store, if any
+    """
+    if os.path.exists(note_store_path):
+        shutil.rmtree(note_store_path)
+
+def write_note_shard(df_notes, note_store_path, shard, partition=None)\
+        -> pd.DataFrame:
+    """ Write the notes in `df_notes` to one shard (and partition) of the
+    store
+
+    Parameters
+    ----------
+    df_notes: pd.DataFrame
+        The notes. This must include at least the `ROW_ID`, `SUBJECT_ID` and
+        `HADM_ID` columns.
+
+    note_store_path: path-like (e.g., a string)
+        The path to the directory of the store
+
+    shard: int
+        The identifier of the shard
+
+    partition: int, or None
+        For partitioned stores, the partition of the notes
+
+    Returns
+    -------
+    df_index: pd.DataFrame
+        The index entries (see `NOTE_STORE_INDEX_COLUMNS`) for the notes
+    """
+    df_notes = df_notes.reset_index(drop=True)
+
+    f = mp_filenames.get_note_store_shard_filename(
+        note_store_path, shard, partition
+    )
+    os.makedirs(os.path.dirname(f), exist_ok=True)
+
+    table = pa.Table.from_pandas(df_notes, preserve_index=False)
+    pq.write_table(table, f)
+
+    df_index = df_notes[['ROW_ID', 'SUBJECT_ID', 'HADM_ID']].copy()
+    df_index['SHARD'] = shard
+    df_index['OFFSET'] = df_index.index
+
+    if partition is not None:
+        df_index[NOTE_STORE_PARTITION_COLUMN] = partition
+
+    return df_index
+
+def write_note_partitions(df_notes, note_store_path, shard, num_partitions)\
+        -> pd.DataFrame:
+    """ Split the notes in `df_notes` (e.g., of a batch of shards) by the
+    partition of their admission and write them to one shard of the
+    (partitioned) store
+
+    The order of the notes is kept within each partition, and each partition
+    of the shard is a single file.
+
+    Returns
+    -------
+    df_index: pd.DataFrame
+        The index entries (see `NOTE_STORE_INDEX_COLUMNS`), including the
+        `PARTITION`, for the notes
+    """
+    partitions = get_note_partitions(df_notes['HADM_ID'], num_partitions)
+
+    all_index_dfs = [
+        write_note_shard(df_partition, note_store_path, shard, partition)
+            for partition, df_partition in df_notes.groupby(partitions)
+    ]
+
+    if len(all_index_dfs) == 0:
+        columns = NOTE_STORE_INDEX_COLUMNS + [NOTE_STORE_PARTITION_COLUMN]
+        return pd.DataFrame(columns=columns)
+
+    df_index = pd.concat(all_index_dfs, ignore_index=True)
+    return df_index
+
+def write_note_vocabulary(vocabulary, note_store_path, shard):
+    """ Write the (chunk-local) vocabulary of one shard of the store
+
+    Parameters
+    ----------
+    vocabulary: np.array of strings
+        The tokens. The position of a token in `vocabulary` is its id in the
+        `TEXT` of the shard.
+
+    note_store_path: path-like (e.g., a string)
+        The path to the directory of the store
+
+    shard: int
+        The identifier of the shard
+    """
+    f = mp_filenames.get_note_store_vocabulary_filename(note_store_path, shard)
+    os.makedirs(os.path.dirname(f), exist_ok=True)
+
+    table = pa.table({'TOKEN': pa.array(list(vocabulary), type=pa.string())})
+    pq.write_table(table, f)
+
+def write_note_index(all_index_dfs, note_store_path) -> pd.DataFrame:
+    """ Combine the index entries of all shards and write the index
+
+    The index is sorted by shard, partition (if any) and offset, that is, in
+    the same order as the notes were written.
+    """
+    df_index = pd.concat(all_index_dfs)
+
+    columns = list(NOTE_STORE_INDEX_COLUMNS)
+    sort_columns = ['SHARD', 'OFFSET']
+    if NOTE_STORE_PARTITION_COLUMN in df_index.columns:
+        columns.append(NOTE_STORE_PARTITION_COLUMN)
+        sort_columns.insert(1, NOTE_STORE_PARTITION_COLUMN)
+
+    df_index = df_index.sort_values(sort_columns)
+    df_index = df_index.reset_index(drop=True)
+    df_index = df_index[columns]
+
+    f = mp_filenames.get_note_store_index_filename(note_store_path)
+    os.makedirs(os.path.dirname(f), exist_ok=True)
+    df_index.to_csv(f, index=False)
+
+    return df_index
+
+###
+# Reading the store
+###
+def load_note_index(note_store_path) -> pd.DataFrame:
+    """ Load the index of the store
+    """
+    f = mp_filenames.get_note_store_index_filename(note_store_path)
+    df_index = pd.read_csv(f)
+    return df_index
+
+def read_note_shard(note_store_path, shard, columns=None, partition=None)\
+        -> pd.DataFrame:
+    """ Read one shard (and partition) of the store
+
+    List columns (e.g., the token ids) are converted to python lists.
+
+    Parameters
+    ----------
+    note_store_path: path-like (e.g., a string)
+        The path to the directory of the store
+
+    shard: int
+        The identifier of the shard
+
+    columns: list of strings, or None
+        The columns to read. By default, all columns are read.
+
+    partition: int, or None
+        For partitioned stores, the partition to read
+
+    Returns
+    -------
+    df_notes: pd.DataFrame
+        The notes in the shard, in the order of their offsets
+    """
+    f = mp_filenames.get_note_store_shard_filename(
+        note_store_path, shard, partition
+    )
+    table = pq.read_table(f, columns=columns)
+
+    list_columns = [
+        field.name for field in table.schema if pa.types.is_list(field.type)
+    ]
+
+    df_notes = table.drop(list_columns).to_pandas()
+    for c in list_columns:
+        df_notes[c] = table.column(c).to_pylist()
+
+    df_notes = df_notes[table.column_names]
+    return df_notes
+
+def read_note_vocabulary(note_store_path, shard) -> np.ndarray:
+    """ Read the (chunk-local) vocabulary of one shard of the store
+
+    Returns
+    -------
+    vocabulary: np.array of strings (with dtype object)
+        The tokens, in the order of their ids
+    """
+    f = mp_filenames.get_note_store_vocabulary_filename(note_store_path, shard)
+    table = pq.read_table(f)
+    vocabulary = np.array(table.column('TOKEN').to_pylist(), dtype=object)
+    return vocabulary
+
+def read_notes(note_store_path, df_index, columns=None) -> pd.DataFrame:
+    """ Read the notes given by the entries of `df_index`
+
+    Each shard (and partition) is read only once, regardless of the number of
+    notes selected from it. For partitioned stores, only the files of the
+    partitions in `df_index` are read.
+
+    Parameters
+    ----------
+    note_store_path: path-like (e.g., a string)
+        The path to the directory of the store
+
+    df_index: pd.DataFrame
+        The (selected) index entries, including the `SHARD` and `OFFSET`
+        (and `PARTITION`) columns. The pandas index of `df_index` must be
+        unique.
+
+    columns: list of strings, or None
+        The columns to read. By default, all columns are read.
+
+    Returns
+    -------
+    df_notes: pd.DataFrame
+        The notes, in the same order and with the same pandas index as
+        `df_index`
+    """
+    all_notes = []
+    for _, df_shard in get_shard_groups(df_index):
+        shard, partition = get_shard_key(df_shard)
+        df_notes = read_note_shard(
+            note_store_path, shard, columns=columns, partition=partition
+        )
+        df_notes = df_notes.iloc[df_shard['OFFSET'].values]
+        df_notes.index = df_shard.index
+        all_notes.append(df_notes)
+
+    if len(all_notes) == 0:
+        return pd.DataFrame(columns=columns)
+
+    df_notes = pd.concat(all_notes)
+    df_notes = df_notes.loc[df_index.index]
+    return df_notes
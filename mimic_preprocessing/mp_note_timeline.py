@@ -0,0 +1,382 @@
+###
+# 
+# NAME OF THE PROGRAM THIS FILE BELONGS TO 
+#  
+# file: mimic-preprocessing
+#  
+# Authors: Brandon Malone (Brandon.malone@neclab.eu
+#               Jun Cheng (jun.cheng@neclab.eu)
+# 
+# NEC Laboratories Europe GmbH, Copyright (c) 2020, All rights reserved. 
+#     THIS HEADER MAY NOT BE EXTRACTED OR MODIFIED IN ANY WAY.
+#  
+#     PROPRIETARY INFORMATION --- 
+# 
+# SOFTWARE LICENSE AGREEMENT
+# ACADEMIC OR NON-PROFIT ORGANIZATION NONCOMMERCIAL RESEARCH USE ONLY
+# BY USING OR DOWNLOADING THE SOFTWARE, YOU ARE AGREEING TO THE TERMS OF THIS LICENSE AGREEMENT.  IF YOU DO NOT AGREE WITH THESE TERMS, YOU MAY NOT USE OR DOWNLOAD THE SOFTWARE.
+# 
+# This is a license agreement ("Agreement") between your academic institution or non-profit organization or self (called "Licensee" or "You" in this Agreement) and NEC Laboratories Europe GmbH (called "Licensor" in this Agreement).  All rights not specifically granted to you in this Agreement are reserved for Licensor. 
+# RESERVATION OF OWNERSHIP AND GRANT OF LICENSE: Licensor retains exclusive ownership of any copy of the Software (as defined below) licensed under this Agreement and hereby grants to Licensee a personal, non-exclusive, non-transferable license to use the Software for noncommercial research purposes, without the right to sublicense, pursuant to the terms and conditions of this Agreement. NO EXPRESS OR IMPLIED LICENSES TO ANY OF LICENSOR’S PATENT RIGHTS ARE GRANTED BY THIS LICENSE. As used in this Agreement, the term "Software" means (i) the actual copy of all or any portion of code for program routines made accessible to Licensee by Licensor pursuant to this Agreement, inclusive of backups, updates, and/or merged copies permitted hereunder or subsequently supplied by Licensor,  including all or any file structures, programming instructions, user interfaces and screen formats and sequences as well as any and all documentation and instructions related to it, and (ii) all or any derivatives and/or modifications created or made by You to any of the items specified in (i).
+# CONFIDENTIALITY/PUBLICATIONS: Licensee acknowledges that the Software is proprietary to Licensor, and as such, Licensee agrees to receive all such materials and to use the Software only in accordance with the terms of this Agreement.  Licensee agrees to use reasonable effort to protect the Software from unauthorized use, reproduction, distribution, or publication. All publication materials mentioning features or use of this software must explicitly include an acknowledgement the software was developed by NEC Laboratories Europe GmbH.
+# COPYRIGHT: The Software is owned by Licensor.  
+# PERMITTED USES:  The Software may be used for your own noncommercial internal research purposes. You understand and agree that Licensor is not obligated to implement any suggestions and/or feedback you might provide regarding the Software, but to the extent Licensor does so, you are not entitled to any compensation related thereto.
+# DERIVATIVES: You may create derivatives of or make modifications to the Software, however, You agree that all and any such derivatives and modifications will be owned by Licensor and become a part of the Software licensed to You under this Agreement.  You may only use such derivatives and modifications for your own noncommercial internal research purposes, and you may not otherwise use, distribute or copy such derivatives and modifications in violation of this Agreement.
+# BACKUPS:  If Licensee is an organization, it may make that number of copies of the Software necessary for internal noncommercial use at a single site within its organization provided that all information appearing in or on the original labels, including the copyright and trademark notices are copied onto the labels of the copies.
+# USES NOT PERMITTED:  You may not distribute, copy or use the Software except as explicitly permitted herein. Licensee has not been granted any trademark license as part of this Agreement. Neither the name of NEC Laboratories Europe GmbH nor the names of its contributors may be used to endorse or promote products derived from this Software without specific prior written permission.
+# You may not sell, rent, lease, sublicense, lend, time-share or transfer, in whole or in part, or provide third parties access to prior or present versions (or any parts thereof) of the Software.
+# ASSIGNMENT: You may not assign this Agreement or your rights hereunder without the prior written consent of Licensor. Any attempted assignment without such consent shall be null and void.
+# TERM: The term of the license granted by this Agreement is from Licensee's acceptance of this Agreement by downloading the Software or by using the Software until terminated as provided below.
+# The Agreement automatically terminates without notice if you fail to comply with any provision of this Agreement.  Licensee may terminate this Agreement by ceasing using the Software.  Upon any termination of this Agreement, Licensee will delete any and all copies of the Software. You agree that all provisions which operate to protect the proprietary rights of Licensor shall remain in force should breach occur and that the obligation of confidentiality described in this Agreement is binding in perpetuity and, as such, survives the term of the Agreement.
+# FEE: Provided Licensee abides completely by the terms and conditions of this Agreement, there is no fee due to Licensor for Licensee's use of the Software in accordance with this Agreement.
+# DISCLAIMER OF WARRANTIES:  THE SOFTWARE IS PROVIDED "AS-IS" WITHOUT WARRANTY OF ANY KIND INCLUDING ANY WARRANTIES OF PERFORMANCE OR MERCHANTABILITY OR FITNESS FOR A PARTICULAR USE OR PURPOSE OR OF NON-INFRINGEMENT.  LICENSEE BEARS ALL RISK RELATING TO QUALITY AND PERFORMANCE OF THE SOFTWARE AND RELATED MATERIALS.
+# SUPPORT AND MAINTENANCE: No Software support or training by the Licensor is provided as part of this Agreement.  
+# EXCLUSIVE REMEDY AND LIMITATION OF LIABILITY: To the maximum extent permitted under applicable law, Licensor shall not be liable for direct, indirect, special, incidental, or consequential damages or lost profits related to Licensee's use of and/or inability to use the Software, even if Licensor is advised of the possibility of such damage.
+# EXPORT REGULATION: Licensee agrees to comply with any and all applicable export control laws, regulations, and/or other laws related to embargoes and sanction programs administered by law.
+# SEVERABILITY: If any provision(s) of this Agreement shall be held to be invalid, illegal, or unenforceable by a court or other tribunal of competent jurisdiction, the validity, legality and enforceability of the remaining provisions shall not in any way be affected or impaired thereby.
+# NO IMPLIED WAIVERS: No failure or delay by Licensor in enforcing any right or remedy under this Agreement shall be construed as a waiver of any future or other exercise of such right or remedy by Licensor.
+# GOVERNING LAW: This Agreement shall be construed and enforced in accordance with the laws of Germany without reference to conflict of laws principles.  You consent to the personal jurisdiction of the courts of this country and waive their rights to venue outside of Germany.
+# ENTIRE AGREEMENT AND AMENDMENTS: This Agreement constitutes the sole and entire agreement between Licensee and Licensor as to the matter set forth herein and supersedes any previous agreements, understandings, and arrangements between the parties relating hereto.
+###
+""" This module contains helpers to write and query the time-indexed note
+timelines.
+
+A timeline holds the bags of words of all notes of a set of admissions in a
+few flat arrays, so that the notes of any time window (e.g., the horizon or
+6h buckets after admission) can be selected by binary search rather than by
+reprocessing the notes. A timeline store consists of:
+
+    * the parts. Each part is an `.npz` file with the notes of a chunk of
+      admissions:
+
+        * `HADM_ID`, `SUBJECT_ID`: the admissions, sorted by `HADM_ID`
+        * `ADMISSION_OFFSETS`: the notes of admission `i` are
+          `ADMISSION_OFFSETS[i]:ADMISSION_OFFSETS[i+1]`
+        * `CHARTTIME`: the chart time of each note, as int64 nanoseconds since
+          the epoch. The notes are sorted by chart time within each admission.
+        * `ROW_ID`, `NOTE_TYPE`: the row and the (integer) note type of each
+          note
+        * `NOTE_ORDER`: the position of each note in the notes of the part as
+          they were written (e.g., their order in NOTEEVENTS)
+        * `TOKEN_OFFSETS`: the token ids of note `j` are
+          `TOKEN_IDS[TOKEN_OFFSETS[j]:TOKEN_OFFSETS[j+1]]`
+        * `TOKEN_IDS`: the token ids of all notes
+
+    * an index (csv) with the `HADM_ID`, `SUBJECT_ID` and `PART` of each
+      admission.
+
+Notes without a chart time are not included, since they are never within a
+time window.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+import mimic_preprocessing.mp_filenames as mp_filenames
+
+NOTE_TIMELINE_INDEX_COLUMNS = [
+    'HADM_ID',
+    'SUBJECT_ID',
+    'PART'
+]
+
+NOTE_TIMELINE_ARRAYS = [
+    'HADM_ID',
+    'SUBJECT_ID',
+    'ADMISSION_OFFSETS',
+    'CHARTTIME',
+    'ROW_ID',
+    'NOTE_TYPE',
+    'NOTE_ORDER',
+    'TOKEN_OFFSETS',
+    'TOKEN_IDS'
+]
+
+MIN_TIME = np.iinfo(np.int64).min
+
+###
+# Helpers
+###
+def get_time_values(times) -> np.ndarray:
+    """ Convert datetimes (or anything `pd.to_datetime` understands) to int64
+    nanoseconds since the epoch, as used in the timelines
+    """
+    times = pd.to_datetime(pd.Series(times).reset_index(drop=True))
+    return times.values.astype('datetime64[ns]').astype(np.int64)
+
+def get_offsets(lengths) -> np.ndarray:
+    """ Get the offsets (with a leading 0) from the lengths of consecutive
+    segments
+    """
+    offsets = np.zeros(len(lengths)+1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+def get_segment_indices(starts, ends) -> np.ndarray:
+    """ Concatenate `np.arange(s, e)` for all segments without a python loop
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    lengths = np.asarray(ends, dtype=np.int64) - starts
+
+    offsets = get_offsets(lengths)
+    indices = np.arange(offsets[-1], dtype=np.int64)
+    indices += np.repeat(starts - offsets[:-1], lengths)
+    return indices
+
+###
+# Writing the timelines
+###
+def write_note_timeline_part(df_notes, note_types, note_timeline_path, part)\
+        -> pd.DataFrame:
+    """ Write the bags of words of the notes in `df_notes` to one part of the
+    timeline store
+
+    Parameters
+    ----------
+    df_notes: pd.DataFrame
+        The notes. This must include the `ROW_ID`, `SUBJECT_ID`, `HADM_ID`,
+        `CHARTTIME` and `NOTE_TYPE` columns, and `TEXT` must be the list of
+        token ids. The order of the notes is kept as `NOTE_ORDER`.
+
+    note_types: list of strings
+        The note types. `NOTE_TYPE` must be the index of the type in this list.
+
+    note_timeline_path: path-like (e.g., a string)
+        The path to the directory of the store
+
+    part: int
+        The identifier of the part
+
+    Returns
+    -------
+    df_index: pd.DataFrame
+        The index entries (see `NOTE_TIMELINE_INDEX_COLUMNS`) for the
+        admissions
+    """
+    df_notes = df_notes.reset_index(drop=True)
+    chart_times = pd.to_datetime(df_notes['CHARTTIME'])
+
+    # admissions without any note with a chart time are still indexed
+    df_admissions = df_notes[['HADM_ID', 'SUBJECT_ID']].drop_duplicates('HADM_ID')
+    df_admissions = df_admissions.sort_values('HADM_ID')
+    df_admissions = df_admissions.astype(np.int64)
+
+    df_notes = df_notes[chart_times.notnull().values]
+    hadm_ids = df_notes['HADM_ID'].values.astype(np.int64)
+    times = get_time_values(df_notes['CHARTTIME'])
+
+    order = np.lexsort((times, hadm_ids))
+    df_notes = df_notes.iloc[order]
+
+    positions = np.searchsorted(df_admissions['HADM_ID'].values, hadm_ids[order])
+    admission_lengths = np.bincount(positions, minlength=len(df_admissions))
+
+    bags = [np.asarray(b, dtype=np.int64) for b in df_notes['TEXT']]
+    token_lengths = np.array([len(b) for b in bags], dtype=np.int64)
+
+    if len(bags) > 0:
+        token_ids = np.concatenate(bags)
+    else:
+        token_ids = np.zeros(0, dtype=np.int64)
+
+    arrays = {
+        'HADM_ID': df_admissions['HADM_ID'].values,
+        'SUBJECT_ID': df_admissions['SUBJECT_ID'].values,
+        'ADMISSION_OFFSETS': get_offsets(admission_lengths),
+        'CHARTTIME': times[order],
+        'ROW_ID': df_notes['ROW_ID'].values.astype(np.int64),
+        'NOTE_TYPE': df_notes['NOTE_TYPE'].values.astype(np.int8),
+        'NOTE_ORDER': df_notes.index.values.astype(np.int64),
+        'TOKEN_OFFSETS': get_offsets(token_lengths),
+        'TOKEN_IDS': token_ids,
+        'NOTE_TYPES': np.array(note_types)
+    }
+
+    f = mp_filenames.get_note_timeline_part_filename(note_timeline_path, part)
+    os.makedirs(os.path.dirname(f), exist_ok=True)
+    np.savez(f, **arrays)
+
+    df_index = df_admissions.copy()
+    df_index['PART'] = part
+    df_index = df_index[NOTE_TIMELINE_INDEX_COLUMNS]
+    return df_index
+
+def write_note_timeline_index(all_index_dfs, note_timeline_path) -> pd.DataFrame:
+    """ Combine the index entries of all parts and write the index
+    """
+    df_index = pd.concat(all_index_dfs)
+    df_index = df_index.sort_values(['PART', 'HADM_ID'])
+    df_index = df_index.reset_index(drop=True)
+    df_index = df_index[NOTE_TIMELINE_INDEX_COLUMNS]
+
+    f = mp_filenames.get_note_store_index_filename(note_timeline_path)
+    os.makedirs(os.path.dirname(f), exist_ok=True)
+    df_index.to_csv(f, index=False)
+
+    return df_index
+
+###
+# Reading the timelines
+###
+def load_note_timeline_index(note_timeline_path) -> pd.DataFrame:
+    """ Load the index of the timeline store
+    """
+    f = mp_filenames.get_note_store_index_filename(note_timeline_path)
+    df_index = pd.read_csv(f)
+    return df_index
+
+class NoteTimeline(object):
+    """ The notes of one part of a timeline store
+
+    Parameters
+    ----------
+    arrays: dict-like of np.arrays
+        The `NOTE_TIMELINE_ARRAYS` and `NOTE_TYPES`, e.g., from
+        `read_note_timeline_part`
+    """
+    def __init__(self, arrays):
+        for a in NOTE_TIMELINE_ARRAYS:
+            setattr(self, a.lower(), arrays[a])
+
+        self.note_types = arrays['NOTE_TYPES'].tolist()
+
+    def get_admission_positions(self, hadm_ids):
+        """ Get the position of each admission in `hadm_id`, and whether it is
+        in the timeline at all
+        """
+        hadm_ids = np.asarray(hadm_ids, dtype=np.int64)
+        if len(self.hadm_id) == 0:
+            positions = np.zeros(len(hadm_ids), dtype=np.int64)
+            return positions, np.zeros(len(hadm_ids), dtype=bool)
+
+        positions = np.searchsorted(self.hadm_id, hadm_ids)
+        positions = np.minimum(positions, len(self.hadm_id) - 1)
+
+        m_found = self.hadm_id[positions] == hadm_ids
+        return positions, m_found
+
+    def get_admission_slices(self, hadm_ids):
+        """ Get the (start, end) offsets of the notes of each admission
+
+        Admissions which are not in the timeline have no notes.
+        """
+        positions, m_found = self.get_admission_positions(hadm_ids)
+        if len(self.hadm_id) == 0:
+            return positions, positions
+
+        starts = np.where(m_found, self.admission_offsets[positions], 0)
+        ends = np.where(m_found, self.admission_offsets[positions+1], 0)
+        return starts, ends
+
+    def get_window_slices(self, hadm_ids, start_times, end_times):
+        """ Get the (start, end) offsets of the notes of each admission with
+        `start_time <= CHARTTIME < end_time`
+
+        The times are int64 nanoseconds since the epoch (see
+        `get_time_values`). Use `MIN_TIME` for windows without a start.
+        """
+        positions, m_found = self.get_admission_positions(hadm_ids)
+        if len(self.hadm_id) == 0:
+            return positions, positions
+
+        # the chart times are only sorted within each admission, but the
+        # (admission, rank of the chart time) keys of all notes are sorted
+        times = np.unique(self.charttime)
+        num_ranks = len(times) + 1
+
+        admission_lengths = np.diff(self.admission_offsets)
+        note_keys = np.repeat(
+            np.arange(len(self.hadm_id), dtype=np.int64), admission_lengths
+        )
+        note_keys = note_keys * num_ranks + np.searchsorted(times, self.charttime)
+
+        # the notes before a window have a lower rank than its boundary
+        boundaries = np.concatenate([start_times, end_times]).astype(np.int64)
+        boundary_keys = (
+            np.tile(positions, 2) * num_ranks +
+            np.searchsorted(times, boundaries, side='left')
+        )
+        slices = np.searchsorted(note_keys, boundary_keys, side='left')
+        slices = np.where(np.tile(m_found, 2), slices, 0)
+
+        starts, ends = np.split(slices, 2)
+        return starts, ends
+
+    def get_window_groups(self, hadm_ids, start_times, end_times):
+        """ Concatenate the token ids of the notes in each window, separately
+        for each note type
+
+        The notes are selected by their chart time, but concatenated in their
+        original order (`NOTE_ORDER`), as in the combined notes of each
+        admission.
+
+        Returns
+        -------
+        token_ids: np.array of ints
+            The token ids of all windows, grouped by note type and then window
+
+        group_sizes: np.array of ints
+            The number of token ids for note type `t` and window `i` is
+            `group_sizes[t*num_windows + i]`
+        """
+        num_windows = len(hadm_ids)
+        num_groups = len(self.note_types) * num_windows
+
+        starts, ends = self.get_window_slices(hadm_ids, start_times, end_times)
+        notes = get_segment_indices(starts, ends)
+        windows = np.repeat(np.arange(num_windows, dtype=np.int64), ends - starts)
+
+        keys = self.note_type[notes].astype(np.int64) * num_windows + windows
+
+        # keep the original order of the notes within each group
+        order = np.lexsort((self.note_order[notes], keys))
+        notes = notes[order]
+
+        token_starts = self.token_offsets[notes]
+        token_ends = self.token_offsets[notes+1]
+        token_ids = self.token_ids[get_segment_indices(token_starts, token_ends)]
+
+        group_sizes = np.bincount(
+            keys[order], weights=token_ends-token_starts, minlength=num_groups
+        ).astype(np.int64)
+
+        return token_ids, group_sizes
+
+    def get_horizon_groups(self, hadm_ids, admit_times, horizon):
+        """ Concatenate the token ids of the notes of each admission which are
+        within `horizon` (a `pd.Timedelta`) after the admit time
+
+        See `get_window_groups` for the return values.
+        """
+        end_times = get_time_values(admit_times) + horizon.value
+        start_times = np.full(len(end_times), MIN_TIME, dtype=np.int64)
+        return self.get_window_groups(hadm_ids, start_times, end_times)
+
+    def get_time_bucket_groups(self, hadm_ids, admit_times, bucket_size,
+            num_buckets):
+        """ Concatenate the token ids of the notes of each admission in each of
+        `num_buckets` consecutive buckets of `bucket_size` (a `pd.Timedelta`)
+        after the admit time
+
+        The windows are ordered by admission and then bucket, so the number of
+        token ids for note type `t`, admission `i` and bucket `b` is
+        `group_sizes[t*num_windows + i*num_buckets + b]` (see
+        `get_window_groups`).
+        """
+        admit_times = get_time_values(admit_times)
+        bucket_starts = np.arange(num_buckets, dtype=np.int64) * bucket_size.value
+
+        start_times = (admit_times[:, np.newaxis] + bucket_starts).ravel()
+        end_times = start_times + bucket_size.value
+        hadm_ids = np.repeat(np.asarray(hadm_ids, dtype=np.int64), num_buckets)
+
+        return self.get_window_groups(hadm_ids, start_times, end_times)
+
+def read_note_timeline_part(note_timeline_path, part) -> NoteTimeline:
+    """ Read one part of the timeline store
+    """
+    f = mp_filenames.get_note_timeline_part_filename(note_timeline_path, part)
+    with np.load(f) as arrays:
+        timeline = NoteTimeline(arrays)
+    return timeline
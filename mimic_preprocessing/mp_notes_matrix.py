@@ -0,0 +1,232 @@
+###
+# 
+# NAME OF THE PROGRAM THIS FILE BELONGS TO 
+#  
+# file: mimic-preprocessing
+#  
+# Authors: Brandon Malone (Brandon.malone@neclab.eu
+#               Jun Cheng (jun.cheng@neclab.eu)
+# 
+# NEC Laboratories Europe GmbH, Copyright (c) 2020, All rights reserved. 
+#     THIS HEADER MAY NOT BE EXTRACTED OR MODIFIED IN ANY WAY.
+#  
+#     PROPRIETARY INFORMATION --- 
+# 
+# SOFTWARE LICENSE AGREEMENT
+# ACADEMIC OR NON-PROFIT ORGANIZATION NONCOMMERCIAL RESEARCH USE ONLY
+# BY USING OR DOWNLOADING THE SOFTWARE, YOU ARE AGREEING TO THE TERMS OF THIS LICENSE AGREEMENT.  IF YOU DO NOT AGREE WITH THESE TERMS, YOU MAY NOT USE OR DOWNLOAD THE SOFTWARE.
+# 
+# This is a license agreement ("Agreement") between your academic institution or non-profit organization or self (called "Licensee" or "You" in this Agreement) and NEC Laboratories Europe GmbH (called "Licensor" in this Agreement).  All rights not specifically granted to you in this Agreement are reserved for Licensor. 
+# RESERVATION OF OWNERSHIP AND GRANT OF LICENSE: Licensor retains exclusive ownership of any copy of the Software (as defined below) licensed under this Agreement and hereby grants to Licensee a personal, non-exclusive, non-transferable license to use the Software for noncommercial research purposes, without the right to sublicense, pursuant to the terms and conditions of this Agreement. NO EXPRESS OR IMPLIED LICENSES TO ANY OF LICENSOR’S PATENT RIGHTS ARE GRANTED BY THIS LICENSE. As used in this Agreement, the term "Software" means (i) the actual copy of all or any portion of code for program routines made accessible to Licensee by Licensor pursuant to this Agreement, inclusive of backups, updates, and/or merged copies permitted hereunder or subsequently supplied by Licensor,  including all or any file structures, programming instructions, user interfaces and screen formats and sequences as well as any and all documentation and instructions related to it, and (ii) all or any derivatives and/or modifications created or made by You to any of the items specified in (i).
+# CONFIDENTIALITY/PUBLICATIONS: Licensee acknowledges that the Software is proprietary to Licensor, and as such, Licensee agrees to receive all such materials and to use the Software only in accordance with the terms of this Agreement.  Licensee agrees to use reasonable effort to protect the Software from unauthorized use, reproduction, distribution, or publication. All publication materials mentioning features or use of this software must explicitly include an acknowledgement the software was developed by NEC Laboratories Europe GmbH.
+# COPYRIGHT: The Software is owned by Licensor.  
+# PERMITTED USES:  The Software may be used for your own noncommercial internal research purposes. You understand and agree that Licensor is not obligated to implement any suggestions and/or feedback you might provide regarding the Software, but to the extent Licensor does so, you are not entitled to any compensation related thereto.
+# DERIVATIVES: You may create derivatives of or make modifications to the Software, however, You agree that all and any such derivatives and modifications will be owned by Licensor and become a part of the Software licensed to You under this Agreement.  You may only use such derivatives and modifications for your own noncommercial internal research purposes, and you may not otherwise use, distribute or copy such derivatives and modifications in violation of this Agreement.
+# BACKUPS:  If Licensee is an organization, it may make that number of copies of the Software necessary for internal noncommercial use at a single site within its organization provided that all information appearing in or on the original labels, including the copyright and trademark notices are copied onto the labels of the copies.
+# USES NOT PERMITTED:  You may not distribute, copy or use the Software except as explicitly permitted herein. Licensee has not been granted any trademark license as part of this Agreement. Neither the name of NEC Laboratories Europe GmbH nor the names of its contributors may be used to endorse or promote products derived from this Software without specific prior written permission.
+# You may not sell, rent, lease, sublicense, lend, time-share or transfer, in whole or in part, or provide third parties access to prior or present versions (or any parts thereof) of the Software.
+# ASSIGNMENT: You may not assign this Agreement or your rights hereunder without the prior written consent of Licensor. Any attempted assignment without such consent shall be null and void.
+# TERM: The term of the license granted by this Agreement is from Licensee's acceptance of this Agreement by downloading the Software or by using the Software until terminated as provided below.
+# The Agreement automatically terminates without notice if you fail to comply with any provision of this Agreement.  Licensee may terminate this Agreement by ceasing using the Software.  Upon any termination of this Agreement, Licensee will delete any and all copies of the Software. You agree that all provisions which operate to protect the proprietary rights of Licensor shall remain in force should breach occur and that the obligation of confidentiality described in this Agreement is binding in perpetuity and, as such, survives the term of the Agreement.
+# FEE: Provided Licensee abides completely by the terms and conditions of this Agreement, there is no fee due to Licensor for Licensee's use of the Software in accordance with this Agreement.
+# DISCLAIMER OF WARRANTIES:  THE SOFTWARE IS PROVIDED "AS-IS" WITHOUT WARRANTY OF ANY KIND INCLUDING ANY WARRANTIES OF PERFORMANCE OR MERCHANTABILITY OR FITNESS FOR A PARTICULAR USE OR PURPOSE OR OF NON-INFRINGEMENT.  LICENSEE BEARS ALL RISK RELATING TO QUALITY AND PERFORMANCE OF THE SOFTWARE AND RELATED MATERIALS.
+# SUPPORT AND MAINTENANCE: No Software support or training by the Licensor is provided as part of this Agreement.  
+# EXCLUSIVE REMEDY AND LIMITATION OF LIABILITY: To the maximum extent permitted under applicable law, Licensor shall not be liable for direct, indirect, special, incidental, or consequential damages or lost profits related to Licensee's use of and/or inability to use the Software, even if Licensor is advised of the possibility of such damage.
+# EXPORT REGULATION: Licensee agrees to comply with any and all applicable export control laws, regulations, and/or other laws related to embargoes and sanction programs administered by law.
+# SEVERABILITY: If any provision(s) of this Agreement shall be held to be invalid, illegal, or unenforceable by a court or other tribunal of competent jurisdiction, the validity, legality and enforceability of the remaining provisions shall not in any way be affected or impaired thereby.
+# NO IMPLIED WAIVERS: No failure or delay by Licensor in enforcing any right or remedy under this Agreement shall be construed as a waiver of any future or other exercise of such right or remedy by Licensor.
+# GOVERNING LAW: This Agreement shall be construed and enforced in accordance with the laws of Germany without reference to conflict of laws principles.  You consent to the personal jurisdiction of the courts of this country and waive their rights to venue outside of Germany.
+# ENTIRE AGREEMENT AND AMENDMENTS: This Agreement constitutes the sole and entire agreement between Licensee and Licensor as to the matter set forth herein and supersedes any previous agreements, understandings, and arrangements between the parties relating hereto.
+###
+""" This module contains helpers to write and read the sparse version of the
+bags of words of the complete dataset.
+
+The bags of words are written as:
+
+    * one `scipy.sparse.csr_matrix` (`.npz`) for each note type, with one row
+      for each episode and one column for each token (or hash bucket). The
+      entries are the number of occurrences of the token in the notes of the
+      type within the horizon.
+
+    * the episodes (csv), with all columns of the complete dataset other than
+      the note types. Row `i` of the episodes is row `i` of each matrix.
+
+    * the metadata (json), with the note types, the number of columns of the
+      matrices and the vectorizer.
+
+Compared to the lists of token ids in the complete dataset, this needs much
+less memory, and the matrices can be used for training directly.
+"""
+import json
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+import mimic_preprocessing.mp_filenames as mp_filenames
+
+VALID_FORMATS = [
+    'jpkl',
+    'npz'
+]
+
+DEFAULT_FORMAT = 'jpkl'
+
+def get_notes_bow_format(config):
+    """ Get the format of the complete dataset from the configuration
+
+    The format is given by the (optional) `notes_bow_format` key. It is either
+    "jpkl" (the default; a data frame with lists of token ids) or "npz"
+    (sparse matrices).
+    """
+    notes_bow_format = config.get('notes_bow_format', DEFAULT_FORMAT)
+
+    if notes_bow_format not in VALID_FORMATS:
+        msg = ("[mp_notes_matrix.get_notes_bow_format] invalid format: {}. "
+            "valid formats are: {}".format(notes_bow_format, VALID_FORMATS))
+        raise ValueError(msg)
+
+    return notes_bow_format
+
+###
+# Creating the matrices
+###
+def get_bow_matrix(bags, num_features) -> scipy.sparse.csr_matrix:
+    """ Convert lists of token ids to a sparse matrix of counts
+
+    Parameters
+    ----------
+    bags: list of lists of ints
+        The token ids for each row
+
+    num_features: int
+        The number of columns of the matrix
+
+    Returns
+    -------
+    bow_matrix: scipy.sparse.csr_matrix
+        The matrix with shape (len(bags), num_features). Entry (i, j) is the
+        number of times token `j` occurs in `bags[i]`.
+    """
+    lengths = np.array([len(bag) for bag in bags], dtype=np.int64)
+
+    indptr = np.zeros(len(bags) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=indptr[1:])
+
+    indices = np.zeros(0, dtype=np.int32)
+    if len(bags) > 0:
+        indices = np.concatenate([
+            np.asarray(bag, dtype=np.int32) for bag in bags
+        ] + [indices])
+
+    data = np.ones(len(indices), dtype=np.int32)
+
+    bow_matrix = scipy.sparse.csr_matrix(
+        (data, indices, indptr), shape=(len(bags), num_features)
+    )
+    bow_matrix.sum_duplicates()
+    return bow_matrix
+
+def get_bow_matrices(df_records, note_types, num_features):
+    """ Split the records into the episodes and one matrix for each note type
+
+    Returns
+    -------
+    df_episodes: pd.DataFrame
+        All columns of `df_records` other than the note types
+
+    bow_matrices: dict of string -> scipy.sparse.csr_matrix
+        The matrix for each note type
+    """
+    df_episodes = df_records.drop(columns=note_types)
+
+    bow_matrices = {
+        nt: get_bow_matrix(df_records[nt].tolist(), num_features)
+            for nt in note_types
+    }
+
+    return df_episodes, bow_matrices
+
+###
+# Writing and reading the matrices
+###
+def write_bow_matrices(df_episodes, bow_matrices, complete_episodes,
+        metadata=None):
+    """ Write the matrices, the episodes and the metadata
+
+    Parameters
+    ----------
+    df_episodes: pd.DataFrame
+        The episode of each row of the matrices
+
+    bow_matrices: dict of string -> scipy.sparse.csr_matrix
+        The matrix for each note type
+
+    complete_episodes: path-like (e.g., a string)
+        The path to the complete dataset. The names of the files are derived
+        from this path.
+
+    metadata: dict, or None
+        Additional (json-serializable) metadata, e.g., about the vectorizer
+    """
+    note_types = list(bow_matrices.keys())
+
+    for nt, bow_matrix in bow_matrices.items():
+        f = mp_filenames.get_notes_bow_matrix_filename(complete_episodes, nt)
+        scipy.sparse.save_npz(f, bow_matrix)
+
+    f = mp_filenames.get_notes_bow_matrix_filename(
+        complete_episodes, "episodes"
+    )
+    df_episodes.to_csv(f, index=False)
+
+    num_features = 0
+    if len(note_types) > 0:
+        num_features = int(bow_matrices[note_types[0]].shape[1])
+
+    all_metadata = {
+        'note_types': note_types,
+        'num_episodes': len(df_episodes),
+        'num_features': num_features
+    }
+
+    if metadata is not None:
+        all_metadata.update(metadata)
+
+    f = mp_filenames.get_notes_bow_matrix_filename(
+        complete_episodes, "metadata"
+    )
+    with open(f, 'w') as out:
+        json.dump(all_metadata, out, indent=4)
+
+def read_bow_matrices(complete_episodes):
+    """ Read the matrices, the episodes and the metadata
+
+    Returns
+    -------
+    df_episodes: pd.DataFrame
+        The episode of each row of the matrices
+
+    bow_matrices: dict of string -> scipy.sparse.csr_matrix
+        The matrix for each note type
+
+    metadata: dict
+        The metadata, including the `note_types` and `num_features`
+    """
+    f = mp_filenames.get_notes_bow_matrix_filename(
+        complete_episodes, "metadata"
+    )
+    with open(f) as metadata_file:
+        metadata = json.load(metadata_file)
+
+    f = mp_filenames.get_notes_bow_matrix_filename(
+        complete_episodes, "episodes"
+    )
+    df_episodes = pd.read_csv(f)
+
+    bow_matrices = dict()
+    for nt in metadata['note_types']:
+        f = mp_filenames.get_notes_bow_matrix_filename(complete_episodes, nt)
+        bow_matrices[nt] = scipy.sparse.load_npz(f)
+
+    return df_episodes, bow_matrices, metadata
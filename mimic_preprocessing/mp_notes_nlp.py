@@ -0,0 +1,528 @@
+###
+# 
+# NAME OF THE PROGRAM THIS FILE BELONGS TO 
+#  
+# file: mimic-preprocessing
+#  
+# Authors: Brandon Malone (Brandon.malone@neclab.eu
+#               Jun Cheng (jun.cheng@neclab.eu)
+# 
+# NEC Laboratories Europe GmbH, Copyright (c) 2020, All rights reserved. 
+#     THIS HEADER MAY NOT BE EXTRACTED OR MODIFIED IN ANY WAY.
+#  
+#     PROPRIETARY INFORMATION --- 
+# 
+# SOFTWARE LICENSE AGREEMENT
+# ACADEMIC OR NON-PROFIT ORGANIZATION NONCOMMERCIAL RESEARCH USE ONLY
+# BY USING OR DOWNLOADING THE SOFTWARE, YOU ARE AGREEING TO THE TERMS OF THIS LICENSE AGREEMENT.  IF YOU DO NOT AGREE WITH THESE TERMS, YOU MAY NOT USE OR DOWNLOAD THE SOFTWARE.
+# 
+# This is a license agreement ("Agreement") between your academic institution or non-profit organization or self (called "Licensee" or "You" in this Agreement) and NEC Laboratories Europe GmbH (called "Licensor" in this Agreement).  All rights not specifically granted to you in this Agreement are reserved for Licensor. 
+# RESERVATION OF OWNERSHIP AND GRANT OF LICENSE: Licensor retains exclusive ownership of any copy of the Software (as defined below) licensed under this Agreement and hereby grants to Licensee a personal, non-exclusive, non-transferable license to use the Software for noncommercial research purposes, without the right to sublicense, pursuant to the terms and conditions of this Agreement. NO EXPRESS OR IMPLIED LICENSES TO ANY OF LICENSOR’S PATENT RIGHTS ARE GRANTED BY THIS LICENSE. As used in this Agreement, the term "Software" means (i) the actual copy of all or any portion of code for program routines made accessible to Licensee by Licensor pursuant to this Agreement, inclusive of backups, updates, and/or merged copies permitted hereunder or subsequently supplied by Licensor,  including all or any file structures, programming instructions, user interfaces and screen formats and sequences as well as any and all documentation and instructions related to it, and (ii) all or any derivatives and/or modifications created or made by You to any of the items specified in (i).
+# CONFIDENTIALITY/PUBLICATIONS: Licensee acknowledges that the Software is proprietary to Licensor, and as such, Licensee agrees to receive all such materials and to use the Software only in accordance with the terms of this Agreement.  Licensee agrees to use reasonable effort to protect the Software from unauthorized use, reproduction, distribution, or publication. All publication materials mentioning features or use of this software must explicitly include an acknowledgement the software was developed by NEC Laboratories Europe GmbH.
+# COPYRIGHT: The Software is owned by Licensor.  
+# PERMITTED USES:  The Software may be used for your own noncommercial internal research purposes. You understand and agree that Licensor is not obligated to implement any suggestions and/or feedback you might provide regarding the Software, but to the extent Licensor does so, you are not entitled to any compensation related thereto.
+# DERIVATIVES: You may create derivatives of or make modifications to the Software, however, You agree that all and any such derivatives and modifications will be owned by Licensor and become a part of the Software licensed to You under this Agreement.  You may only use such derivatives and modifications for your own noncommercial internal research purposes, and you may not otherwise use, distribute or copy such derivatives and modifications in violation of this Agreement.
+# BACKUPS:  If Licensee is an organization, it may make that number of copies of the Software necessary for internal noncommercial use at a single site within its organization provided that all information appearing in or on the original labels, including the copyright and trademark notices are copied onto the labels of the copies.
+# USES NOT PERMITTED:  You may not distribute, copy or use the Software except as explicitly permitted herein. Licensee has not been granted any trademark license as part of this Agreement. Neither the name of NEC Laboratories Europe GmbH nor the names of its contributors may be used to endorse or promote products derived from this Software without specific prior written permission.
+# You may not sell, rent, lease, sublicense, lend, time-share or transfer, in whole or in part, or provide third parties access to prior or present versions (or any parts thereof) of the Software.
+# ASSIGNMENT: You may not assign this Agreement or your rights hereunder without the prior written consent of Licensor. Any attempted assignment without such consent shall be null and void.
+# TERM: The term of the license granted by this Agreement is from Licensee's acceptance of this Agreement by downloading the Software or by using the Software until terminated as provided below.
+# The Agreement automatically terminates without notice if you fail to comply with any provision of this Agreement.  Licensee may terminate this Agreement by ceasing using the Software.  Upon any termination of this Agreement, Licensee will delete any and all copies of the Software. You agree that all provisions which operate to protect the proprietary rights of Licensor shall remain in force should breach occur and that the obligation of confidentiality described in this Agreement is binding in perpetuity and, as such, survives the term of the Agreement.
+# FEE: Provided Licensee abides completely by the terms and conditions of this Agreement, there is no fee due to Licensor for Licensee's use of the Software in accordance with this Agreement.
+# DISCLAIMER OF WARRANTIES:  THE SOFTWARE IS PROVIDED "AS-IS" WITHOUT WARRANTY OF ANY KIND INCLUDING ANY WARRANTIES OF PERFORMANCE OR MERCHANTABILITY OR FITNESS FOR A PARTICULAR USE OR PURPOSE OR OF NON-INFRINGEMENT.  LICENSEE BEARS ALL RISK RELATING TO QUALITY AND PERFORMANCE OF THE SOFTWARE AND RELATED MATERIALS.
+# SUPPORT AND MAINTENANCE: No Software support or training by the Licensor is provided as part of this Agreement.  
+# EXCLUSIVE REMEDY AND LIMITATION OF LIABILITY: To the maximum extent permitted under applicable law, Licensor shall not be liable for direct, indirect, special, incidental, or consequential damages or lost profits related to Licensee's use of and/or inability to use the Software, even if Licensor is advised of the possibility of such damage.
+# EXPORT REGULATION: Licensee agrees to comply with any and all applicable export control laws, regulations, and/or other laws related to embargoes and sanction programs administered by law.
+# SEVERABILITY: If any provision(s) of this Agreement shall be held to be invalid, illegal, or unenforceable by a court or other tribunal of competent jurisdiction, the validity, legality and enforceability of the remaining provisions shall not in any way be affected or impaired thereby.
+# NO IMPLIED WAIVERS: No failure or delay by Licensor in enforcing any right or remedy under this Agreement shall be construed as a waiver of any future or other exercise of such right or remedy by Licensor.
+# GOVERNING LAW: This Agreement shall be construed and enforced in accordance with the laws of Germany without reference to conflict of laws principles.  You consent to the personal jurisdiction of the courts of this country and waive their rights to venue outside of Germany.
+# ENTIRE AGREEMENT AND AMENDMENTS: This Agreement constitutes the sole and entire agreement between Licensee and Licensor as to the matter set forth herein and supersedes any previous agreements, understandings, and arrangements between the parties relating hereto.
+###
+""" This module contains helpers to clean the notes, to represent the tokens
+of a chunk of notes compactly and to hash tokens to buckets.
+
+The cleaning matches `pyllars.nlp_utils.clean_doc`, but the tokens are kept as
+a list rather than joined with spaces (and later split again).
+`clean_docs_tokens` cleans a batch of documents and caches the result of
+cleaning and stemming each distinct word. `CompactVocabulary` is a token
+mapping in flat arrays which needs less memory on the workers than a dict.
+"""
+import functools
+import joblib
+import nltk
+import numpy as np
+import pandas as pd
+
+import pyllars.nlp_utils as nlp_utils
+from sklearn.utils import murmurhash3_32
+
+###
+# Cleaning
+###
+# the maximum number of distinct words in the cache of each process
+STEM_CACHE_SIZE = 2 ** 18
+
+@functools.lru_cache(maxsize=STEM_CACHE_SIZE)
+def clean_word(word):
+    """ Clean a single word from `nltk.word_tokenize` in the same way as
+    `nlp_utils.clean_doc`: lower case, remove punctuation, drop non-alphabetic
+    words and stop words, and stem
+
+    The result is cached, so each distinct word is only cleaned and stemmed
+    once in each (worker) process.
+
+    Returns
+    -------
+    stem: string, or None
+        The stem, or None if the word is removed
+    """
+    w = word.lower()
+    w = w.translate(nlp_utils.STRING_PUNCTUATION_TABLE)
+
+    if (not w.isalpha()) or (w in nlp_utils.ENGLISH_STOP_WORDS):
+        return None
+
+    stem = nlp_utils.ENGLISH_SNOWBALL_STEMMER.stem(w)
+    return stem
+
+def clean_docs_tokens(docs):
+    """ Clean each document in `docs` in the same way as
+    `nlp_utils.clean_doc`, but keep the list of tokens. Each word is cleaned
+    with (the cache of) `clean_word`.
+
+    For compatibility with splitting the result of `clean_doc`, a document
+    without any tokens results in a single empty token.
+
+    Returns
+    -------
+    all_tokens: list of lists of strings
+        The tokens of each document
+    """
+    all_tokens = []
+    for doc in docs:
+        stems = [clean_word(w) for w in nltk.word_tokenize(doc)]
+        tokens = [stem for stem in stems if stem is not None]
+
+        if len(tokens) == 0:
+            tokens = ['']
+
+        all_tokens.append(tokens)
+
+    return all_tokens
+
+def get_stem_cache_stats():
+    """ Get the statistics of the `clean_word` cache of this process
+
+    Returns
+    -------
+    stats: dict
+        The `hits`, `misses`, current `size` and `hit_rate` of the cache
+    """
+    cache_info = clean_word.cache_info()
+
+    lookups = cache_info.hits + cache_info.misses
+    hit_rate = 0
+    if lookups > 0:
+        hit_rate = cache_info.hits / lookups
+
+    stats = {
+        'hits': cache_info.hits,
+        'misses': cache_info.misses,
+        'size': cache_info.currsize,
+        'hit_rate': hit_rate
+    }
+    return stats
+
+###
+# Chunk-local token ids
+###
+def get_chunk_tokens(all_tokens):
+    """ Convert the tokens of each document in a chunk to ids in a
+    chunk-local vocabulary
+
+    Parameters
+    ----------
+    all_tokens: list of lists of strings
+        The tokens of each document
+
+    Returns
+    -------
+    chunk_tokens: dict
+        A dictionary with the following keys:
+
+        * `vocabulary`: the (sorted) unique tokens in the chunk
+        * `token_ids`: an np.array of int32 ids into `vocabulary` for each
+          document
+    """
+    lengths = [len(tokens) for tokens in all_tokens]
+    flat_tokens = [t for tokens in all_tokens for t in tokens]
+
+    vocabulary, flat_ids = np.unique(
+        np.array(flat_tokens, dtype=object), return_inverse=True
+    )
+    flat_ids = flat_ids.astype(np.int32)
+
+    token_ids = []
+    if len(all_tokens) > 0:
+        splits = np.cumsum(lengths)[:-1]
+        token_ids = np.split(flat_ids, splits)
+
+    chunk_tokens = {
+        'vocabulary': vocabulary,
+        'token_ids': token_ids
+    }
+    return chunk_tokens
+
+def get_document_frequencies(chunk_tokens, weights=None):
+    """ Count the number of documents in the chunk which contain each token
+
+    If given, `weights` is the number of times each document should be
+    counted (e.g., to account for duplicates).
+
+    Returns
+    -------
+    token_count: dict of string -> int
+        The document frequency of each token in the chunk vocabulary
+    """
+    vocabulary = chunk_tokens['vocabulary']
+    counts = np.zeros(len(vocabulary), dtype=np.int64)
+
+    unique_ids = [np.unique(ids) for ids in chunk_tokens['token_ids']]
+    if len(unique_ids) > 0:
+        token_weights = None
+        if weights is not None:
+            lengths = [len(ids) for ids in unique_ids]
+            token_weights = np.repeat(weights, lengths)
+
+        counts = np.bincount(
+            np.concatenate(unique_ids),
+            weights=token_weights,
+            minlength=len(vocabulary)
+        )
+        counts = counts.astype(np.int64)
+
+    token_count = dict(zip(vocabulary.tolist(), counts.tolist()))
+    return token_count
+
+def transform_chunk_tokens(chunk_tokens, token_mapping):
+    """ Convert the chunk-local token ids to the ids of the global
+    `token_mapping` (a dict or a `CompactVocabulary`), dropping unknown tokens
+
+    This matches `IncrementalCountVectorizer.transform`, but each distinct
+    token in the chunk is only looked up once.
+
+    Returns
+    -------
+    bags: list of lists of ints
+        The global token ids for each document, in the original token order
+    """
+    if isinstance(token_mapping, CompactVocabulary):
+        local_to_global = token_mapping.lookup(chunk_tokens['vocabulary'])
+    else:
+        local_to_global = np.array([
+            token_mapping.get(t, -1) for t in chunk_tokens['vocabulary']
+        ], dtype=np.int64)
+
+    bags = []
+    for ids in chunk_tokens['token_ids']:
+        global_ids = local_to_global[ids]
+        global_ids = global_ids[global_ids >= 0]
+        bags.append(global_ids.tolist())
+
+    return bags
+
+###
+# Compact vocabulary
+###
+def get_token_hashes(tokens):
+    """ Get a (deterministic) 64-bit hash of each token """
+    tokens = np.asarray(tokens, dtype=object)
+    hashes = pd.util.hash_array(tokens, categorize=False)
+    return hashes
+
+class CompactVocabulary:
+    """ A read-only token mapping kept in a few flat numpy arrays rather than
+    a dict of python strings
+
+    The tokens are sorted by their 64-bit hash, and a token is found by binary
+    search on the hashes. The UTF-8 bytes of all tokens are kept in a single
+    buffer, so that a match of the hash is also checked against the token.
+
+    Compared to the `token_mapping_` of the count vectorizer, this needs much
+    less memory, and it is (de)serialized as a handful of buffers rather than
+    one object for each token. For 20,000 tokens, it needs about a quarter of
+    the memory of the dict and is unpickled much faster, but its pickle is
+    larger (about 470 KB compared to 270 KB), mostly because of the hashes.
+    The arrays can also be put into shared memory or a memory-mapped file as
+    they are.
+
+    Parameters
+    ----------
+    hashes: np.array of uint64
+        The sorted hashes of the tokens, from `get_token_hashes`
+
+    ids: np.array of int32
+        The id of each token
+
+    offsets: np.array of int32 (or int64 for buffers of at least 2 GB)
+        The bytes of token `i` are `buffer[offsets[i]:offsets[i+1]]`
+
+    buffer: np.array of uint8
+        The UTF-8 bytes of all tokens
+    """
+    def __init__(self, hashes, ids, offsets, buffer):
+        self.hashes = hashes
+        self.ids = ids
+        self.offsets = offsets
+        self.buffer = buffer
+
+    @classmethod
+    def from_token_mapping(cls, token_mapping):
+        """ Create the compact version of a dict from tokens to ids """
+        tokens = np.array(list(token_mapping.keys()), dtype=object)
+        ids = np.fromiter(token_mapping.values(), dtype=np.int32,
+            count=len(tokens))
+
+        hashes = get_token_hashes(tokens)
+        order = np.argsort(hashes, kind='stable')
+
+        hashes = hashes[order]
+        if np.any(hashes[1:] == hashes[:-1]):
+            msg = "Tokens with the same hash in the vocabulary"
+            raise ValueError(msg)
+
+        encoded = [t.encode('utf-8') for t in tokens[order]]
+        lengths = np.array([len(t) for t in encoded], dtype=np.int64)
+
+        # the offsets are half the size unless the buffer is very large
+        offsets_dtype = np.int32
+        if lengths.sum() >= 2 ** 31:
+            offsets_dtype = np.int64
+
+        offsets = np.zeros(len(encoded)+1, dtype=offsets_dtype)
+        np.cumsum(lengths, out=offsets[1:])
+        buffer = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+        return cls(hashes, ids[order], offsets, buffer)
+
+    def to_arrays(self):
+        """ Get the arrays, e.g., for `np.savez` """
+        arrays = {
+            'hashes': self.hashes,
+            'ids': self.ids,
+            'offsets': self.offsets,
+            'buffer': self.buffer
+        }
+        return arrays
+
+    def lookup(self, tokens):
+        """ Get the id of each of `tokens`, or -1 for unknown tokens """
+        ids = np.full(len(tokens), -1, dtype=np.int64)
+        if (len(self.hashes) == 0) or (len(tokens) == 0):
+            return ids
+
+        hashes = get_token_hashes(tokens)
+        positions = np.searchsorted(self.hashes, hashes)
+        positions = np.minimum(positions, len(self.hashes) - 1)
+
+        encoded = [t.encode('utf-8') for t in tokens]
+        lengths = np.array([len(t) for t in encoded], dtype=np.int64)
+        starts = np.cumsum(lengths) - lengths
+        buffer = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+        # the candidates with the same hash and length...
+        candidate_starts = self.offsets[positions]
+        candidate_lengths = self.offsets[positions+1] - candidate_starts
+        m_candidate = (
+            (self.hashes[positions] == hashes) &
+            (candidate_lengths == lengths)
+        )
+        candidates = np.where(m_candidate)[0]
+
+        # ... must also have the same bytes
+        candidate_lengths = lengths[candidates]
+        segments = np.repeat(np.arange(len(candidates)), candidate_lengths)
+        within = np.arange(len(segments)) - np.repeat(
+            np.cumsum(candidate_lengths) - candidate_lengths, candidate_lengths
+        )
+
+        token_bytes = buffer[starts[candidates][segments] + within]
+        candidate_bytes = self.buffer[
+            candidate_starts[candidates][segments] + within
+        ]
+
+        num_mismatches = np.bincount(
+            segments[token_bytes != candidate_bytes], minlength=len(candidates)
+        )
+        matches = candidates[num_mismatches == 0]
+
+        ids[matches] = self.ids[positions[matches]]
+        return ids
+
+    def get(self, token, default=None):
+        token_id = self.lookup([token])[0]
+        if token_id < 0:
+            return default
+        return int(token_id)
+
+    def __contains__(self, token):
+        return self.get(token) is not None
+
+    def __len__(self):
+        return len(self.ids)
+
+def get_compact_vocabulary(vectorizer):
+    """ Get the compact vocabulary of a fitted count vectorizer """
+    return CompactVocabulary.from_token_mapping(vectorizer.token_mapping_)
+
+def write_compact_vocabulary(vocabulary, filename):
+    """ Write the arrays of a `CompactVocabulary` to an (uncompressed) `.npz`
+    file
+    """
+    np.savez(filename, **vocabulary.to_arrays())
+
+def load_compact_vocabulary(filename):
+    """ Load a `CompactVocabulary` from `write_compact_vocabulary` """
+    with np.load(filename) as arrays:
+        vocabulary = CompactVocabulary(**arrays)
+    return vocabulary
+
+###
+# Feature hashing
+###
+DEFAULT_NUM_HASH_BUCKETS = 2 ** 20
+
+class HashingTokenVectorizer:
+    """ A stateless alternative to `IncrementalCountVectorizer` which maps each
+    token to one of `num_buckets` buckets using (positive) murmurhash3
+
+    Since the mapping does not depend on any other documents, each note can be
+    transformed as soon as it is cleaned. Rare and abundant buckets can
+    optionally be pruned afterwards (see `get_pruned_buckets`); the pruned
+    buckets are then also removed by later calls to `transform`.
+    """
+    def __init__(self, num_buckets=DEFAULT_NUM_HASH_BUCKETS,
+            pruned_buckets=None):
+
+        self.num_buckets = num_buckets
+
+        if pruned_buckets is None:
+            pruned_buckets = []
+        self.pruned_buckets = np.unique(np.asarray(pruned_buckets, dtype=np.int64))
+
+    def get_buckets(self, tokens):
+        """ Get the bucket of each token, or -1 for tokens in pruned buckets
+        """
+        buckets = np.array([
+            murmurhash3_32(t, positive=True) for t in tokens
+        ], dtype=np.int64) % self.num_buckets
+
+        m_pruned = np.isin(buckets, self.pruned_buckets)
+        buckets[m_pruned] = -1
+        return buckets
+
+    def transform(self, X, *_, **__):
+        """ Convert each list of tokens in `X` to a list of bucket ids
+
+        This has the same interface as `IncrementalCountVectorizer.transform`.
+        """
+        chunk_tokens = get_chunk_tokens(list(X))
+        return self.transform_chunk(chunk_tokens)
+
+    def transform_chunk(self, chunk_tokens):
+        """ Convert the tokens of a chunk (see `get_chunk_tokens`) to lists of
+        bucket ids. Each distinct token is only hashed once.
+        """
+        local_to_bucket = self.get_buckets(chunk_tokens['vocabulary'])
+
+        bags = []
+        for ids in chunk_tokens['token_ids']:
+            buckets = local_to_bucket[ids]
+            buckets = buckets[buckets >= 0]
+            bags.append(buckets.tolist())
+
+        return bags
+
+def get_bucket_document_frequencies(bags):
+    """ Count the number of documents which contain each bucket
+
+    Returns
+    -------
+    buckets, counts: np.arrays of ints
+        The (sorted) buckets which occur in `bags` and their document
+        frequencies
+    """
+    unique_buckets = [np.unique(np.asarray(bag, dtype=np.int64)) for bag in bags]
+
+    if len(unique_buckets) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    buckets, counts = np.unique(np.concatenate(unique_buckets), return_counts=True)
+    return buckets, counts
+
+def get_pruned_buckets(doc_freqs, num_docs, min_df=0, max_df=1):
+    """ Find the buckets which are too rare or too abundant
+
+    The thresholds are interpreted in the same way as in
+    `IncrementalCountVectorizer.prune_tokens`; that is, values of at most 1
+    are fractions of `num_docs`.
+
+    Parameters
+    ----------
+    doc_freqs: np.array of ints
+        The document frequency of each bucket
+
+    num_docs: int
+        The number of documents
+
+    {min,max}_df: numbers
+        The minimum and maximum document frequency of the kept buckets
+
+    Returns
+    -------
+    pruned_buckets: np.array of ints
+        The buckets (with at least one document) to remove
+    """
+    if min_df <= 1:
+        min_df = num_docs * min_df
+
+    if max_df <= 1:
+        max_df = num_docs * max_df
+
+    m_pruned = (doc_freqs > 0) & ((doc_freqs < min_df) | (doc_freqs > max_df))
+    pruned_buckets = np.where(m_pruned)[0]
+    return pruned_buckets
+
+###
+# Raw document frequencies
+###
+def write_document_frequencies(icv, filename):
+    """ Write the raw (unpruned) document frequencies of a merged
+    `IncrementalCountVectorizer`
+
+    Parameters
+    ----------
+    icv: IncrementalCountVectorizer
+        The merged (but not pruned) vectorizer
+
+    filename: path-like (e.g., a string)
+        The path to the output (joblib) file
+    """
+    document_frequencies = {
+        'num_docs': int(icv.num_docs),
+        'token_count': dict(icv.token_count_)
+    }
+    joblib.dump(document_frequencies, filename)
+
+def load_document_frequencies(filename):
+    """ Load the raw document frequencies written by
+    `write_document_frequencies`
+
+    Returns
+    -------
+    document_frequencies: dict
+        A dictionary with the number of documents (`num_docs`) and the
+        document frequency of each token (`token_count`)
+    """
+    document_frequencies = joblib.load(filename)
+    return document_frequencies
@@ -0,0 +1,1099 @@
+###
+# 
+# NAME OF THE PROGRAM THIS FILE BELONGS TO 
+#  
+# file: mimic-preprocessing
+#  
+# Authors: Brandon Malone (Brandon.malone@neclab.eu
+#               Jun Cheng (jun.cheng@neclab.eu)
+# 
+# NEC Laboratories Europe GmbH, Copyright (c) 2020, All rights reserved. 
+#     THIS HEADER MAY NOT BE EXTRACTED OR MODIFIED IN ANY WAY.
+#  
+#     PROPRIETARY INFORMATION --- 
+# 
+# SOFTWARE LICENSE AGREEMENT
+# ACADEMIC OR NON-PROFIT ORGANIZATION NONCOMMERCIAL RESEARCH USE ONLY
+# BY USING OR DOWNLOADING THE SOFTWARE, YOU ARE AGREEING TO THE TERMS OF THIS LICENSE AGREEMENT.  IF YOU DO NOT AGREE WITH THESE TERMS, YOU MAY NOT USE OR DOWNLOAD THE SOFTWARE.
+# 
+# This is a license agreement ("Agreement") between your academic institution or non-profit organization or self (called "Licensee" or "You" in this Agreement) and NEC Laboratories Europe GmbH (called "Licensor" in this Agreement).  All rights not specifically granted to you in this Agreement are reserved for Licensor. 
+# RESERVATION OF OWNERSHIP AND GRANT OF LICENSE: Licensor retains exclusive ownership of any copy of the Software (as defined below) licensed under this Agreement and hereby grants to Licensee a personal, non-exclusive, non-transferable license to use the Software for noncommercial research purposes, without the right to sublicense, pursuant to the terms and conditions of this Agreement. NO EXPRESS OR IMPLIED LICENSES TO ANY OF LICENSOR’S PATENT RIGHTS ARE GRANTED BY THIS LICENSE. As used in this Agreement, the term "Software" means (i) the actual copy of all or any portion of code for program routines made accessible to Licensee by Licensor pursuant to this Agreement, inclusive of backups, updates, and/or merged copies permitted hereunder or subsequently supplied by Licensor,  including all or any file structures, programming instructions, user interfaces and screen formats and sequences as well as any and all documentation and instructions related to it, and (ii) all or any derivatives and/or modifications created or made by You to any of the items specified in (i).
+# CONFIDENTIALITY/PUBLICATIONS: Licensee acknowledges that the Software is proprietary to Licensor, and as such, Licensee agrees to receive all such materials and to use the Software only in accordance with the terms of this Agreement.  Licensee agrees to use reasonable effort to protect the Software from unauthorized use, reproduction, distribution, or publication. All publication materials mentioning features or use of this software must explicitly include an acknowledgement the software was developed by NEC Laboratories Europe GmbH.
+# COPYRIGHT: The Software is owned by Licensor.  
+# PERMITTED USES:  The Software may be used for your own noncommercial internal research purposes. You understand and agree that Licensor is not obligated to implement any suggestions and/or feedback you might provide regarding the Software, but to the extent Licensor does so, you are not entitled to any compensation related thereto.
+# DERIVATIVES: You may create derivatives of or make modifications to the Software, however, You agree that all and any such derivatives and modifications will be owned by Licensor and become a part of the Software licensed to You under this Agreement.  You may only use such derivatives and modifications for your own noncommercial internal research purposes, and you may not otherwise use, distribute or copy such derivatives and modifications in violation of this Agreement.
+# BACKUPS:  If Licensee is an organization, it may make that number of copies of the Software necessary for internal noncommercial use at a single site within its organization provided that all information appearing in or on the original labels, including the copyright and trademark notices are copied onto the labels of the copies.
+# USES NOT PERMITTED:  You may not distribute, copy or use the Software except as explicitly permitted herein. Licensee has not been granted any trademark license as part of this Agreement. Neither the name of NEC Laboratories Europe GmbH nor the names of its contributors may be used to endorse or promote products derived from this Software without specific prior written permission.
+# You may not sell, rent, lease, sublicense, lend, time-share or transfer, in whole or in part, or provide third parties access to prior or present versions (or any parts thereof) of the Software.
+# ASSIGNMENT: You may not assign this Agreement or your rights hereunder without the prior written consent of Licensor. Any attempted assignment without such consent shall be null and void.
+# TERM: The term of the license granted by this Agreement is from Licensee's acceptance of this Agreement by downloading the Software or by using the Software until terminated as provided below.
+# The Agreement automatically terminates without notice if you fail to comply with any provision of this Agreement.  Licensee may terminate this Agreement by ceasing using the Software.  Upon any termination of this Agreement, Licensee will delete any and all copies of the Software. You agree that all provisions which operate to protect the proprietary rights of Licensor shall remain in force should breach occur and that the obligation of confidentiality described in this Agreement is binding in perpetuity and, as such, survives the term of the Agreement.
+# FEE: Provided Licensee abides completely by the terms and conditions of this Agreement, there is no fee due to Licensor for Licensee's use of the Software in accordance with this Agreement.
+# DISCLAIMER OF WARRANTIES:  THE SOFTWARE IS PROVIDED "AS-IS" WITHOUT WARRANTY OF ANY KIND INCLUDING ANY WARRANTIES OF PERFORMANCE OR MERCHANTABILITY OR FITNESS FOR A PARTICULAR USE OR PURPOSE OR OF NON-INFRINGEMENT.  LICENSEE BEARS ALL RISK RELATING TO QUALITY AND PERFORMANCE OF THE SOFTWARE AND RELATED MATERIALS.
+# SUPPORT AND MAINTENANCE: No Software support or training by the Licensor is provided as part of this Agreement.  
+# EXCLUSIVE REMEDY AND LIMITATION OF LIABILITY: To the maximum extent permitted under applicable law, Licensor shall not be liable for direct, indirect, special, incidental, or consequential damages or lost profits related to Licensee's use of and/or inability to use the Software, even if Licensor is advised of the possibility of such damage.
+# EXPORT REGULATION: Licensee agrees to comply with any and all applicable export control laws, regulations, and/or other laws related to embargoes and sanction programs administered by law.
+# SEVERABILITY: If any provision(s) of this Agreement shall be held to be invalid, illegal, or unenforceable by a court or other tribunal of competent jurisdiction, the validity, legality and enforceability of the remaining provisions shall not in any way be affected or impaired thereby.
+# NO IMPLIED WAIVERS: No failure or delay by Licensor in enforcing any right or remedy under this Agreement shall be construed as a waiver of any future or other exercise of such right or remedy by Licensor.
+# GOVERNING LAW: This Agreement shall be construed and enforced in accordance with the laws of Germany without reference to conflict of laws principles.  You consent to the personal jurisdiction of the courts of this country and waive their rights to venue outside of Germany.
+# ENTIRE AGREEMENT AND AMENDMENTS: This Agreement constitutes the sole and entire agreement between Licensee and Licensor as to the matter set forth herein and supersedes any previous agreements, understandings, and arrangements between the parties relating hereto.
+###
+""" This module contains helpers to calculate the hand-crafted time series
+features for many stays at once using numpy segment reductions.
+
+The values are sorted once by (stay, kind, time). Each statistic is then
+calculated for all (stay, kind) segments of a window with a few calls to
+`np.bincount` rather than one `pd.Series` call per segment.
+"""
+import numpy as np
+import pandas as pd
+
+###
+# Helpers for segment reductions
+###
+
+# the same threshold used by pandas (nanops._zero_out_fperr)
+FLOATING_POINT_ERROR = 1e-14
+
+def _zero_out_fperr(x):
+    return np.where(np.abs(x) < FLOATING_POINT_ERROR, 0, x)
+
+def _get_segment_starts(counts):
+    starts = np.zeros_like(counts)
+    np.cumsum(counts[:-1], out=starts[1:])
+    return starts
+
+def _get_moment_statistics(n, m2, m3, m4):
+    """ Calculate the standard deviation, skew and kurtosis from the number
+    of values and the sums of the 2nd, 3rd and 4th powers of the deviations
+    from the mean, using the same estimators as pandas
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        std = np.sqrt(m2 / (n - 1))
+        std[n < 2] = np.nan
+
+        # see pandas nanops.nanskew
+        m2_skew = _zero_out_fperr(m2)
+        m3_skew = _zero_out_fperr(m3)
+        skew = (n * (n - 1) ** 0.5 / (n - 2)) * (m3_skew / m2_skew ** 1.5)
+        skew = np.where(m2_skew == 0, 0, skew)
+        skew[n < 3] = np.nan
+
+        # see pandas nanops.nankurt
+        adj = 3 * (n - 1) ** 2 / ((n - 2) * (n - 3))
+        numerator = _zero_out_fperr(n * (n + 1) * (n - 1) * m4)
+        denominator = _zero_out_fperr((n - 2) * (n - 3) * m2 ** 2)
+        kurtosis = numerator / denominator - adj
+        kurtosis = np.where(denominator == 0, 0, kurtosis)
+        kurtosis[n < 4] = np.nan
+
+    return std, skew, kurtosis
+
+# the quantile features, in addition to the median
+QUANTILES = {
+    "PERCENTILE_5": 0.05,
+    "PERCENTILE_25": 0.25,
+    "PERCENTILE_75": 0.75,
+    "PERCENTILE_95": 0.95
+}
+
+def _get_quantiles(sorted_values, first, counts, q):
+    """ Calculate the `q` quantile of each (non-empty) segment of the sorted
+    values, using the same linear interpolation as `np.quantile`
+    """
+    virtual_index = (counts - 1) * q
+    previous = np.floor(virtual_index)
+    gamma = virtual_index - previous
+
+    previous = first + previous.astype(np.int64)
+    following = np.minimum(previous + 1, first + counts - 1)
+
+    a = sorted_values[previous]
+    b = sorted_values[following]
+    diff_b_a = b - a
+
+    # see numpy.lib.function_base._lerp
+    quantiles = np.where(
+        gamma >= 0.5,
+        b - diff_b_a * (1 - gamma),
+        a + diff_b_a * gamma
+    )
+    return quantiles
+
+def get_segment_statistics(segments, values, num_segments, is_sorted=False):
+    """ Calculate the standard statistics for each segment
+
+    The statistics match the respective `pd.Series` methods (`count`, `min`,
+    `max`, `mean`, `median`, `std`, `skew`, `kurt`, `mad` and `quantile`).
+    Empty segments have a count of 0 and `np.nan` for all other statistics.
+
+    Parameters
+    ----------
+    segments: np.array of ints
+        The (sorted) segment identifier of each value. The identifiers must be
+        in the range [0, `num_segments`).
+
+    values: np.array of floats
+        The observed values. These must not include `np.nan`.
+
+    num_segments: int
+        The total number of segments
+
+    is_sorted: bool
+        Whether `segments` is sorted and the values are already sorted within
+        each segment. In that case, the values are not sorted again for the
+        order statistics.
+
+    Returns
+    -------
+    statistics: dict of string -> np.array
+        A mapping from the name of the statistic to its value for each segment.
+        The names match the keys of `FEATURE_EXTRACTORS` in
+        `extract_mimic_time_series_features`.
+    """
+    counts = np.bincount(segments, minlength=num_segments)
+    n = counts.astype(float)
+
+    # sort the values within each segment for the order statistics
+    if is_sorted:
+        sorted_values = values
+    else:
+        order = np.lexsort((values, segments))
+        sorted_values = values[order]
+
+    starts = _get_segment_starts(counts)
+    nonempty = counts > 0
+    first = starts[nonempty]
+    last = first + counts[nonempty] - 1
+
+    v_min = np.full(num_segments, np.nan)
+    v_min[nonempty] = sorted_values[first]
+
+    v_max = np.full(num_segments, np.nan)
+    v_max[nonempty] = sorted_values[last]
+
+    v_median = np.full(num_segments, np.nan)
+    lower = first + (counts[nonempty] - 1) // 2
+    upper = first + counts[nonempty] // 2
+    v_median[nonempty] = (sorted_values[lower] + sorted_values[upper]) / 2
+
+    quantiles = {}
+    for name, q in QUANTILES.items():
+        v_quantile = np.full(num_segments, np.nan)
+        v_quantile[nonempty] = _get_quantiles(
+            sorted_values, first, counts[nonempty], q
+        )
+        quantiles[name] = v_quantile
+
+    iqr = quantiles["PERCENTILE_75"] - quantiles["PERCENTILE_25"]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sums = np.bincount(segments, weights=values, minlength=num_segments)
+        mean = sums / n
+
+        adjusted = values - mean[segments]
+        adjusted2 = adjusted ** 2
+
+        m1 = np.bincount(segments, weights=np.abs(adjusted),
+            minlength=num_segments)
+        m2 = np.bincount(segments, weights=adjusted2, minlength=num_segments)
+        m3 = np.bincount(segments, weights=adjusted2*adjusted,
+            minlength=num_segments)
+        m4 = np.bincount(segments, weights=adjusted2**2,
+            minlength=num_segments)
+
+        mad = m1 / n
+
+    std, skew, kurtosis = _get_moment_statistics(n, m2, m3, m4)
+
+    statistics = {
+        "KURTOSIS": kurtosis,
+        "MAX_ABSOLUTE_DEVIATION": mad,
+        "MAX": v_max,
+        "MEAN": mean,
+        "MEDIAN": v_median,
+        "MIN": v_min,
+        "SKEW": skew,
+        "STD": std,
+        "COUNT": counts,
+        "INTERQUARTILE_RANGE": iqr
+    }
+    statistics.update(quantiles)
+
+    return statistics
+
+###
+# Sorting the stacked time series data
+###
+def sort_ts_data(
+        df_ts_data,
+        name_column='kind',
+        time_column='Hours',
+        value_column='num_value',
+        stay_column='stay'):
+    """ Sort the stacked time series data by (stay, kind, time)
+
+    Parameters
+    ----------
+    df_ts_data: pd.DataFrame
+        The long-format time series data, such as that created by
+        `extract_mimic_time_series_features.get_normalized_stacked_df`
+
+    {name,time,value,stay}_column: strings
+        The names of the respective columns in `df_ts_data`
+
+    Returns
+    -------
+    sorted_ts_data: dict
+        A dictionary with the following keys:
+
+        * `order`: the position in `df_ts_data` of each sorted row
+        * `stays`, `kinds`: the unique (sorted) stays and kinds
+        * `stay_codes`, `kind_codes`: the index of the stay and kind of each
+          sorted row in `stays` and `kinds`
+        * `segments`: the (stay, kind) segment of each sorted row, that is,
+          `stay_code * len(kinds) + kind_code`
+        * `times`, `values`: the (float) times and values of each sorted row
+    """
+    stay_codes, stays = pd.factorize(df_ts_data[stay_column], sort=True)
+    kind_codes, kinds = pd.factorize(df_ts_data[name_column], sort=True)
+    times = df_ts_data[time_column].to_numpy(dtype=float)
+    values = df_ts_data[value_column].to_numpy(dtype=float)
+
+    order = np.lexsort((times, kind_codes, stay_codes))
+    stay_codes = stay_codes[order]
+    kind_codes = kind_codes[order]
+
+    segments = stay_codes.astype(np.int64) * len(kinds) + kind_codes
+
+    sorted_ts_data = {
+        'order': order,
+        'stays': stays,
+        'kinds': kinds,
+        'stay_codes': stay_codes,
+        'kind_codes': kind_codes,
+        'segments': segments,
+        'times': times[order],
+        'values': values[order]
+    }
+
+    return sorted_ts_data
+
+###
+# Feature extraction
+###
+VALID_FEATURE_NAMES = [
+    "KURTOSIS",
+    "MAX_ABSOLUTE_DEVIATION",
+    "MAX",
+    "MEAN",
+    "MEDIAN",
+    "MIN",
+    "SKEW",
+    "STD",
+    "COUNT",
+    "PERCENTILE_5",
+    "PERCENTILE_25",
+    "PERCENTILE_75",
+    "PERCENTILE_95",
+    "INTERQUARTILE_RANGE"
+]
+
+def _validate_feature_names(feature_names, function_name):
+    invalid_names = set(feature_names) - set(VALID_FEATURE_NAMES)
+
+    if len(invalid_names) > 0:
+        msg = ("[{}] cannot calculate features: {}. valid names are: "
+            "{}".format(function_name, sorted(invalid_names),
+            VALID_FEATURE_NAMES))
+        raise ValueError(msg)
+
+def get_feature_name(kind, start, end, feature_name):
+    """ Get the name of the column for the given feature, in the form:
+    `<kind>__<start>-<end>__<feature_name>`
+    """
+    name = "{}__{:.2f}-{:.2f}__{}".format(kind, start, end, feature_name)
+    return name
+
+def extract_window_features(sorted_ts_data, subsequence_timepoints,
+        feature_names):
+    """ Calculate the features for all (stay, kind) segments in each window
+
+    The observed values are sorted by value within each segment once. Since
+    selecting the values of a window keeps them sorted, the order statistics
+    (`MIN`, `MAX`, `MEDIAN` and the quantiles) of all windows are answered
+    from this single sort.
+
+    Parameters
+    ----------
+    sorted_ts_data: dict
+        The result of `sort_ts_data`
+
+    subsequence_timepoints: iterable of (start, end) pairs
+        The (inclusive) boundaries of each window
+
+    feature_names: iterable of strings
+        The names of the features to calculate. Please see
+        `VALID_FEATURE_NAMES` for all valid names.
+
+    Returns
+    -------
+    window_features: dict of (start, end, feature_name) -> np.array
+        The features for each (stay, kind) segment, with shape
+        (num_stays, num_kinds)
+    """
+    _validate_feature_names(feature_names, "extract_window_features")
+
+    num_stays = len(sorted_ts_data['stays'])
+    num_kinds = len(sorted_ts_data['kinds'])
+    num_segments = num_stays * num_kinds
+
+    times = sorted_ts_data['times']
+    values = sorted_ts_data['values']
+    segments = sorted_ts_data['segments']
+    m_observed = ~np.isnan(values)
+
+    # sort the observed values by (segment, value)
+    times = times[m_observed]
+    values = values[m_observed]
+    segments = segments[m_observed]
+
+    order = np.lexsort((values, segments))
+    times = times[order]
+    values = values[order]
+    segments = segments[order]
+
+    window_features = {}
+    for (start, end) in subsequence_timepoints:
+        m_valid = (times >= start) & (times <= end)
+
+        statistics = get_segment_statistics(
+            segments[m_valid], values[m_valid], num_segments, is_sorted=True
+        )
+
+        for feature_name in feature_names:
+            f = statistics[feature_name].reshape(num_stays, num_kinds)
+            window_features[(start, end, feature_name)] = f
+
+    return window_features
+
+def extract_all_time_series_features(
+        df_ts_data,
+        subsequence_timepoints,
+        feature_names=VALID_FEATURE_NAMES,
+        name_column='kind',
+        time_column='Hours',
+        value_column='num_value',
+        stay_column='stay',
+        id_columns=['SUBJECT_ID', 'EPISODE']) -> pd.DataFrame:
+    """ Calculate the hand-crafted features for all stays in `df_ts_data`
+
+    The result has the same columns as
+    `extract_mimic_time_series_features.extract_all_episode_time_series_features`.
+    In particular, all features for a kind are `np.nan` (including `COUNT`)
+    when the stay does not include any observations of that kind.
+
+    Parameters
+    ----------
+    df_ts_data: pd.DataFrame
+        The long-format time series data
+
+    subsequence_timepoints: iterable of (start, end) pairs
+        The (inclusive) boundaries of each window
+
+    feature_names: iterable of strings
+        The names of the features to calculate
+
+    {name,time,value,stay}_column: strings
+        The names of the respective columns in `df_ts_data`
+
+    id_columns: list of strings
+        Additional identifier columns to copy to the result for each stay
+
+    Returns
+    -------
+    df_ts_features: pd.DataFrame
+        The features, with one row for each stay
+    """
+    sorted_ts_data = sort_ts_data(
+        df_ts_data,
+        name_column=name_column,
+        time_column=time_column,
+        value_column=value_column,
+        stay_column=stay_column
+    )
+
+    window_features = extract_window_features(
+        sorted_ts_data, subsequence_timepoints, feature_names
+    )
+
+    stays = sorted_ts_data['stays']
+    kinds = sorted_ts_data['kinds']
+
+    # kinds never observed for a stay are missing rather than empty
+    num_segments = len(stays) * len(kinds)
+    m_present = np.bincount(sorted_ts_data['segments'], minlength=num_segments)
+    m_present = (m_present > 0).reshape(len(stays), len(kinds))
+
+    features = {}
+    for k, kind in enumerate(kinds):
+        m_missing = ~m_present[:, k]
+        for (start, end) in subsequence_timepoints:
+            for feature_name in feature_names:
+                f = window_features[(start, end, feature_name)][:, k]
+                f = f.astype(float)
+                f[m_missing] = np.nan
+
+                name = get_feature_name(kind, start, end, feature_name)
+                features[name] = f
+
+    df_ts_features = pd.DataFrame(features)
+
+    # and the identifiers from the first row of each stay
+    _, first_rows = np.unique(sorted_ts_data['stay_codes'], return_index=True)
+    first_rows = sorted_ts_data['order'][first_rows]
+
+    for c in id_columns:
+        df_ts_features[c] = df_ts_data[c].to_numpy()[first_rows]
+    df_ts_features[stay_column] = np.asarray(stays)
+
+    return df_ts_features
+
+###
+# Rolling features at many prediction times
+###
+def get_prediction_times(sorted_ts_data, prediction_times=None, hourly=False):
+    """ Get the prediction times for each stay
+
+    Parameters
+    ----------
+    sorted_ts_data: dict
+        The result of `sort_ts_data`
+
+    prediction_times: iterable of floats, or None
+        Fixed prediction times (horizons, in hours), such as [24, 48, 72],
+        used for every stay
+
+    hourly: bool
+        Whether to predict at every hour of each stay, from hour 1 up to
+        (and including) the first full hour after the last observation. This
+        matches the hourly predictions of the decompensation and
+        length-of-stay benchmark problems.
+
+    Returns
+    -------
+    query_stays: np.array of ints
+        The index of the stay (in `sorted_ts_data['stays']`) of each query
+
+    query_times: np.array of floats
+        The prediction time of each query, in hours. The queries are sorted
+        by stay and then by time.
+    """
+    num_stays = len(sorted_ts_data['stays'])
+
+    query_stays = []
+    query_times = []
+
+    if prediction_times is not None:
+        prediction_times = np.unique(np.asarray(prediction_times, dtype=float))
+        query_stays.append(
+            np.repeat(np.arange(num_stays), len(prediction_times))
+        )
+        query_times.append(np.tile(prediction_times, num_stays))
+
+    if hourly:
+        last_times = np.full(num_stays, -np.inf)
+        np.fmax.at(
+            last_times, sorted_ts_data['stay_codes'], sorted_ts_data['times']
+        )
+        num_hours = np.maximum(np.ceil(last_times), 1).astype(np.int64)
+
+        stays = np.repeat(np.arange(num_stays), num_hours)
+        hours = np.arange(len(stays)) - np.repeat(
+            _get_segment_starts(num_hours), num_hours
+        ) + 1
+
+        query_stays.append(stays)
+        query_times.append(hours.astype(float))
+
+    if len(query_stays) == 0:
+        msg = ("[mp_ts_features.get_prediction_times] either prediction_times "
+            "or hourly must be given")
+        raise ValueError(msg)
+
+    query_stays = np.concatenate(query_stays)
+    query_times = np.concatenate(query_times)
+
+    # drop duplicates, e.g., a fixed horizon which is also an hourly prediction
+    queries = np.unique(np.stack([query_stays, query_times], axis=1), axis=0)
+    query_stays = queries[:, 0].astype(np.int64)
+    query_times = queries[:, 1]
+
+    return query_stays, query_times
+
+def _search_segments(segments, times, query_segments, query_times, side):
+    """ Find the position of each query (segment, time) in the sorted
+    (segment, time) data, like `np.searchsorted` on the pairs
+
+    Queries and data are sorted together, so no tolerance is needed for
+    comparing the times. With `side='left'`, a query is placed before data
+    with the same time; with `side='right'`, after it.
+    """
+    num_values = len(segments)
+    num_queries = len(query_segments)
+
+    all_segments = np.concatenate([segments, query_segments])
+    all_times = np.concatenate([times, query_times])
+    is_query = np.concatenate([
+        np.zeros(num_values, dtype=int),
+        np.ones(num_queries, dtype=int)
+    ])
+
+    ties = is_query if side == 'right' else 1 - is_query
+    order = np.lexsort((ties, all_times, all_segments))
+
+    positions = np.empty_like(order)
+    positions[order] = np.arange(len(order))
+    query_positions = positions[num_values:]
+
+    # subtract the number of queries before each query
+    query_ranks = np.empty_like(query_positions)
+    query_ranks[np.argsort(query_positions)] = np.arange(num_queries)
+
+    return query_positions - query_ranks
+
+def _get_segment_cumsum(values, segments):
+    """ Calculate the cumulative sum of `values` within each (sorted) segment
+
+    The sums restart at the start of each segment, so they never include
+    (large) sums from earlier segments. The scan doubles the distance of the
+    summed values in each step, so it takes log2 of the length of the
+    longest segment vectorized steps. As for prefix sums, position `i` of the
+    result is the sum of the values of the segment before position `i`, and
+    the result includes a leading 0.
+    """
+    cumsum = values.copy()
+    step = 1
+    while step < len(cumsum):
+        m_same = segments[step:] == segments[:-step]
+        if not m_same.any():
+            break
+
+        cumsum[step:] = cumsum[step:] + np.where(m_same, cumsum[:-step], 0)
+        step *= 2
+
+    cumsum = np.concatenate([np.zeros(1, dtype=cumsum.dtype), cumsum])
+    return cumsum
+
+def _get_window_sums(cumsum, lo, hi, segment_starts):
+    """ Calculate the sums of the windows [lo, hi) from the cumulative sums
+    of `_get_segment_cumsum`. Each window must be within the segment which
+    starts at `segment_starts`.
+    """
+    nonempty = hi > lo
+    sums = np.where(nonempty, cumsum[hi], 0)
+    sums = sums - np.where(nonempty & (lo > segment_starts), cumsum[lo], 0)
+    return sums
+
+def _get_sparse_tables(values, max_length):
+    """ Create the sparse tables for constant-time range min and max queries
+
+    Row `j` of each table holds the min (or max) of `values[i:i+2**j]`.
+    """
+    num_levels = max(int(max_length).bit_length(), 1)
+
+    mins = np.empty((num_levels, len(values)))
+    maxs = np.empty((num_levels, len(values)))
+    mins[0] = values
+    maxs[0] = values
+
+    for j in range(1, num_levels):
+        step = 2 ** (j-1)
+        mins[j] = mins[j-1]
+        maxs[j] = maxs[j-1]
+        np.minimum(mins[j-1][:-step], mins[j-1][step:], out=mins[j][:-step])
+        np.maximum(maxs[j-1][:-step], maxs[j-1][step:], out=maxs[j][:-step])
+
+    return mins, maxs
+
+def _query_sparse_table(table, lo, hi):
+    """ Query the range [lo, hi) of the sparse table for non-empty ranges """
+    lengths = hi - lo
+    levels = np.floor(np.log2(lengths)).astype(int)
+    left = table[levels, lo]
+    right = table[levels, hi - 2 ** levels]
+    return left, right
+
+def _get_wavelet_matrix(keys, weights=None):
+    """ Create a wavelet matrix for order statistics of ranges of `keys`
+
+    The keys must be distinct integers in [0, len(keys)). Each level of the
+    matrix stably partitions the keys by one bit, from the highest to the
+    lowest, and keeps the number of keys with a 0 bit (and the sum of their
+    `weights`, if given) before each position. Thus, each query on a range
+    of the keys takes one (vectorized) step per bit, independent of the
+    length of the range.
+    """
+    num_keys = len(keys)
+    num_bits = max(int(num_keys).bit_length(), 1)
+
+    zero_counts = np.zeros((num_bits, num_keys + 1), dtype=np.int64)
+    num_zeros = np.zeros(num_bits, dtype=np.int64)
+
+    zero_sums = None
+    if weights is not None:
+        zero_sums = np.zeros((num_bits, num_keys + 1), dtype=weights.dtype)
+
+    for level in range(num_bits):
+        bit = num_bits - level - 1
+        m_zero = ((keys >> bit) & 1) == 0
+
+        np.cumsum(m_zero, out=zero_counts[level, 1:])
+        num_zeros[level] = zero_counts[level, -1]
+
+        order = np.concatenate(
+            [np.flatnonzero(m_zero), np.flatnonzero(~m_zero)]
+        )
+        keys = keys[order]
+
+        if weights is not None:
+            np.cumsum(np.where(m_zero, weights, 0), out=zero_sums[level, 1:])
+            weights = weights[order]
+
+    wavelet_matrix = {
+        'num_bits': num_bits,
+        'zero_counts': zero_counts,
+        'num_zeros': num_zeros,
+        'zero_sums': zero_sums
+    }
+    return wavelet_matrix
+
+def _query_kth_key(wavelet_matrix, lo, hi, k):
+    """ Find the `k`th smallest (0-based) key in each range [lo, hi). Each
+    range must include more than `k` keys.
+    """
+    keys = np.zeros_like(k)
+
+    for level in range(wavelet_matrix['num_bits']):
+        bit = wavelet_matrix['num_bits'] - level - 1
+        zero_counts = wavelet_matrix['zero_counts'][level]
+        num_zeros = wavelet_matrix['num_zeros'][level]
+
+        zeros_lo = zero_counts[lo]
+        zeros_hi = zero_counts[hi]
+        zeros = zeros_hi - zeros_lo
+
+        m_zero = k < zeros
+        lo = np.where(m_zero, zeros_lo, num_zeros + lo - zeros_lo)
+        hi = np.where(m_zero, zeros_hi, num_zeros + hi - zeros_hi)
+        k = np.where(m_zero, k, k - zeros)
+        keys |= (~m_zero).astype(keys.dtype) << bit
+
+    return keys
+
+def _query_keys_below(wavelet_matrix, lo, hi, thresholds):
+    """ Count the keys smaller than `thresholds` in each range [lo, hi), and
+    sum their weights
+    """
+    counts = np.zeros(len(lo), dtype=np.int64)
+    sums = np.zeros(len(lo), dtype=wavelet_matrix['zero_sums'].dtype)
+
+    for level in range(wavelet_matrix['num_bits']):
+        bit = wavelet_matrix['num_bits'] - level - 1
+        zero_counts = wavelet_matrix['zero_counts'][level]
+        zero_sums = wavelet_matrix['zero_sums'][level]
+        num_zeros = wavelet_matrix['num_zeros'][level]
+
+        zeros_lo = zero_counts[lo]
+        zeros_hi = zero_counts[hi]
+
+        # all keys with a 0 bit where the threshold has a 1 bit are smaller
+        m_one = ((thresholds >> bit) & 1) == 1
+        counts += np.where(m_one, zeros_hi - zeros_lo, 0)
+        sums += np.where(m_one, zero_sums[hi] - zero_sums[lo], 0)
+
+        lo = np.where(m_one, num_zeros + lo - zeros_lo, zeros_lo)
+        hi = np.where(m_one, num_zeros + hi - zeros_hi, zeros_hi)
+
+    return counts, sums
+
+def _query_window_quantiles(wavelet_matrix, sorted_values, lo, hi, q):
+    """ Calculate the `q` quantile of the values in each (non-empty) window
+    [lo, hi), using the same linear interpolation as `np.quantile`
+    """
+    counts = hi - lo
+    virtual_index = (counts - 1) * q
+    previous = np.floor(virtual_index).astype(np.int64)
+    following = np.minimum(previous + 1, counts - 1)
+    gamma = virtual_index - previous
+
+    a = sorted_values[_query_kth_key(wavelet_matrix, lo, hi, previous)]
+    b = sorted_values[_query_kth_key(wavelet_matrix, lo, hi, following)]
+    diff_b_a = b - a
+
+    # see numpy.lib.function_base._lerp
+    quantiles = np.where(
+        gamma >= 0.5,
+        b - diff_b_a * (1 - gamma),
+        a + diff_b_a * gamma
+    )
+    return quantiles
+
+def _get_window_order_statistics(wavelet_matrix, sorted_values,
+        sorted_segments, lo, hi, query_segments, mean, mean_shifted, s1,
+        feature_names):
+    """ Calculate the order statistics (and `MAX_ABSOLUTE_DEVIATION`) of the
+    windows [lo, hi) with the wavelet matrix of the segment ranks
+
+    `mean_shifted` and `s1` are the mean and the sum of the values of each
+    window relative to the reference value of its segment, as for the
+    weights of the wavelet matrix.
+    """
+    num_windows = len(lo)
+    nonempty = hi > lo
+    lo = lo[nonempty]
+    hi = hi[nonempty]
+
+    statistics = {}
+
+    if "MEDIAN" in feature_names:
+        counts = hi - lo
+        lower = _query_kth_key(wavelet_matrix, lo, hi, (counts - 1) // 2)
+        upper = _query_kth_key(wavelet_matrix, lo, hi, counts // 2)
+
+        v_median = np.full(num_windows, np.nan)
+        v_median[nonempty] = (sorted_values[lower] + sorted_values[upper]) / 2
+        statistics["MEDIAN"] = v_median
+
+    if "INTERQUARTILE_RANGE" in feature_names:
+        feature_names = feature_names | {"PERCENTILE_25", "PERCENTILE_75"}
+
+    for name, q in QUANTILES.items():
+        if name not in feature_names:
+            continue
+
+        v_quantile = np.full(num_windows, np.nan)
+        v_quantile[nonempty] = _query_window_quantiles(
+            wavelet_matrix, sorted_values, lo, hi, q
+        )
+        statistics[name] = v_quantile
+
+    if "INTERQUARTILE_RANGE" in feature_names:
+        statistics["INTERQUARTILE_RANGE"] = (
+            statistics["PERCENTILE_75"] - statistics["PERCENTILE_25"]
+        )
+
+    if "MAX_ABSOLUTE_DEVIATION" in feature_names:
+        # the values below the mean of each window are the ranks (of its
+        # segment) before the position of the mean
+        thresholds = _search_segments(
+            sorted_segments,
+            sorted_values,
+            query_segments[nonempty],
+            mean[nonempty],
+            side='left'
+        )
+
+        num_below, sum_below = _query_keys_below(
+            wavelet_matrix, lo, hi, thresholds
+        )
+
+        n = (hi - lo).astype(float)
+        m = mean_shifted[nonempty]
+        num_above = n - num_below
+        sum_above = s1[nonempty] - sum_below
+
+        deviations = (m * num_below - sum_below) + (sum_above - m * num_above)
+
+        mad = np.full(num_windows, np.nan)
+        mad[nonempty] = deviations.astype(float) / n
+        statistics["MAX_ABSOLUTE_DEVIATION"] = mad
+
+    return statistics
+
+def extract_rolling_window_features(sorted_ts_data, query_stays, query_times,
+        subsequences, feature_names):
+    """ Calculate the features for all (query, kind) pairs in each window
+
+    The windows are relative to the prediction time of each query. That is,
+    for the subsequence (`start`, `end`) and prediction time `t`, the window
+    includes all observations with times in [`start*t`, `end*t`].
+
+    The data is sorted once. The positions of the window boundaries are then
+    found with a single search for all queries, and `COUNT`, `MEAN`, `STD`,
+    `SKEW` and `KURTOSIS` are calculated from cumulative sums of the powers of
+    the values within each (stay, kind) segment. `MIN` and `MAX` use sparse
+    tables. Thus, the cost of these features does not depend on the length
+    of the windows.
+
+    `MEDIAN`, the quantiles and `MAX_ABSOLUTE_DEVIATION` use a wavelet matrix
+    over the rank of each value within its segment. It answers the k-th
+    smallest value of a window, and the number and sum of the values below
+    the mean of a window, in a number of steps logarithmic in the number of
+    values. Thus, the values of the windows are never gathered, and the cost
+    of hourly predictions grows linearly rather than quadratically with the
+    length of the stays. The wavelet matrix takes O(n log n) memory for the n
+    observed values of the chunk, so it is only created when those features
+    are requested.
+
+    Parameters
+    ----------
+    sorted_ts_data: dict
+        The result of `sort_ts_data`
+
+    query_stays, query_times: np.arrays
+        The stay and prediction time of each query, such as those created by
+        `get_prediction_times`
+
+    subsequences: iterable of (start, end) pairs
+        The (inclusive) boundaries of each window, as fractions of the
+        prediction time
+
+    feature_names: iterable of strings
+        The names of the features to calculate. Please see
+        `VALID_FEATURE_NAMES` for all valid names.
+
+    Returns
+    -------
+    window_features: dict of (start, end, feature_name) -> np.array
+        The features for each (query, kind) pair, with shape
+        (num_queries, num_kinds)
+    """
+    _validate_feature_names(feature_names, "extract_rolling_window_features")
+
+    num_kinds = len(sorted_ts_data['kinds'])
+    num_queries = len(query_stays)
+
+    times = sorted_ts_data['times']
+    values = sorted_ts_data['values']
+    segments = sorted_ts_data['segments']
+
+    m_observed = ~np.isnan(values) & ~np.isnan(times)
+    times = times[m_observed]
+    values = values[m_observed]
+    segments = segments[m_observed]
+
+    # the power sums are calculated relative to the first value of each
+    # segment, with extended precision, and restart at each segment. thus,
+    # the sums of a window never include the sums of other stays or kinds
+    num_segments = len(sorted_ts_data['stays']) * num_kinds
+    counts = np.bincount(segments, minlength=num_segments)
+    starts = _get_segment_starts(counts)
+    reference = np.zeros(num_segments)
+    reference[counts > 0] = values[starts[counts > 0]]
+
+    shifted = (values - reference[segments]).astype(np.longdouble)
+    power_sums = [
+        _get_segment_cumsum(shifted ** power, segments)
+            for power in range(1, 5)
+    ]
+
+    # the sparse tables are also used to find constant windows, for which
+    # the moments are exactly 0
+    if len(values) > 0:
+        mins, maxs = _get_sparse_tables(values, counts.max())
+
+    # the rank of each value within its segment, for the order statistics
+    order_names = {"MEDIAN", "MAX_ABSOLUTE_DEVIATION", "INTERQUARTILE_RANGE"}
+    order_names.update(QUANTILES.keys())
+    order_names = order_names & set(feature_names)
+
+    if len(order_names) > 0:
+        value_order = np.lexsort((values, segments))
+        sorted_values = values[value_order]
+        sorted_segments = segments[value_order]
+
+        ranks = np.empty_like(value_order)
+        ranks[value_order] = np.arange(len(value_order))
+
+        weights = None
+        if "MAX_ABSOLUTE_DEVIATION" in order_names:
+            weights = shifted
+
+        wavelet_matrix = _get_wavelet_matrix(ranks, weights)
+
+    # each (query, kind) pair, in the order of the result
+    query_segments = (
+        query_stays[:, np.newaxis] * num_kinds + np.arange(num_kinds)
+    ).ravel()
+    query_segment_reference = reference[query_segments]
+    query_segment_starts = starts[query_segments]
+
+    window_features = {}
+    for (start, end) in subsequences:
+        window_start = np.repeat(start * query_times, num_kinds)
+        window_end = np.repeat(end * query_times, num_kinds)
+
+        lo = _search_segments(
+            segments, times, query_segments, window_start, side='left'
+        )
+        hi = _search_segments(
+            segments, times, query_segments, window_end, side='right'
+        )
+        hi = np.maximum(lo, hi)
+
+        n = (hi - lo).astype(float)
+        nonempty = n > 0
+
+        v_min = np.full(len(n), np.nan)
+        v_max = np.full(len(n), np.nan)
+
+        if nonempty.any():
+            left, right = _query_sparse_table(mins, lo[nonempty], hi[nonempty])
+            v_min[nonempty] = np.minimum(left, right)
+
+            left, right = _query_sparse_table(maxs, lo[nonempty], hi[nonempty])
+            v_max[nonempty] = np.maximum(left, right)
+
+        s1, s2, s3, s4 = [
+            _get_window_sums(p, lo, hi, query_segment_starts)
+                for p in power_sums
+        ]
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean_shifted = s1 / n
+            mean = query_segment_reference + mean_shifted.astype(float)
+
+            # the central moments, that is, the power sums centred on the
+            # mean of each window
+            m2 = s2 - s1 * mean_shifted
+            m3 = s3 - 3 * mean_shifted * s2 + 2 * s1 * mean_shifted ** 2
+            m4 = (s4 - 4 * mean_shifted * s3 + 6 * mean_shifted ** 2 * s2 -
+                3 * s1 * mean_shifted ** 3)
+
+            m_constant = v_min == v_max
+            m2 = np.where(m_constant, 0, np.maximum(m2, 0)).astype(float)
+            m3 = np.where(m_constant, 0, m3).astype(float)
+            m4 = np.where(m_constant, 0, m4).astype(float)
+
+        std, skew, kurtosis = _get_moment_statistics(n, m2, m3, m4)
+
+        statistics = {
+            "COUNT": n,
+            "MEAN": mean,
+            "STD": std,
+            "SKEW": skew,
+            "KURTOSIS": kurtosis,
+            "MIN": v_min,
+            "MAX": v_max
+        }
+
+        if len(order_names) > 0:
+            statistics.update(_get_window_order_statistics(
+                wavelet_matrix, sorted_values, sorted_segments, lo, hi,
+                query_segments, mean, mean_shifted, s1, order_names
+            ))
+
+        for feature_name in feature_names:
+            f = statistics[feature_name].reshape(num_queries, num_kinds)
+            window_features[(start, end, feature_name)] = f
+
+    return window_features
+
+def extract_all_rolling_time_series_features(
+        df_ts_data,
+        subsequences,
+        prediction_times=None,
+        hourly=False,
+        feature_names=VALID_FEATURE_NAMES,
+        name_column='kind',
+        time_column='Hours',
+        value_column='num_value',
+        stay_column='stay',
+        period_length_column='PERIOD_LENGTH',
+        id_columns=['SUBJECT_ID', 'EPISODE']) -> pd.DataFrame:
+    """ Calculate the hand-crafted features for all stays in `df_ts_data` at
+    each prediction time
+
+    The features are the same as those calculated by
+    `extract_all_time_series_features`, but the windows are relative to each
+    prediction time rather than a fixed period. Consequently, the features are
+    named using the fractions of the windows, for example,
+    `Heart Rate__0.00-0.10__MEAN`. Up to floating point error, the features
+    at prediction time 48 are the same as those of
+    `extract_mimic_time_series_features.extract_all_episode_time_series_features`
+    for the default subsequences.
+
+    Parameters
+    ----------
+    df_ts_data: pd.DataFrame
+        The long-format time series data
+
+    subsequences: iterable of (start, end) pairs
+        The (inclusive) boundaries of each window, as fractions of the
+        prediction time
+
+    prediction_times: iterable of floats, or None
+        Fixed prediction times (in hours) used for all stays
+
+    hourly: bool
+        Whether to predict at every hour of each stay. Please see
+        `get_prediction_times` for more details.
+
+    feature_names: iterable of strings
+        The names of the features to calculate
+
+    {name,time,value,stay}_column: strings
+        The names of the respective columns in `df_ts_data`
+
+    period_length_column: string
+        The name of the column for the prediction time in the result. The
+        default matches the listfiles of the benchmark problems.
+
+    id_columns: list of strings
+        Additional identifier columns to copy to the result for each stay
+
+    Returns
+    -------
+    df_ts_features: pd.DataFrame
+        The features, with one row for each (stay, prediction time) pair
+    """
+    sorted_ts_data = sort_ts_data(
+        df_ts_data,
+        name_column=name_column,
+        time_column=time_column,
+        value_column=value_column,
+        stay_column=stay_column
+    )
+
+    query_stays, query_times = get_prediction_times(
+        sorted_ts_data, prediction_times=prediction_times, hourly=hourly
+    )
+
+    window_features = extract_rolling_window_features(
+        sorted_ts_data, query_stays, query_times, subsequences, feature_names
+    )
+
+    stays = sorted_ts_data['stays']
+    kinds = sorted_ts_data['kinds']
+
+    # kinds never observed for a stay are missing rather than empty
+    num_segments = len(stays) * len(kinds)
+    m_present = np.bincount(sorted_ts_data['segments'], minlength=num_segments)
+    m_present = (m_present > 0).reshape(len(stays), len(kinds))
+    m_present = m_present[query_stays]
+
+    features = {}
+    for k, kind in enumerate(kinds):
+        m_missing = ~m_present[:, k]
+        for (start, end) in subsequences:
+            for feature_name in feature_names:
+                f = window_features[(start, end, feature_name)][:, k]
+                f = f.astype(float)
+                f[m_missing] = np.nan
+
+                name = get_feature_name(kind, start, end, feature_name)
+                features[name] = f
+
+    df_ts_features = pd.DataFrame(features)
+
+    # and the identifiers from the first row of each stay
+    _, first_rows = np.unique(sorted_ts_data['stay_codes'], return_index=True)
+    first_rows = sorted_ts_data['order'][first_rows][query_stays]
+
+    for c in id_columns:
+        df_ts_features[c] = df_ts_data[c].to_numpy()[first_rows]
+    df_ts_features[stay_column] = np.asarray(stays)[query_stays]
+    df_ts_features[period_length_column] = query_times
+
+    return df_ts_features
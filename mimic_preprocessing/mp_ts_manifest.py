@@ -0,0 +1,223 @@
+###
+# 
+# NAME OF THE PROGRAM THIS FILE BELONGS TO 
+#  
+# file: mimic-preprocessing
+#  
+# Authors: Brandon Malone (Brandon.malone@neclab.eu
+#               Jun Cheng (jun.cheng@neclab.eu)
+# 
+# NEC Laboratories Europe GmbH, Copyright (c) 2020, All rights reserved. 
+#     THIS HEADER MAY NOT BE EXTRACTED OR MODIFIED IN ANY WAY.
+#  
+#     PROPRIETARY INFORMATION --- 
+# 
+# SOFTWARE LICENSE AGREEMENT
+# ACADEMIC OR NON-PROFIT ORGANIZATION NONCOMMERCIAL RESEARCH USE ONLY
+# BY USING OR DOWNLOADING THE SOFTWARE, YOU ARE AGREEING TO THE TERMS OF THIS LICENSE AGREEMENT.  IF YOU DO NOT AGREE WITH THESE TERMS, YOU MAY NOT USE OR DOWNLOAD THE SOFTWARE.
+# 
+# This is a license agreement ("Agreement") between your academic institution or non-profit organization or self (called "Licensee" or "You" in this Agreement) and NEC Laboratories Europe GmbH (called "Licensor" in this Agreement).  All rights not specifically granted to you in this Agreement are reserved for Licensor. 
+# RESERVATION OF OWNERSHIP AND GRANT OF LICENSE: Licensor retains exclusive ownership of any copy of the Software (as defined below) licensed under this Agreement and hereby grants to Licensee a personal, non-exclusive, non-transferable license to use the Software for noncommercial research purposes, without the right to sublicense, pursuant to the terms and conditions of this Agreement. NO EXPRESS OR IMPLIED LICENSES TO ANY OF LICENSOR’S PATENT RIGHTS ARE GRANTED BY THIS LICENSE. As used in this Agreement, the term "Software" means (i) the actual copy of all or any portion of code for program routines made accessible to Licensee by Licensor pursuant to this Agreement, inclusive of backups, updates, and/or merged copies permitted hereunder or subsequently supplied by Licensor,  including all or any file structures, programming instructions, user interfaces and screen formats and sequences as well as any and all documentation and instructions related to it, and (ii) all or any derivatives and/or modifications created or made by You to any of the items specified in (i).
+# CONFIDENTIALITY/PUBLICATIONS: Licensee acknowledges that the Software is proprietary to Licensor, and as such, Licensee agrees to receive all such materials and to use the Software only in accordance with the terms of this Agreement.  Licensee agrees to use reasonable effort to protect the Software from unauthorized use, reproduction, distribution, or publication. All publication materials mentioning features or use of this software must explicitly include an acknowledgement the software was developed by NEC Laboratories Europe GmbH.
+# COPYRIGHT: The Software is owned by Licensor.  
+# PERMITTED USES:  The Software may be used for your own noncommercial internal research purposes. You understand and agree that Licensor is not obligated to implement any suggestions and/or feedback you might provide regarding the Software, but to the extent Licensor does so, you are not entitled to any compensation related thereto.
+# DERIVATIVES: You may create derivatives of or make modifications to the Software, however, You agree that all and any such derivatives and modifications will be owned by Licensor and become a part of the Software licensed to You under this Agreement.  You may only use such derivatives and modifications for your own noncommercial internal research purposes, and you may not otherwise use, distribute or copy such derivatives and modifications in violation of this Agreement.
+# BACKUPS:  If Licensee is an organization, it may make that number of copies of the Software necessary for internal noncommercial use at a single site within its organization provided that all information appearing in or on the original labels, including the copyright and trademark notices are copied onto the labels of the copies.
+# USES NOT PERMITTED:  You may not distribute, copy or use the Software except as explicitly permitted herein. Licensee has not been granted any trademark license as part of this Agreement. Neither the name of NEC Laboratories Europe GmbH nor the names of its contributors may be used to endorse or promote products derived from this Software without specific prior written permission.
+# You may not sell, rent, lease, sublicense, lend, time-share or transfer, in whole or in part, or provide third parties access to prior or present versions (or any parts thereof) of the Software.
+# ASSIGNMENT: You may not assign this Agreement or your rights hereunder without the prior written consent of Licensor. Any attempted assignment without such consent shall be null and void.
+# TERM: The term of the license granted by this Agreement is from Licensee's acceptance of this Agreement by downloading the Software or by using the Software until terminated as provided below.
+# The Agreement automatically terminates without notice if you fail to comply with any provision of this Agreement.  Licensee may terminate this Agreement by ceasing using the Software.  Upon any termination of this Agreement, Licensee will delete any and all copies of the Software. You agree that all provisions which operate to protect the proprietary rights of Licensor shall remain in force should breach occur and that the obligation of confidentiality described in this Agreement is binding in perpetuity and, as such, survives the term of the Agreement.
+# FEE: Provided Licensee abides completely by the terms and conditions of this Agreement, there is no fee due to Licensor for Licensee's use of the Software in accordance with this Agreement.
+# DISCLAIMER OF WARRANTIES:  THE SOFTWARE IS PROVIDED "AS-IS" WITHOUT WARRANTY OF ANY KIND INCLUDING ANY WARRANTIES OF PERFORMANCE OR MERCHANTABILITY OR FITNESS FOR A PARTICULAR USE OR PURPOSE OR OF NON-INFRINGEMENT.  LICENSEE BEARS ALL RISK RELATING TO QUALITY AND PERFORMANCE OF THE SOFTWARE AND RELATED MATERIALS.
+# SUPPORT AND MAINTENANCE: No Software support or training by the Licensor is provided as part of this Agreement.  
+# EXCLUSIVE REMEDY AND LIMITATION OF LIABILITY: To the maximum extent permitted under applicable law, Licensor shall not be liable for direct, indirect, special, incidental, or consequential damages or lost profits related to Licensee's use of and/or inability to use the Software, even if Licensor is advised of the possibility of such damage.
+# EXPORT REGULATION: Licensee agrees to comply with any and all applicable export control laws, regulations, and/or other laws related to embargoes and sanction programs administered by law.
+# SEVERABILITY: If any provision(s) of this Agreement shall be held to be invalid, illegal, or unenforceable by a court or other tribunal of competent jurisdiction, the validity, legality and enforceability of the remaining provisions shall not in any way be affected or impaired thereby.
+# NO IMPLIED WAIVERS: No failure or delay by Licensor in enforcing any right or remedy under this Agreement shall be construed as a waiver of any future or other exercise of such right or remedy by Licensor.
+# GOVERNING LAW: This Agreement shall be construed and enforced in accordance with the laws of Germany without reference to conflict of laws principles.  You consent to the personal jurisdiction of the courts of this country and waive their rights to venue outside of Germany.
+# ENTIRE AGREEMENT AND AMENDMENTS: This Agreement constitutes the sole and entire agreement between Licensee and Licensor as to the matter set forth herein and supersedes any previous agreements, understandings, and arrangements between the parties relating hereto.
+###
+""" This module contains helpers to incrementally update the time series
+features file.
+
+A manifest next to the features file records a fingerprint for each stay: the
+path, size and modification time of its time series file, and a hash of the
+feature configuration. Only stays whose fingerprint changed (or which are
+new) are processed again.
+
+The features for each processed chunk are first written to a "pending" file.
+Pending files are merged into the features file at the end of a run, or at
+the beginning of the next run if a job died halfway.
+"""
+import logging
+logger = logging.getLogger(__name__)
+
+import glob
+import hashlib
+import json
+import os
+
+import pandas as pd
+
+import mimic_preprocessing.mp_filenames as mp_filenames
+
+FINGERPRINT_COLUMNS = [
+    'TS_FILE',
+    'SIZE',
+    'MTIME_NS',
+    'CONFIG_HASH'
+]
+
+MANIFEST_COLUMNS = ['stay'] + FINGERPRINT_COLUMNS
+
+###
+# Fingerprints
+###
+def get_config_hash(feature_config):
+    """ Get a (stable) hash of the json-serializable `feature_config`
+    """
+    s = json.dumps(feature_config, sort_keys=True)
+    config_hash = hashlib.sha1(s.encode('utf-8')).hexdigest()
+    return config_hash
+
+def get_fingerprint(ts_file):
+    """ Get the path, size and modification time (in ns) of `ts_file`
+    """
+    stat = os.stat(ts_file)
+    fingerprint = {
+        'TS_FILE': str(ts_file),
+        'SIZE': stat.st_size,
+        'MTIME_NS': stat.st_mtime_ns
+    }
+    return fingerprint
+
+def get_stale_stays(df_fingerprints, df_manifest):
+    """ Find the stays whose fingerprints do not match the manifest
+
+    Parameters
+    ----------
+    df_fingerprints: pd.DataFrame
+        A data frame with the `MANIFEST_COLUMNS` for the current stays
+
+    df_manifest: pd.DataFrame
+        The existing manifest
+
+    Returns
+    -------
+    m_stale: np.array of bools
+        A mask indicating which rows of `df_fingerprints` are new or changed
+    """
+    df = df_fingerprints[MANIFEST_COLUMNS].merge(
+        df_manifest[MANIFEST_COLUMNS],
+        on='stay',
+        how='left',
+        suffixes=('', '_MANIFEST')
+    )
+
+    m_stale = pd.Series(False, index=df.index)
+    for c in FINGERPRINT_COLUMNS:
+        m_stale |= (df[c].astype(str) != df[c + '_MANIFEST'].astype(str))
+
+    return m_stale.values
+
+###
+# Reading and writing the manifest and pending files
+###
+def load_manifest(time_series_features) -> pd.DataFrame:
+    """ Load the manifest for `time_series_features`, or an empty manifest if
+    it does not exist
+    """
+    f = mp_filenames.get_ts_features_manifest_filename(time_series_features)
+
+    if os.path.exists(f):
+        df_manifest = pd.read_csv(f)
+    else:
+        df_manifest = pd.DataFrame(columns=MANIFEST_COLUMNS)
+
+    return df_manifest
+
+def write_pending_part(df_ts_features, df_manifest, time_series_features, part):
+    """ Write the features and manifest for one chunk of stays
+
+    The manifest is written last, so a part is only considered complete if its
+    manifest file exists.
+    """
+    # stays without any observations do not have features
+    if len(df_ts_features) == 0:
+        df_ts_features = pd.DataFrame(columns=['stay'])
+
+    f = mp_filenames.get_ts_features_pending_filename(
+        time_series_features, part, "features"
+    )
+    os.makedirs(os.path.dirname(f), exist_ok=True)
+    df_ts_features.to_csv(f, index=False)
+
+    f = mp_filenames.get_ts_features_pending_filename(
+        time_series_features, part, "manifest"
+    )
+    df_manifest[MANIFEST_COLUMNS].to_csv(f, index=False)
+
+def _write_csv_atomic(df, f):
+    tmp_f = f + ".tmp"
+    df.to_csv(tmp_f, index=False)
+    os.replace(tmp_f, f)
+
+def merge_pending_parts(time_series_features):
+    """ Merge all complete pending parts into the features file and manifest
+
+    The rows for stays in the pending parts replace any existing rows for
+    those stays. Afterwards, the pending files are removed.
+
+    Parameters
+    ----------
+    time_series_features: path-like (e.g., a string)
+        The path to the time series features file
+
+    Returns
+    -------
+    num_stays: int
+        The number of stays in the merged parts
+    """
+    pattern = mp_filenames.get_ts_features_pending_filename(
+        time_series_features, 0, "manifest"
+    )
+    pattern = pattern.replace("part-000000", "part-*")
+    manifest_files = sorted(glob.glob(pattern))
+
+    if len(manifest_files) == 0:
+        return 0
+
+    feature_files = [
+        f.replace(".manifest", ".features") for f in manifest_files
+    ]
+
+    df_new_features = pd.concat([pd.read_csv(f) for f in feature_files])
+
+    df_new_manifest = pd.concat([pd.read_csv(f) for f in manifest_files])
+    updated_stays = set(df_new_manifest['stay'])
+
+    df_manifest = load_manifest(time_series_features)
+    m_updated = df_manifest['stay'].isin(updated_stays)
+    df_manifest = pd.concat([df_manifest[~m_updated], df_new_manifest])
+
+    df_ts_features = df_new_features
+    if os.path.exists(time_series_features):
+        df_ts_features = pd.read_csv(time_series_features)
+        m_updated = df_ts_features['stay'].isin(updated_stays)
+        df_ts_features = pd.concat([df_ts_features[~m_updated], df_new_features])
+
+    msg = ("[mp_ts_manifest.merge_pending_parts] merging {} stays into: "
+        "'{}'".format(len(updated_stays), time_series_features))
+    logger.info(msg)
+
+    # the manifest is written last so an interrupted merge is repeated
+    _write_csv_atomic(df_ts_features, str(time_series_features))
+    f = mp_filenames.get_ts_features_manifest_filename(time_series_features)
+    _write_csv_atomic(df_manifest[MANIFEST_COLUMNS], f)
+
+    for f in feature_files + manifest_files:
+        if os.path.exists(f):
+            os.remove(f)
+
+    return len(updated_stays)
@@ -0,0 +1,211 @@
+###
+# 
+# NAME OF THE PROGRAM THIS FILE BELONGS TO 
+#  
+# file: mimic-preprocessing
+#  
+# Authors: Brandon Malone (Brandon.malone@neclab.eu
+#               Jun Cheng (jun.cheng@neclab.eu)
+# 
+# NEC Laboratories Europe GmbH, Copyright (c) 2020, All rights reserved. 
+#     THIS HEADER MAY NOT BE EXTRACTED OR MODIFIED IN ANY WAY.
+#  
+#     PROPRIETARY INFORMATION --- 
+# 
+# SOFTWARE LICENSE AGREEMENT
+# ACADEMIC OR NON-PROFIT ORGANIZATION NONCOMMERCIAL RESEARCH USE ONLY
+# BY USING OR DOWNLOADING THE SOFTWARE, YOU ARE AGREEING TO THE TERMS OF THIS LICENSE AGREEMENT.  IF YOU DO NOT AGREE WITH THESE TERMS, YOU MAY NOT USE OR DOWNLOAD THE SOFTWARE.
+# 
+# This is a license agreement ("Agreement") between your academic institution or non-profit organization or self (called "Licensee" or "You" in this Agreement) and NEC Laboratories Europe GmbH (called "Licensor" in this Agreement).  All rights not specifically granted to you in this Agreement are reserved for Licensor. 
+# RESERVATION OF OWNERSHIP AND GRANT OF LICENSE: Licensor retains exclusive ownership of any copy of the Software (as defined below) licensed under this Agreement and hereby grants to Licensee a personal, non-exclusive, non-transferable license to use the Software for noncommercial research purposes, without the right to sublicense, pursuant to the terms and conditions of this Agreement. NO EXPRESS OR IMPLIED LICENSES TO ANY OF LICENSOR’S PATENT RIGHTS ARE GRANTED BY THIS LICENSE. As used in this Agreement, the term "Software" means (i) the actual copy of all or any portion of code for program routines made accessible to Licensee by Licensor pursuant to this Agreement, inclusive of backups, updates, and/or merged copies permitted hereunder or subsequently supplied by Licensor,  including all or any file structures, programming instructions, user interfaces and screen formats and sequences as well as any and all documentation and instructions related to it, and (ii) all or any derivatives and/or modifications created or made by You to any of the items specified in (i).
+# CONFIDENTIALITY/PUBLICATIONS: Licensee acknowledges that the Software is proprietary to Licensor, and as such, Licensee agrees to receive all such materials and to use the Software only in accordance with the terms of this Agreement.  Licensee agrees to use reasonable effort to protect the Software from unauthorized use, reproduction, distribution, or publication. All publication materials mentioning features or use of this software must explicitly include an acknowledgement the software was developed by NEC Laboratories Europe GmbH.
+# COPYRIGHT: The Software is owned by Licensor.  
+# PERMITTED USES:  The Software may be used for your own noncommercial internal research purposes. You understand and agree that Licensor is not obligated to implement any suggestions and/or feedback you might provide regarding the Software, but to the extent Licensor does so, you are not entitled to any compensation related thereto.
+# DERIVATIVES: You may create derivatives of or make modifications to the Software, however, You agree that all and any such derivatives and modifications will be owned by Licensor and become a part of the Software licensed to You under this Agreement.  You may only use such derivatives and modifications for your own noncommercial internal research purposes, and you may not otherwise use, distribute or copy such derivatives and modifications in violation of this Agreement.
+# BACKUPS:  If Licensee is an organization, it may make that number of copies of the Software necessary for internal noncommercial use at a single site within its organization provided that all information appearing in or on the original labels, including the copyright and trademark notices are copied onto the labels of the copies.
+# USES NOT PERMITTED:  You may not distribute, copy or use the Software except as explicitly permitted herein. Licensee has not been granted any trademark license as part of this Agreement. Neither the name of NEC Laboratories Europe GmbH nor the names of its contributors may be used to endorse or promote products derived from this Software without specific prior written permission.
+# You may not sell, rent, lease, sublicense, lend, time-share or transfer, in whole or in part, or provide third parties access to prior or present versions (or any parts thereof) of the Software.
+# ASSIGNMENT: You may not assign this Agreement or your rights hereunder without the prior written consent of Licensor. Any attempted assignment without such consent shall be null and void.
+# TERM: The term of the license granted by this Agreement is from Licensee's acceptance of this Agreement by downloading the Software or by using the Software until terminated as provided below.
+# The Agreement automatically terminates without notice if you fail to comply with any provision of this Agreement.  Licensee may terminate this Agreement by ceasing using the Software.  Upon any termination of this Agreement, Licensee will delete any and all copies of the Software. You agree that all provisions which operate to protect the proprietary rights of Licensor shall remain in force should breach occur and that the obligation of confidentiality described in this Agreement is binding in perpetuity and, as such, survives the term of the Agreement.
+# FEE: Provided Licensee abides completely by the terms and conditions of this Agreement, there is no fee due to Licensor for Licensee's use of the Software in accordance with this Agreement.
+# DISCLAIMER OF WARRANTIES:  THE SOFTWARE IS PROVIDED "AS-IS" WITHOUT WARRANTY OF ANY KIND INCLUDING ANY WARRANTIES OF PERFORMANCE OR MERCHANTABILITY OR FITNESS FOR A PARTICULAR USE OR PURPOSE OR OF NON-INFRINGEMENT.  LICENSEE BEARS ALL RISK RELATING TO QUALITY AND PERFORMANCE OF THE SOFTWARE AND RELATED MATERIALS.
+# SUPPORT AND MAINTENANCE: No Software support or training by the Licensor is provided as part of this Agreement.  
+# EXCLUSIVE REMEDY AND LIMITATION OF LIABILITY: To the maximum extent permitted under applicable law, Licensor shall not be liable for direct, indirect, special, incidental, or consequential damages or lost profits related to Licensee's use of and/or inability to use the Software, even if Licensor is advised of the possibility of such damage.
+# EXPORT REGULATION: Licensee agrees to comply with any and all applicable export control laws, regulations, and/or other laws related to embargoes and sanction programs administered by law.
+# SEVERABILITY: If any provision(s) of this Agreement shall be held to be invalid, illegal, or unenforceable by a court or other tribunal of competent jurisdiction, the validity, legality and enforceability of the remaining provisions shall not in any way be affected or impaired thereby.
+# NO IMPLIED WAIVERS: No failure or delay by Licensor in enforcing any right or remedy under this Agreement shall be construed as a waiver of any future or other exercise of such right or remedy by Licensor.
+# GOVERNING LAW: This Agreement shall be construed and enforced in accordance with the laws of Germany without reference to conflict of laws principles.  You consent to the personal jurisdiction of the courts of this country and waive their rights to venue outside of Germany.
+# ENTIRE AGREEMENT AND AMENDMENTS: This Agreement constitutes the sole and entire agreement between Licensee and Licensor as to the matter set forth herein and supersedes any previous agreements, understandings, and arrangements between the parties relating hereto.
+###
+""" This module contains helpers to write and read the binary version of the
+time series features.
+
+The features are written as:
+
+    * a float32 `.npy` matrix with one row for each stay (or stay and
+      prediction time) and one column for each feature. The matrix can be
+      memory mapped with `np.load(..., mmap_mode='r')`.
+
+    * the column manifest (csv), with the name of each column of the matrix.
+
+    * the stay keys (csv), with the identifiers (e.g., `SUBJECT_ID`,
+      `EPISODE` and `stay`) of each row of the matrix.
+
+Compared to the csv file, this avoids formatting and parsing about 1000
+columns of text, and it halves the size on disk. The values are float32, so
+they are rounded compared to the csv file.
+"""
+import numpy as np
+import pandas as pd
+
+import mimic_preprocessing.mp_filenames as mp_filenames
+
+VALID_FORMATS = [
+    'csv',
+    'npy'
+]
+
+DEFAULT_FORMAT = 'csv'
+
+KEY_COLUMNS = [
+    'SUBJECT_ID',
+    'EPISODE',
+    'stay',
+    'PERIOD_LENGTH'
+]
+
+def get_ts_features_format(config):
+    """ Get the format of the time series features from the configuration
+
+    The format is given by the (optional) `time_series_features_format` key.
+    It is either "csv" (the default) or "npy".
+    """
+    ts_features_format = config.get(
+        'time_series_features_format', DEFAULT_FORMAT
+    )
+
+    if ts_features_format not in VALID_FORMATS:
+        msg = ("[mp_ts_matrix.get_ts_features_format] invalid format: {}. "
+            "valid formats are: {}".format(ts_features_format, VALID_FORMATS))
+        raise ValueError(msg)
+
+    return ts_features_format
+
+###
+# Writing the features
+###
+def write_ts_features_matrix(df_ts_features, time_series_features):
+    """ Write the features as a float32 matrix, column manifest and stay keys
+
+    Parameters
+    ----------
+    df_ts_features: pd.DataFrame
+        The features. All columns in `KEY_COLUMNS` are written to the stay
+        keys, and all other columns to the matrix.
+
+    time_series_features: path-like (e.g., a string)
+        The path to the time series features file. The names of the binary
+        files are derived from this path.
+    """
+    key_columns = [c for c in KEY_COLUMNS if c in df_ts_features.columns]
+    feature_columns = [
+        c for c in df_ts_features.columns if c not in key_columns
+    ]
+
+    f = mp_filenames.get_ts_features_matrix_filename(
+        time_series_features, "matrix"
+    )
+    matrix = np.lib.format.open_memmap(f, mode='w+', dtype=np.float32,
+        shape=(len(df_ts_features), len(feature_columns)))
+
+    # convert a block of columns at a time to limit the memory
+    block_size = 100
+    for i in range(0, len(feature_columns), block_size):
+        block = feature_columns[i:i+block_size]
+        matrix[:, i:i+len(block)] = df_ts_features[block].to_numpy(
+            dtype=np.float32
+        )
+    matrix.flush()
+    del matrix
+
+    f = mp_filenames.get_ts_features_matrix_filename(
+        time_series_features, "columns"
+    )
+    pd.DataFrame({'feature': feature_columns}).to_csv(f, index=False)
+
+    f = mp_filenames.get_ts_features_matrix_filename(
+        time_series_features, "stays"
+    )
+    df_ts_features[key_columns].to_csv(f, index=False)
+
+def write_ts_features(df_ts_features, time_series_features,
+        ts_features_format=DEFAULT_FORMAT):
+    """ Write the features in the given format (see `VALID_FORMATS`)
+    """
+    if ts_features_format == 'npy':
+        write_ts_features_matrix(df_ts_features, time_series_features)
+    else:
+        df_ts_features.to_csv(time_series_features, index=False)
+
+###
+# Reading the features
+###
+def read_ts_features_matrix(time_series_features, mmap_mode='r'):
+    """ Read the float32 matrix, column manifest and stay keys
+
+    Parameters
+    ----------
+    time_series_features: path-like (e.g., a string)
+        The path to the time series features file
+
+    mmap_mode: string or None
+        The `mmap_mode` for `np.load`. Use `None` to read the entire matrix
+        into memory.
+
+    Returns
+    -------
+    matrix: np.array or np.memmap
+        The features, with shape (num_rows, num_features)
+
+    columns: list of strings
+        The name of each column of `matrix`
+
+    df_keys: pd.DataFrame
+        The identifiers of each row of `matrix`
+    """
+    f = mp_filenames.get_ts_features_matrix_filename(
+        time_series_features, "matrix"
+    )
+    matrix = np.load(f, mmap_mode=mmap_mode)
+
+    f = mp_filenames.get_ts_features_matrix_filename(
+        time_series_features, "columns"
+    )
+    columns = pd.read_csv(f)['feature'].tolist()
+
+    f = mp_filenames.get_ts_features_matrix_filename(
+        time_series_features, "stays"
+    )
+    df_keys = pd.read_csv(f)
+
+    return matrix, columns, df_keys
+
+def read_ts_features(time_series_features,
+        ts_features_format=DEFAULT_FORMAT) -> pd.DataFrame:
+    """ Read the features, in the given format, as a data frame
+
+    For the "npy" format, the features are float32 columns. The result
+    otherwise has the same columns as the csv file.
+    """
+    if ts_features_format != 'npy':
+        df_ts_features = pd.read_csv(time_series_features)
+        return df_ts_features
+
+    matrix, columns, df_keys = read_ts_features_matrix(
+        time_series_features, mmap_mode=None
+    )
+
+    df_features = pd.DataFrame(matrix, columns=columns, copy=False)
+    df_ts_features = pd.concat([df_features, df_keys], axis=1)
+    return df_ts_features
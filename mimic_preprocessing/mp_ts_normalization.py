@@ -0,0 +1,260 @@
+###
+# 
+# NAME OF THE PROGRAM THIS FILE BELONGS TO 
+#  
+# file: mimic-preprocessing
+#  
+# Authors: Brandon Malone (Brandon.malone@neclab.eu
+#               Jun Cheng (jun.cheng@neclab.eu)
+# 
+# NEC Laboratories Europe GmbH, Copyright (c) 2020, All rights reserved. 
+#     THIS HEADER MAY NOT BE EXTRACTED OR MODIFIED IN ANY WAY.
+#  
+#     PROPRIETARY INFORMATION --- 
+# 
+# SOFTWARE LICENSE AGREEMENT
+# ACADEMIC OR NON-PROFIT ORGANIZATION NONCOMMERCIAL RESEARCH USE ONLY
+# BY USING OR DOWNLOADING THE SOFTWARE, YOU ARE AGREEING TO THE TERMS OF THIS LICENSE AGREEMENT.  IF YOU DO NOT AGREE WITH THESE TERMS, YOU MAY NOT USE OR DOWNLOAD THE SOFTWARE.
+# 
+# This is a license agreement ("Agreement") between your academic institution or non-profit organization or self (called "Licensee" or "You" in this Agreement) and NEC Laboratories Europe GmbH (called "Licensor" in this Agreement).  All rights not specifically granted to you in this Agreement are reserved for Licensor. 
+# RESERVATION OF OWNERSHIP AND GRANT OF LICENSE: Licensor retains exclusive ownership of any copy of the Software (as defined below) licensed under this Agreement and hereby grants to Licensee a personal, non-exclusive, non-transferable license to use the Software for noncommercial research purposes, without the right to sublicense, pursuant to the terms and conditions of this Agreement. NO EXPRESS OR IMPLIED LICENSES TO ANY OF LICENSOR’S PATENT RIGHTS ARE GRANTED BY THIS LICENSE. As used in this Agreement, the term "Software" means (i) the actual copy of all or any portion of code for program routines made accessible to Licensee by Licensor pursuant to this Agreement, inclusive of backups, updates, and/or merged copies permitted hereunder or subsequently supplied by Licensor,  including all or any file structures, programming instructions, user interfaces and screen formats and sequences as well as any and all documentation and instructions related to it, and (ii) all or any derivatives and/or modifications created or made by You to any of the items specified in (i).
+# CONFIDENTIALITY/PUBLICATIONS: Licensee acknowledges that the Software is proprietary to Licensor, and as such, Licensee agrees to receive all such materials and to use the Software only in accordance with the terms of this Agreement.  Licensee agrees to use reasonable effort to protect the Software from unauthorized use, reproduction, distribution, or publication. All publication materials mentioning features or use of this software must explicitly include an acknowledgement the software was developed by NEC Laboratories Europe GmbH.
+# COPYRIGHT: The Software is owned by Licensor.  
+# PERMITTED USES:  The Software may be used for your own noncommercial internal research purposes. You understand and agree that Licensor is not obligated to implement any suggestions and/or feedback you might provide regarding the Software, but to the extent Licensor does so, you are not entitled to any compensation related thereto.
+# DERIVATIVES: You may create derivatives of or make modifications to the Software, however, You agree that all and any such derivatives and modifications will be owned by Licensor and become a part of the Software licensed to You under this Agreement.  You may only use such derivatives and modifications for your own noncommercial internal research purposes, and you may not otherwise use, distribute or copy such derivatives and modifications in violation of this Agreement.
+# BACKUPS:  If Licensee is an organization, it may make that number of copies of the Software necessary for internal noncommercial use at a single site within its organization provided that all information appearing in or on the original labels, including the copyright and trademark notices are copied onto the labels of the copies.
+# USES NOT PERMITTED:  You may not distribute, copy or use the Software except as explicitly permitted herein. Licensee has not been granted any trademark license as part of this Agreement. Neither the name of NEC Laboratories Europe GmbH nor the names of its contributors may be used to endorse or promote products derived from this Software without specific prior written permission.
+# You may not sell, rent, lease, sublicense, lend, time-share or transfer, in whole or in part, or provide third parties access to prior or present versions (or any parts thereof) of the Software.
+# ASSIGNMENT: You may not assign this Agreement or your rights hereunder without the prior written consent of Licensor. Any attempted assignment without such consent shall be null and void.
+# TERM: The term of the license granted by this Agreement is from Licensee's acceptance of this Agreement by downloading the Software or by using the Software until terminated as provided below.
+# The Agreement automatically terminates without notice if you fail to comply with any provision of this Agreement.  Licensee may terminate this Agreement by ceasing using the Software.  Upon any termination of this Agreement, Licensee will delete any and all copies of the Software. You agree that all provisions which operate to protect the proprietary rights of Licensor shall remain in force should breach occur and that the obligation of confidentiality described in this Agreement is binding in perpetuity and, as such, survives the term of the Agreement.
+# FEE: Provided Licensee abides completely by the terms and conditions of this Agreement, there is no fee due to Licensor for Licensee's use of the Software in accordance with this Agreement.
+# DISCLAIMER OF WARRANTIES:  THE SOFTWARE IS PROVIDED "AS-IS" WITHOUT WARRANTY OF ANY KIND INCLUDING ANY WARRANTIES OF PERFORMANCE OR MERCHANTABILITY OR FITNESS FOR A PARTICULAR USE OR PURPOSE OR OF NON-INFRINGEMENT.  LICENSEE BEARS ALL RISK RELATING TO QUALITY AND PERFORMANCE OF THE SOFTWARE AND RELATED MATERIALS.
+# SUPPORT AND MAINTENANCE: No Software support or training by the Licensor is provided as part of this Agreement.  
+# EXCLUSIVE REMEDY AND LIMITATION OF LIABILITY: To the maximum extent permitted under applicable law, Licensor shall not be liable for direct, indirect, special, incidental, or consequential damages or lost profits related to Licensee's use of and/or inability to use the Software, even if Licensor is advised of the possibility of such damage.
+# EXPORT REGULATION: Licensee agrees to comply with any and all applicable export control laws, regulations, and/or other laws related to embargoes and sanction programs administered by law.
+# SEVERABILITY: If any provision(s) of this Agreement shall be held to be invalid, illegal, or unenforceable by a court or other tribunal of competent jurisdiction, the validity, legality and enforceability of the remaining provisions shall not in any way be affected or impaired thereby.
+# NO IMPLIED WAIVERS: No failure or delay by Licensor in enforcing any right or remedy under this Agreement shall be construed as a waiver of any future or other exercise of such right or remedy by Licensor.
+# GOVERNING LAW: This Agreement shall be construed and enforced in accordance with the laws of Germany without reference to conflict of laws principles.  You consent to the personal jurisdiction of the courts of this country and waive their rights to venue outside of Germany.
+# ENTIRE AGREEMENT AND AMENDMENTS: This Agreement constitutes the sole and entire agreement between Licensee and Licensor as to the matter set forth herein and supersedes any previous agreements, understandings, and arrangements between the parties relating hereto.
+###
+""" This module contains helpers to convert the text values of some kinds of
+time series (e.g., the Glascow coma scale) to numbers.
+
+The mappings for all kinds are compiled once into a lookup table. The table
+is then applied to each (wide) time series file directly after it is parsed,
+so the long-format data only ever contains numeric values.
+
+Additional mappings can be given in the config file with the `value_mappings`
+key. For example:
+
+    value_mappings:
+        Capillary refill rate:
+            Normal <3 secs: 0
+            Abnormal >3 secs: 1
+
+The keys of the mappings are compared to the text exactly as it appears in
+the time series files.
+"""
+import numpy as np
+import pandas as pd
+
+EYE_MAPPING = {   
+    '1 No Response': 1,
+    '2 To pain': 2,
+    '3 To speech': 3,
+    '4 Spontaneously': 4,
+    'None': 1,
+    'Spontaneously': 4,
+    'To Pain': 2,
+    'To Speech': 3
+}
+
+MOTOR_MAPPING = {
+    '1 No Response': 1,
+    '2 Abnorm extensn': 2,
+    '3 Abnorm flexion': 3,
+    '4 Flex-withdraws': 4,
+    '5 Localizes Pain': 5,
+    '6 Obeys Commands': 6,
+    'Abnormal Flexion': 3,
+    'Abnormal extension': 2,
+    'Flex-withdraws': 4,
+    'Localizes Pain': 5,
+    'No response': 1,
+    'Obeys Commands': 6
+}
+
+VERBAL_MAPPING = {
+    '1 No Response': 1,
+    '1.0 ET/Trach': 1,
+    '2 Incomp sounds': 2,
+    '3 Inapprop words': 3,
+    '4 Confused': 4,
+    '5 Oriented': 5,
+    'Confused': 4,
+    'Inappropriate Words': 3,
+    'Incomprehensible sounds': 2,
+    'No Response': 1,
+    'No Response-ETT': 1,
+    'Oriented': 5
+}
+
+DEFAULT_VALUE_MAPPINGS = {
+    'Glascow coma scale eye opening': EYE_MAPPING,
+    'Glascow coma scale motor response': MOTOR_MAPPING,
+    'Glascow coma scale verbal response': VERBAL_MAPPING
+}
+
+###
+# Creating the lookup table
+###
+def get_value_mappings(config=None):
+    """ Get the mappings for all kinds, including those from `config`
+
+    Parameters
+    ----------
+    config: dict or None
+        The configuration. If it includes `value_mappings`, then those
+        mappings are added to (or replace) the default mappings for the
+        respective kinds.
+
+    Returns
+    -------
+    value_mappings: dict of kind -> (dict of text -> value)
+        The mappings for all kinds
+    """
+    value_mappings = dict(DEFAULT_VALUE_MAPPINGS)
+
+    if config is not None:
+        value_mappings.update(config.get('value_mappings') or {})
+
+    return value_mappings
+
+def compile_value_mappings(value_mappings):
+    """ Compile the mappings into a lookup table
+
+    Parameters
+    ----------
+    value_mappings: dict of kind -> (dict of text -> value)
+        The mappings, e.g., from `get_value_mappings`
+
+    Returns
+    -------
+    value_table: dict of kind -> (pd.Index, np.array)
+        For each kind, the texts and the respective (float) values
+    """
+    value_table = {}
+    for kind, mapping in value_mappings.items():
+        texts = pd.Index([str(t) for t in mapping.keys()])
+        values = np.array(list(mapping.values()), dtype=float)
+        value_table[kind] = (texts, values)
+
+    return value_table
+
+def get_value_table(config=None):
+    """ Compile the default mappings and those from `config` into a lookup table
+    """
+    value_mappings = get_value_mappings(config)
+    value_table = compile_value_mappings(value_mappings)
+    return value_table
+
+###
+# Applying the lookup table
+###
+def map_values(values, texts, mapped_values):
+    """ Look up each of `values` in `texts`. Values which do not appear in
+    `texts` (including missing values) are mapped to `np.nan`.
+    """
+    values = pd.Series(values)
+    m_null = values.isnull()
+
+    indices = texts.get_indexer(values.astype(str))
+    indices[m_null.values] = -1
+
+    ret = np.full(len(values), np.nan)
+    m_found = indices >= 0
+    ret[m_found] = mapped_values[indices[m_found]]
+    return ret
+
+def normalize_wide_ts_data(df_ts, kinds, value_table):
+    """ Convert the values of all `kinds` in the (wide) time series data
+    `df_ts` to numbers
+
+    Kinds in `value_table` are mapped using the table; all other kinds must
+    already be numeric.
+
+    Parameters
+    ----------
+    df_ts: pd.DataFrame
+        The wide time series data, e.g., from a `*_timeseries.csv` file
+
+    kinds: list of strings
+        The columns in `df_ts` with time series values
+
+    value_table: dict
+        The result of `compile_value_mappings`
+
+    Returns
+    -------
+    df_numeric: pd.DataFrame
+        A copy of `df_ts` in which all `kinds` are numeric
+
+    m_observed: pd.DataFrame
+        A boolean data frame indicating which of the original values (of
+        `kinds`) were observed. These are not necessarily the same as the
+        non-missing values in `df_numeric` since text values which do not
+        appear in the lookup table become `np.nan`.
+    """
+    m_observed = df_ts[kinds].notnull()
+    df_numeric = df_ts.copy()
+
+    for kind in kinds:
+        if kind in value_table:
+            texts, mapped_values = value_table[kind]
+            df_numeric[kind] = map_values(df_ts[kind], texts, mapped_values)
+        else:
+            df_numeric[kind] = pd.to_numeric(df_ts[kind]).astype(float)
+
+    return df_numeric, m_observed
+
+def stack_normalized_ts_data(df_ts, id_vars, value_table):
+    """ Normalize the wide time series data in `df_ts` and convert it to the
+    long format
+
+    Parameters
+    ----------
+    df_ts: pd.DataFrame
+        The wide time series data
+
+    id_vars: list of strings
+        The identifier columns in `df_ts` (e.g., `Hours`). All other
+        columns are treated as kinds of time series.
+
+    value_table: dict
+        The result of `compile_value_mappings`
+
+    Returns
+    -------
+    df_stacked: pd.DataFrame
+        The long-format data with `id_vars`, `kind` and `num_value` columns.
+        All originally observed values are included, so text values which do
+        not appear in the lookup table have a `num_value` of `np.nan`.
+    """
+    kinds = [c for c in df_ts.columns if c not in id_vars]
+    df_numeric, m_observed = normalize_wide_ts_data(df_ts, kinds, value_table)
+
+    df_stacked = pd.melt(
+        df_numeric,
+        id_vars=id_vars,
+        value_vars=kinds,
+        var_name="kind",
+        value_name="num_value"
+    )
+
+    # melt stacks the columns in the same order
+    m_observed = m_observed.values.ravel(order='F')
+    df_stacked = df_stacked[m_observed]
+    df_stacked = df_stacked.reset_index(drop=True)
+
+    return df_stacked
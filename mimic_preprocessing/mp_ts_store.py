@@ -0,0 +1,313 @@
+###
+# 
+# NAME OF THE PROGRAM THIS FILE BELONGS TO 
+#  
+# file: mimic-preprocessing
+#  
+# Authors: Brandon Malone (Brandon.malone@neclab.eu
+#               Jun Cheng (jun.cheng@neclab.eu)
+# 
+# NEC Laboratories Europe GmbH, Copyright (c) 2020, All rights reserved. 
+#     THIS HEADER MAY NOT BE EXTRACTED OR MODIFIED IN ANY WAY.
+#  
+#     PROPRIETARY INFORMATION --- 
+# 
+# SOFTWARE LICENSE AGREEMENT
+# ACADEMIC OR NON-PROFIT ORGANIZATION NONCOMMERCIAL RESEARCH USE ONLY
+# BY USING OR DOWNLOADING THE SOFTWARE, YOU ARE AGREEING TO THE TERMS OF THIS LICENSE AGREEMENT.  IF YOU DO NOT AGREE WITH THESE TERMS, YOU MAY NOT USE OR DOWNLOAD THE SOFTWARE.
+# 
+# This is a license agreement ("Agreement") between your academic institution or non-profit organization or self (called "Licensee" or "You" in this Agreement) and NEC Laboratories Europe GmbH (called "Licensor" in this Agreement).  All rights not specifically granted to you in this Agreement are reserved for Licensor. 
+# RESERVATION OF OWNERSHIP AND GRANT OF LICENSE: Licensor retains exclusive ownership of any copy of the Software (as defined below) licensed under this Agreement and hereby grants to Licensee a personal, non-exclusive, non-transferable license to use the Software for noncommercial research purposes, without the right to sublicense, pursuant to the terms and conditions of this Agreement. NO EXPRESS OR IMPLIED LICENSES TO ANY OF LICENSOR’S PATENT RIGHTS ARE GRANTED BY THIS LICENSE. As used in this Agreement, the term "Software" means (i) the actual copy of all or any portion of code for program routines made accessible to Licensee by Licensor pursuant to this Agreement, inclusive of backups, updates, and/or merged copies permitted hereunder or subsequently supplied by Licensor,  including all or any file structures, programming instructions, user interfaces and screen formats and sequences as well as any and all documentation and instructions related to it, and (ii) all or any derivatives and/or modifications created or made by You to any of the items specified in (i).
+# CONFIDENTIALITY/PUBLICATIONS: Licensee acknowledges that the Software is proprietary to Licensor, and as such, Licensee agrees to receive all such materials and to use the Software only in accordance with the terms of this Agreement.  Licensee agrees to use reasonable effort to protect the Software from unauthorized use, reproduction, distribution, or publication. All publication materials mentioning features or use of this software must explicitly include an acknowledgement the software was developed by NEC Laboratories Europe GmbH.
+# COPYRIGHT: The Software is owned by Licensor.  
+# PERMITTED USES:  The Software may be used for your own noncommercial internal research purposes. You understand and agree that Licensor is not obligated to implement any suggestions and/or feedback you might provide regarding the Software, but to the extent Licensor does so, you are not entitled to any compensation related thereto.
+# DERIVATIVES: You may create derivatives of or make modifications to the Software, however, You agree that all and any such derivatives and modifications will be owned by Licensor and become a part of the Software licensed to You under this Agreement.  You may only use such derivatives and modifications for your own noncommercial internal research purposes, and you may not otherwise use, distribute or copy such derivatives and modifications in violation of this Agreement.
+# BACKUPS:  If Licensee is an organization, it may make that number of copies of the Software necessary for internal noncommercial use at a single site within its organization provided that all information appearing in or on the original labels, including the copyright and trademark notices are copied onto the labels of the copies.
+# USES NOT PERMITTED:  You may not distribute, copy or use the Software except as explicitly permitted herein. Licensee has not been granted any trademark license as part of this Agreement. Neither the name of NEC Laboratories Europe GmbH nor the names of its contributors may be used to endorse or promote products derived from this Software without specific prior written permission.
+# You may not sell, rent, lease, sublicense, lend, time-share or transfer, in whole or in part, or provide third parties access to prior or present versions (or any parts thereof) of the Software.
+# ASSIGNMENT: You may not assign this Agreement or your rights hereunder without the prior written consent of Licensor. Any attempted assignment without such consent shall be null and void.
+# TERM: The term of the license granted by this Agreement is from Licensee's acceptance of this Agreement by downloading the Software or by using the Software until terminated as provided below.
+# The Agreement automatically terminates without notice if you fail to comply with any provision of this Agreement.  Licensee may terminate this Agreement by ceasing using the Software.  Upon any termination of this Agreement, Licensee will delete any and all copies of the Software. You agree that all provisions which operate to protect the proprietary rights of Licensor shall remain in force should breach occur and that the obligation of confidentiality described in this Agreement is binding in perpetuity and, as such, survives the term of the Agreement.
+# FEE: Provided Licensee abides completely by the terms and conditions of this Agreement, there is no fee due to Licensor for Licensee's use of the Software in accordance with this Agreement.
+# DISCLAIMER OF WARRANTIES:  THE SOFTWARE IS PROVIDED "AS-IS" WITHOUT WARRANTY OF ANY KIND INCLUDING ANY WARRANTIES OF PERFORMANCE OR MERCHANTABILITY OR FITNESS FOR A PARTICULAR USE OR PURPOSE OR OF NON-INFRINGEMENT.  LICENSEE BEARS ALL RISK RELATING TO QUALITY AND PERFORMANCE OF THE SOFTWARE AND RELATED MATERIALS.
+# SUPPORT AND MAINTENANCE: No Software support or training by the Licensor is provided as part of this Agreement.  
+# EXCLUSIVE REMEDY AND LIMITATION OF LIABILITY: To the maximum extent permitted under applicable law, Licensor shall not be liable for direct, indirect, special, incidental, or consequential damages or lost profits related to Licensee's use of and/or inability to use the Software, even if Licensor is advised of the possibility of such damage.
+# EXPORT REGULATION: Licensee agrees to comply with any and all applicable export control laws, regulations, and/or other laws related to embargoes and sanction programs administered by law.
+# SEVERABILITY: If any provision(s) of this Agreement shall be held to be invalid, illegal, or unenforceable by a court or other tribunal of competent jurisdiction, the validity, legality and enforceability of the remaining provisions shall not in any way be affected or impaired thereby.
+# NO IMPLIED WAIVERS: No failure or delay by Licensor in enforcing any right or remedy under this Agreement shall be construed as a waiver of any future or other exercise of such right or remedy by Licensor.
+# GOVERNING LAW: This Agreement shall be construed and enforced in accordance with the laws of Germany without reference to conflict of laws principles.  You consent to the personal jurisdiction of the courts of this country and waive their rights to venue outside of Germany.
+# ENTIRE AGREEMENT AND AMENDMENTS: This Agreement constitutes the sole and entire agreement between Licensee and Licensor as to the matter set forth herein and supersedes any previous agreements, understandings, and arrangements between the parties relating hereto.
+###
+""" This module contains helpers to write and read the columnar time series
+store.
+
+The store contains the same information as the `*_timeseries.csv` files
+created by the benchmark scripts from Harutyunyan et al. It consists of:
+
+    * a parquet dataset partitioned by SPLIT. Each row corresponds to one
+      row of the original files, with an additional `STAY_ID` column. The
+      rows are sorted by `STAY_ID` and `Hours`.
+
+    * a stay index (csv) with the `STAY_ID`, `stay`, `SUBJECT_ID`, `EPISODE`,
+      `SPLIT` and `NUM_ROWS` of each stay.
+"""
+import functools
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.fs
+import pyarrow.parquet as pq
+
+import mimic_preprocessing.mp_filenames as mp_filenames
+import mimic_preprocessing.mp_ts_normalization as mp_ts_normalization
+
+# these kinds are recorded as text in the benchmark files; all others are
+# numeric
+TEXT_KINDS = list(mp_ts_normalization.DEFAULT_VALUE_MAPPINGS.keys())
+
+STAY_INDEX_COLUMNS = [
+    'STAY_ID',
+    'stay',
+    'SUBJECT_ID',
+    'EPISODE',
+    'SPLIT',
+    'NUM_ROWS'
+]
+
+###
+# Writing the store
+###
+def get_kinds(ts_file):
+    """ Read the kinds of time series from the header of `ts_file`
+    """
+    df = pd.read_csv(ts_file, nrows=0)
+    kinds = [c for c in df.columns if c != 'Hours']
+    return kinds
+
+def get_schema(kinds, text_kinds=TEXT_KINDS):
+    """ Create the schema for the time series data with the given kinds
+    """
+    fields = [
+        pa.field('STAY_ID', pa.int32()),
+        pa.field('Hours', pa.float64())
+    ]
+
+    for kind in kinds:
+        t = pa.string() if kind in text_kinds else pa.float64()
+        fields.append(pa.field(kind, t))
+
+    schema = pa.schema(fields)
+    return schema
+
+def read_ts_csv(ts_file, kinds, text_kinds=TEXT_KINDS):
+    """ Read `ts_file` and ensure the columns match the store schema
+
+    Missing kinds are added with only missing values. A `ValueError` is raised
+    if a kind which is not in `text_kinds` contains non-numeric values.
+    """
+    dtype = {kind: str for kind in text_kinds}
+    df = pd.read_csv(ts_file, dtype=dtype)
+    df = df.reindex(columns=['Hours'] + kinds)
+
+    for kind in kinds:
+        if kind in text_kinds:
+            m_null = df[kind].isnull()
+            df[kind] = df[kind].astype(str).where(~m_null, None)
+        else:
+            try:
+                df[kind] = pd.to_numeric(df[kind]).astype(float)
+            except ValueError as ve:
+                msg = ("[read_ts_csv] found non-numeric values for kind: {}. "
+                    "file: {}".format(kind, ts_file))
+                raise ValueError(msg) from ve
+
+    return df
+
+def write_store_chunk(df, config, kinds, text_kinds=TEXT_KINDS):
+    """ Write the time series of each stay in `df` to the store
+
+    Parameters
+    ----------
+    df: pd.DataFrame
+        A chunk of the extended list file, with an additional `STAY_ID` column
+
+    config: dict
+        The configuration. In particular, this must include `benchmark_base`
+        and `ts_store`
+
+    kinds: list of strings
+        The kinds of time series
+
+    text_kinds: list of strings
+        The kinds which are recorded as text
+
+    Returns
+    -------
+    df_num_rows: pd.DataFrame
+        A data frame with the `STAY_ID` and `NUM_ROWS` of each stay in `df`
+    """
+    schema = get_schema(kinds, text_kinds)
+    all_num_rows = []
+
+    for split, df_split in df.groupby('SPLIT'):
+        ts_dfs = []
+        for _, row in df_split.iterrows():
+            ts_file = mp_filenames.get_benchmark_ts_raw_filename(
+                benchmark_base=config['benchmark_base'],
+                split=split,
+                subject_id=row['SUBJECT_ID'],
+                episode_id=row['EPISODE']
+            )
+
+            df_ts = read_ts_csv(ts_file, kinds, text_kinds)
+            df_ts = df_ts.sort_values('Hours', kind='mergesort')
+            df_ts.insert(0, 'STAY_ID', row['STAY_ID'])
+            ts_dfs.append(df_ts)
+
+            all_num_rows.append((row['STAY_ID'], len(df_ts)))
+
+        df_ts = pd.concat(ts_dfs)
+        table = pa.Table.from_pandas(df_ts, schema=schema, preserve_index=False)
+
+        # use the first stay in the chunk to identify the part
+        part = int(df_split['STAY_ID'].iloc[0])
+        f = mp_filenames.get_ts_store_part_filename(config['ts_store'], split,
+            part)
+
+        os.makedirs(os.path.dirname(f), exist_ok=True)
+        pq.write_table(table, f)
+
+    df_num_rows = pd.DataFrame(all_num_rows, columns=['STAY_ID', 'NUM_ROWS'])
+    return df_num_rows
+
+###
+# Reading the store
+###
+@functools.lru_cache(maxsize=4)
+def get_stay_index(ts_store) -> pd.DataFrame:
+    """ Load the stay index of the store
+
+    The index is cached since each worker typically reads it many times.
+    """
+    f = mp_filenames.get_ts_store_index_filename(ts_store)
+    df_stay_index = pd.read_csv(f)
+    return df_stay_index
+
+def get_store_kinds(ts_store):
+    """ Read the kinds of time series from the schema of the store
+    """
+    dataset = ds.dataset(
+        mp_filenames.get_ts_store_data_path(ts_store),
+        format='parquet',
+        partitioning='hive'
+    )
+
+    id_columns = {'STAY_ID', 'Hours', 'SPLIT'}
+    kinds = [c for c in dataset.schema.names if c not in id_columns]
+    return kinds
+
+def read_ts_store(ts_store, stay_ids=None, splits=None, columns=None) -> pd.DataFrame:
+    """ Read the (wide) time series data from the store
+
+    The parquet files are memory mapped, and only the row groups which
+    include the selected stays and splits are read.
+
+    Parameters
+    ----------
+    ts_store: path-like (e.g., a string)
+        The path to the base directory of the store
+
+    stay_ids: iterable of ints, or None
+        The `STAY_ID`s to read. By default, all stays are read.
+
+    splits: iterable of strings, or None
+        The splits to read. By default, all splits are read.
+
+    columns: list of strings, or None
+        The columns to read. By default, all columns are read.
+
+    Returns
+    -------
+    df_ts: pd.DataFrame
+        The time series data, with one row for each row in the original
+        `*_timeseries.csv` files
+    """
+    filesystem = pyarrow.fs.LocalFileSystem(use_mmap=True)
+    dataset = ds.dataset(
+        mp_filenames.get_ts_store_data_path(ts_store),
+        format='parquet',
+        partitioning='hive',
+        filesystem=filesystem
+    )
+
+    filters = []
+    if stay_ids is not None:
+        stay_ids = np.asarray(stay_ids, dtype=np.int32)
+        filters.append(ds.field('STAY_ID').isin(stay_ids))
+
+    if splits is not None:
+        filters.append(ds.field('SPLIT').isin(list(splits)))
+
+    f = None
+    if len(filters) > 0:
+        f = functools.reduce(lambda a, b: a & b, filters)
+
+    table = dataset.to_table(columns=columns, filter=f)
+    df_ts = table.to_pandas()
+    return df_ts
+
+def _read_stays(ts_store, stays):
+    df_stay_index = get_stay_index(ts_store)
+    m_stays = df_stay_index['stay'].isin(set(stays))
+    df_stay_index = df_stay_index[m_stays]
+
+    df_ts = read_ts_store(
+        ts_store,
+        stay_ids=df_stay_index['STAY_ID'],
+        splits=df_stay_index['SPLIT'].unique()
+    )
+    df_ts = df_ts.drop(columns=['SPLIT'])
+
+    return df_ts, df_stay_index
+
+def _add_stay_ids(df_stacked, df_stay_index):
+    id_columns = ['STAY_ID', 'stay', 'SUBJECT_ID', 'EPISODE']
+    df_stacked = df_stacked.merge(df_stay_index[id_columns], on='STAY_ID')
+    df_stacked = df_stacked.drop(columns=['STAY_ID'])
+    df_stacked = df_stacked.reset_index(drop=True)
+    return df_stacked
+
+def read_normalized_stacked_ts_data(ts_store, stays, value_table) -> pd.DataFrame:
+    """ Read the time series data for the given stays from the store and
+    convert the text values to numbers while stacking
+
+    Please see `mp_ts_normalization.stack_normalized_ts_data` for details.
+
+    Parameters
+    ----------
+    ts_store: path-like (e.g., a string)
+        The path to the base directory of the store
+
+    stays: iterable of strings
+        The stays (e.g., "12741_episode1_timeseries.csv")
+
+    value_table: dict
+        The result of `mp_ts_normalization.compile_value_mappings`
+
+    Returns
+    -------
+    df_stacked: pd.DataFrame
+        The long-format time series data, with columns `Hours`, `kind`,
+        `num_value`, `stay`, `SUBJECT_ID` and `EPISODE`
+    """
+    df_ts, df_stay_index = _read_stays(ts_store, stays)
+
+    df_stacked = mp_ts_normalization.stack_normalized_ts_data(
+        df_ts, ['STAY_ID', 'Hours'], value_table
+    )
+    df_stacked = _add_stay_ids(df_stacked, df_stay_index)
+
+    return df_stacked
@@ -0,0 +1,320 @@
+###
+# 
+# NAME OF THE PROGRAM THIS FILE BELONGS TO 
+#  
+# file: mimic-preprocessing
+#  
+# Authors: Brandon Malone (Brandon.malone@neclab.eu
+#               Jun Cheng (jun.cheng@neclab.eu)
+# 
+# NEC Laboratories Europe GmbH, Copyright (c) 2020, All rights reserved. 
+#     THIS HEADER MAY NOT BE EXTRACTED OR MODIFIED IN ANY WAY.
+#  
+#     PROPRIETARY INFORMATION --- 
+# 
+# SOFTWARE LICENSE AGREEMENT
+# ACADEMIC OR NON-PROFIT ORGANIZATION NONCOMMERCIAL RESEARCH USE ONLY
+# BY USING OR DOWNLOADING THE SOFTWARE, YOU ARE AGREEING TO THE TERMS OF THIS LICENSE AGREEMENT.  IF YOU DO NOT AGREE WITH THESE TERMS, YOU MAY NOT USE OR DOWNLOAD THE SOFTWARE.
+# 
+# This is a license agreement ("Agreement") between your academic institution or non-profit organization or self (called "Licensee" or "You" in this Agreement) and NEC Laboratories Europe GmbH (called "Licensor" in this Agreement).  All rights not specifically granted to you in this Agreement are reserved for Licensor. 
+# RESERVATION OF OWNERSHIP AND GRANT OF LICENSE: Licensor retains exclusive ownership of any copy of the Software (as defined below) licensed under this Agreement and hereby grants to Licensee a personal, non-exclusive, non-transferable license to use the Software for noncommercial research purposes, without the right to sublicense, pursuant to the terms and conditions of this Agreement. NO EXPRESS OR IMPLIED LICENSES TO ANY OF LICENSOR’S PATENT RIGHTS ARE GRANTED BY THIS LICENSE. As used in this Agreement, the term "Software" means (i) the actual copy of all or any portion of code for program routines made accessible to Licensee by Licensor pursuant to this Agreement, inclusive of backups, updates, and/or merged copies permitted hereunder or subsequently supplied by Licensor,  including all or any file structures, programming instructions, user interfaces and screen formats and sequences as well as any and all documentation and instructions related to it, and (ii) all or any derivatives and/or modifications created or made by You to any of the items specified in (i).
+# CONFIDENTIALITY/PUBLICATIONS: Licensee acknowledges that the Software is proprietary to Licensor, and as such, Licensee agrees to receive all such materials and to use the Software only in accordance with the terms of this Agreement.  Licensee agrees to use reasonable effort to protect the Software from unauthorized use, reproduction, distribution, or publication. All publication materials mentioning features or use of this software must explicitly include an acknowledgement the software was developed by NEC Laboratories Europe GmbH.
+# COPYRIGHT: The Software is owned by Licensor.  
+# PERMITTED USES:  The Software may be used for your own noncommercial internal research purposes. You understand and agree that Licensor is not obligated to implement any suggestions and/or feedback you might provide regarding the Software, but to the extent Licensor does so, you are not entitled to any compensation related thereto.
+# DERIVATIVES: You may create derivatives of or make modifications to the Software, however, You agree that all and any such derivatives and modifications will be owned by Licensor and become a part of the Software licensed to You under this Agreement.  You may only use such derivatives and modifications for your own noncommercial internal research purposes, and you may not otherwise use, distribute or copy such derivatives and modifications in violation of this Agreement.
+# BACKUPS:  If Licensee is an organization, it may make that number of copies of the Software necessary for internal noncommercial use at a single site within its organization provided that all information appearing in or on the original labels, including the copyright and trademark notices are copied onto the labels of the copies.
+# USES NOT PERMITTED:  You may not distribute, copy or use the Software except as explicitly permitted herein. Licensee has not been granted any trademark license as part of this Agreement. Neither the name of NEC Laboratories Europe GmbH nor the names of its contributors may be used to endorse or promote products derived from this Software without specific prior written permission.
+# You may not sell, rent, lease, sublicense, lend, time-share or transfer, in whole or in part, or provide third parties access to prior or present versions (or any parts thereof) of the Software.
+# ASSIGNMENT: You may not assign this Agreement or your rights hereunder without the prior written consent of Licensor. Any attempted assignment without such consent shall be null and void.
+# TERM: The term of the license granted by this Agreement is from Licensee's acceptance of this Agreement by downloading the Software or by using the Software until terminated as provided below.
+# The Agreement automatically terminates without notice if you fail to comply with any provision of this Agreement.  Licensee may terminate this Agreement by ceasing using the Software.  Upon any termination of this Agreement, Licensee will delete any and all copies of the Software. You agree that all provisions which operate to protect the proprietary rights of Licensor shall remain in force should breach occur and that the obligation of confidentiality described in this Agreement is binding in perpetuity and, as such, survives the term of the Agreement.
+# FEE: Provided Licensee abides completely by the terms and conditions of this Agreement, there is no fee due to Licensor for Licensee's use of the Software in accordance with this Agreement.
+# DISCLAIMER OF WARRANTIES:  THE SOFTWARE IS PROVIDED "AS-IS" WITHOUT WARRANTY OF ANY KIND INCLUDING ANY WARRANTIES OF PERFORMANCE OR MERCHANTABILITY OR FITNESS FOR A PARTICULAR USE OR PURPOSE OR OF NON-INFRINGEMENT.  LICENSEE BEARS ALL RISK RELATING TO QUALITY AND PERFORMANCE OF THE SOFTWARE AND RELATED MATERIALS.
+# SUPPORT AND MAINTENANCE: No Software support or training by the Licensor is provided as part of this Agreement.  
+# EXCLUSIVE REMEDY AND LIMITATION OF LIABILITY: To the maximum extent permitted under applicable law, Licensor shall not be liable for direct, indirect, special, incidental, or consequential damages or lost profits related to Licensee's use of and/or inability to use the Software, even if Licensor is advised of the possibility of such damage.
+# EXPORT REGULATION: Licensee agrees to comply with any and all applicable export control laws, regulations, and/or other laws related to embargoes and sanction programs administered by law.
+# SEVERABILITY: If any provision(s) of this Agreement shall be held to be invalid, illegal, or unenforceable by a court or other tribunal of competent jurisdiction, the validity, legality and enforceability of the remaining provisions shall not in any way be affected or impaired thereby.
+# NO IMPLIED WAIVERS: No failure or delay by Licensor in enforcing any right or remedy under this Agreement shall be construed as a waiver of any future or other exercise of such right or remedy by Licensor.
+# GOVERNING LAW: This Agreement shall be construed and enforced in accordance with the laws of Germany without reference to conflict of laws principles.  You consent to the personal jurisdiction of the courts of this country and waive their rights to venue outside of Germany.
+# ENTIRE AGREEMENT AND AMENDMENTS: This Agreement constitutes the sole and entire agreement between Licensee and Licensor as to the matter set forth herein and supersedes any previous agreements, understandings, and arrangements between the parties relating hereto.
+###
+""" This module contains helpers to write and read the hourly-binned time
+series tensors.
+
+The tensors contain the time series of each stay as dense (hours x kinds)
+arrays. They consist of:
+
+    * a float32 array of shape (num_stays, num_hours, num_kinds) with the
+      value of each kind in each hour. Hours without an observation of the
+      kind are `np.nan`.
+
+    * a uint8 array of the same shape which is 1 for each (hour, kind) with
+      at least one observation, and 0 otherwise.
+
+    * a stay index (csv) with the `ROW`, `stay`, `SUBJECT_ID`, `EPISODE` and
+      `SPLIT` of each stay. `ROW` is the index of the stay in the first axis
+      of the arrays.
+
+    * the kinds (csv), in the order of the last axis of the arrays.
+
+Both arrays are `.npy` files, so they can be memory mapped with
+`np.load(..., mmap_mode='r')`. The values are read from the columnar time
+series store (see `mp_ts_store`).
+"""
+import numpy as np
+import pandas as pd
+
+import mimic_preprocessing.mp_filenames as mp_filenames
+import mimic_preprocessing.mp_ts_store as mp_ts_store
+
+STAY_INDEX_COLUMNS = [
+    'ROW',
+    'stay',
+    'SUBJECT_ID',
+    'EPISODE',
+    'SPLIT'
+]
+
+VALID_AGGREGATIONS = [
+    'last',
+    'mean'
+]
+
+###
+# Binning
+###
+def bin_ts_data(rows, kind_codes, times, values, num_rows, num_hours,
+        num_kinds, aggregation='last'):
+    """ Bin the observations into dense (rows x hours x kinds) arrays
+
+    Each observation is assigned to the hour `floor(time)`. Observations
+    before hour 0 or after `num_hours` are ignored.
+
+    Parameters
+    ----------
+    rows, kind_codes: np.arrays of ints
+        The row (stay) and kind of each observation
+
+    times, values: np.arrays of floats
+        The time (in hours) and (numeric) value of each observation.
+        Observations with a missing value are ignored.
+
+    num_{rows,hours,kinds}: ints
+        The shape of the arrays
+
+    aggregation: string
+        How to combine several observations of the same kind in one hour.
+        "last" uses the last observation (as in the discretizer of
+        Harutyunyan et al.), while "mean" uses the mean of the observations.
+
+    Returns
+    -------
+    ts_values: np.array of np.float32
+        The binned values, with shape (num_rows, num_hours, num_kinds)
+
+    ts_mask: np.array of np.uint8
+        1 for each observed (row, hour, kind), and 0 otherwise
+    """
+    if aggregation not in VALID_AGGREGATIONS:
+        msg = ("[mp_ts_tensor.bin_ts_data] invalid aggregation: {}. valid "
+            "aggregations are: {}".format(aggregation, VALID_AGGREGATIONS))
+        raise ValueError(msg)
+
+    hours = np.floor(times)
+    m_valid = (
+        ~np.isnan(values) &
+        (hours >= 0) &
+        (hours < num_hours)
+    )
+
+    rows = rows[m_valid]
+    kind_codes = kind_codes[m_valid]
+    times = times[m_valid]
+    values = values[m_valid]
+    hours = hours[m_valid].astype(np.int64)
+
+    # the flat index of the cell of each observation
+    cells = (rows * num_hours + hours) * num_kinds + kind_codes
+    num_cells = num_rows * num_hours * num_kinds
+
+    counts = np.bincount(cells, minlength=num_cells)
+    m_observed = counts > 0
+
+    ts_values = np.full(num_cells, np.nan, dtype=np.float32)
+
+    if aggregation == 'mean':
+        sums = np.bincount(cells, weights=values, minlength=num_cells)
+        ts_values[m_observed] = sums[m_observed] / counts[m_observed]
+    else:
+        # sort by (cell, time) and keep the last observation of each cell
+        order = np.lexsort((times, cells))
+        sorted_cells = cells[order]
+        m_last = np.ones(len(order), dtype=bool)
+        m_last[:-1] = sorted_cells[1:] != sorted_cells[:-1]
+        last = order[m_last]
+        ts_values[cells[last]] = values[last]
+
+    shape = (num_rows, num_hours, num_kinds)
+    ts_values = ts_values.reshape(shape)
+    ts_mask = m_observed.astype(np.uint8).reshape(shape)
+
+    return ts_values, ts_mask
+
+###
+# Writing the tensors
+###
+def create_tensor_files(ts_tensor, num_stays, num_hours, num_kinds):
+    """ Create the (empty) memory-mapped arrays for the tensors
+
+    The values are initialized to `np.nan` and the mask to 0, so rows which
+    are never written contain no observations.
+    """
+    shape = (num_stays, num_hours, num_kinds)
+
+    f = mp_filenames.get_ts_tensor_filename(ts_tensor, 'values')
+    ts_values = np.lib.format.open_memmap(f, mode='w+', dtype=np.float32,
+        shape=shape)
+    ts_values[:] = np.nan
+    ts_values.flush()
+
+    f = mp_filenames.get_ts_tensor_filename(ts_tensor, 'mask')
+    ts_mask = np.lib.format.open_memmap(f, mode='w+', dtype=np.uint8,
+        shape=shape)
+    ts_mask.flush()
+
+def write_tensor_chunk(df, config, kinds, value_table, aggregation='last'):
+    """ Bin the time series of each stay in `df` and write them to the rows
+    of the memory-mapped arrays
+
+    Parameters
+    ----------
+    df: pd.DataFrame
+        A chunk of the stay index, including the `ROW` and `stay` columns
+
+    config: dict
+        The configuration. In particular, this must include `ts_store` and
+        `ts_tensor`
+
+    kinds: list of strings
+        The kinds of time series, in the order of the last axis of the arrays
+
+    value_table: dict
+        The result of `mp_ts_normalization.compile_value_mappings`
+
+    aggregation: string
+        How to combine several observations in one hour. Please see
+        `bin_ts_data` for details.
+
+    Returns
+    -------
+    num_observations: int
+        The number of observed (stay, hour, kind) cells in the chunk
+    """
+    df_ts_data = mp_ts_store.read_normalized_stacked_ts_data(
+        config['ts_store'], df['stay'], value_table
+    )
+
+    ts_values = load_ts_tensor(config['ts_tensor'], 'values', mmap_mode='r+')
+    ts_mask = load_ts_tensor(config['ts_tensor'], 'mask', mmap_mode='r+')
+    _, num_hours, num_kinds = ts_values.shape
+
+    # rows within the chunk
+    rows = pd.Index(df['stay']).get_indexer(df_ts_data['stay'])
+    kind_codes = pd.Categorical(df_ts_data['kind'], categories=kinds).codes
+
+    m_known = (rows >= 0) & (kind_codes >= 0)
+
+    chunk_values, chunk_mask = bin_ts_data(
+        rows[m_known].astype(np.int64),
+        kind_codes[m_known].astype(np.int64),
+        df_ts_data['Hours'].to_numpy(dtype=float)[m_known],
+        df_ts_data['num_value'].to_numpy(dtype=float)[m_known],
+        num_rows=len(df),
+        num_hours=num_hours,
+        num_kinds=num_kinds,
+        aggregation=aggregation
+    )
+
+    chunk_rows = df['ROW'].to_numpy()
+    ts_values[chunk_rows] = chunk_values
+    ts_mask[chunk_rows] = chunk_mask
+
+    ts_values.flush()
+    ts_mask.flush()
+
+    num_observations = int(chunk_mask.sum(dtype=np.int64))
+    return num_observations
+
+###
+# Reading the tensors
+###
+def load_ts_tensor(ts_tensor, note, mmap_mode='r'):
+    """ Load (memory map) one of the arrays of the tensors
+
+    Parameters
+    ----------
+    ts_tensor: path-like (e.g., a string)
+        The path to the base directory of the tensors
+
+    note: string
+        The array. This should be either "values" or "mask".
+
+    mmap_mode: string or None
+        The `mmap_mode` for `np.load`. Use `None` to read the entire array
+        into memory.
+
+    Returns
+    -------
+    tensor: np.array or np.memmap
+        The array, with shape (num_stays, num_hours, num_kinds)
+    """
+    f = mp_filenames.get_ts_tensor_filename(ts_tensor, note)
+    tensor = np.load(f, mmap_mode=mmap_mode)
+    return tensor
+
+def get_stay_index(ts_tensor) -> pd.DataFrame:
+    """ Load the stay index of the tensors
+    """
+    f = mp_filenames.get_ts_tensor_index_filename(ts_tensor)
+    df_stay_index = pd.read_csv(f)
+    return df_stay_index
+
+def get_kinds(ts_tensor):
+    """ Load the kinds of time series, in the order of the last axis of the
+    tensors
+    """
+    f = mp_filenames.get_ts_tensor_kinds_filename(ts_tensor)
+    kinds = pd.read_csv(f)['kind'].tolist()
+    return kinds
+
+def read_ts_tensor(ts_tensor, stays=None):
+    """ Read the binned values and observation mask for the given stays
+
+    Parameters
+    ----------
+    ts_tensor: path-like (e.g., a string)
+        The path to the base directory of the tensors
+
+    stays: iterable of strings, or None
+        The stays (e.g., "12741_episode1_timeseries.csv"). By default, all
+        stays are read.
+
+    Returns
+    -------
+    ts_values, ts_mask: np.arrays
+        The values and mask for the stays, in the order of `stays`
+
+    kinds: list of strings
+        The kinds of time series, in the order of the last axis of the arrays
+    """
+    ts_values = load_ts_tensor(ts_tensor, 'values')
+    ts_mask = load_ts_tensor(ts_tensor, 'mask')
+
+    if stays is not None:
+        df_stay_index = get_stay_index(ts_tensor).set_index('stay')
+        rows = df_stay_index.loc[list(stays), 'ROW'].to_numpy()
+        ts_values = ts_values[rows]
+        ts_mask = ts_mask[rows]
+
+    kinds = get_kinds(ts_tensor)
+    return ts_values, ts_mask, kinds
@@ -0,0 +1,274 @@
+###
+# 
+# NAME OF THE PROGRAM THIS FILE BELONGS TO 
+#  
+# file: mimic-preprocessing
+#  
+# Authors: Brandon Malone (Brandon.malone@neclab.eu
+#               Jun Cheng (jun.cheng@neclab.eu)
+# 
+# NEC Laboratories Europe GmbH, Copyright (c) 2020, All rights reserved. 
+#     THIS HEADER MAY NOT BE EXTRACTED OR MODIFIED IN ANY WAY.
+#  
+#     PROPRIETARY INFORMATION --- 
+# 
+# SOFTWARE LICENSE AGREEMENT
+# ACADEMIC OR NON-PROFIT ORGANIZATION NONCOMMERCIAL RESEARCH USE ONLY
+# BY USING OR DOWNLOADING THE SOFTWARE, YOU ARE AGREEING TO THE TERMS OF THIS LICENSE AGREEMENT.  IF YOU DO NOT AGREE WITH THESE TERMS, YOU MAY NOT USE OR DOWNLOAD THE SOFTWARE.
+# 
+# This is a license agreement ("Agreement") between your academic institution or non-profit organization or self (called "Licensee" or "You" in this Agreement) and NEC Laboratories Europe GmbH (called "Licensor" in this Agreement).  All rights not specifically granted to you in this Agreement are reserved for Licensor. 
+# RESERVATION OF OWNERSHIP AND GRANT OF LICENSE: Licensor retains exclusive ownership of any copy of the Software (as defined below) licensed under this Agreement and hereby grants to Licensee a personal, non-exclusive, non-transferable license to use the Software for noncommercial research purposes, without the right to sublicense, pursuant to the terms and conditions of this Agreement. NO EXPRESS OR IMPLIED LICENSES TO ANY OF LICENSOR’S PATENT RIGHTS ARE GRANTED BY THIS LICENSE. As used in this Agreement, the term "Software" means (i) the actual copy of all or any portion of code for program routines made accessible to Licensee by Licensor pursuant to this Agreement, inclusive of backups, updates, and/or merged copies permitted hereunder or subsequently supplied by Licensor,  including all or any file structures, programming instructions, user interfaces and screen formats and sequences as well as any and all documentation and instructions related to it, and (ii) all or any derivatives and/or modifications created or made by You to any of the items specified in (i).
+# CONFIDENTIALITY/PUBLICATIONS: Licensee acknowledges that the Software is proprietary to Licensor, and as such, Licensee agrees to receive all such materials and to use the Software only in accordance with the terms of this Agreement.  Licensee agrees to use reasonable effort to protect the Software from unauthorized use, reproduction, distribution, or publication. All publication materials mentioning features or use of this software must explicitly include an acknowledgement the software was developed by NEC Laboratories Europe GmbH.
+# COPYRIGHT: The Software is owned by Licensor.  
+# PERMITTED USES:  The Software may be used for your own noncommercial internal research purposes. You understand and agree that Licensor is not obligated to implement any suggestions and/or feedback you might provide regarding the Software, but to the extent Licensor does so, you are not entitled to any compensation related thereto.
+# DERIVATIVES: You may create derivatives of or make modifications to the Software, however, You agree that all and any such derivatives and modifications will be owned by Licensor and become a part of the Software licensed to You under this Agreement.  You may only use such derivatives and modifications for your own noncommercial internal research purposes, and you may not otherwise use, distribute or copy such derivatives and modifications in violation of this Agreement.
+# BACKUPS:  If Licensee is an organization, it may make that number of copies of the Software necessary for internal noncommercial use at a single site within its organization provided that all information appearing in or on the original labels, including the copyright and trademark notices are copied onto the labels of the copies.
+# USES NOT PERMITTED:  You may not distribute, copy or use the Software except as explicitly permitted herein. Licensee has not been granted any trademark license as part of this Agreement. Neither the name of NEC Laboratories Europe GmbH nor the names of its contributors may be used to endorse or promote products derived from this Software without specific prior written permission.
+# You may not sell, rent, lease, sublicense, lend, time-share or transfer, in whole or in part, or provide third parties access to prior or present versions (or any parts thereof) of the Software.
+# ASSIGNMENT: You may not assign this Agreement or your rights hereunder without the prior written consent of Licensor. Any attempted assignment without such consent shall be null and void.
+# TERM: The term of the license granted by this Agreement is from Licensee's acceptance of this Agreement by downloading the Software or by using the Software until terminated as provided below.
+# The Agreement automatically terminates without notice if you fail to comply with any provision of this Agreement.  Licensee may terminate this Agreement by ceasing using the Software.  Upon any termination of this Agreement, Licensee will delete any and all copies of the Software. You agree that all provisions which operate to protect the proprietary rights of Licensor shall remain in force should breach occur and that the obligation of confidentiality described in this Agreement is binding in perpetuity and, as such, survives the term of the Agreement.
+# FEE: Provided Licensee abides completely by the terms and conditions of this Agreement, there is no fee due to Licensor for Licensee's use of the Software in accordance with this Agreement.
+# DISCLAIMER OF WARRANTIES:  THE SOFTWARE IS PROVIDED "AS-IS" WITHOUT WARRANTY OF ANY KIND INCLUDING ANY WARRANTIES OF PERFORMANCE OR MERCHANTABILITY OR FITNESS FOR A PARTICULAR USE OR PURPOSE OR OF NON-INFRINGEMENT.  LICENSEE BEARS ALL RISK RELATING TO QUALITY AND PERFORMANCE OF THE SOFTWARE AND RELATED MATERIALS.
+# SUPPORT AND MAINTENANCE: No Software support or training by the Licensor is provided as part of this Agreement.  
+# EXCLUSIVE REMEDY AND LIMITATION OF LIABILITY: To the maximum extent permitted under applicable law, Licensor shall not be liable for direct, indirect, special, incidental, or consequential damages or lost profits related to Licensee's use of and/or inability to use the Software, even if Licensor is advised of the possibility of such damage.
+# EXPORT REGULATION: Licensee agrees to comply with any and all applicable export control laws, regulations, and/or other laws related to embargoes and sanction programs administered by law.
+# SEVERABILITY: If any provision(s) of this Agreement shall be held to be invalid, illegal, or unenforceable by a court or other tribunal of competent jurisdiction, the validity, legality and enforceability of the remaining provisions shall not in any way be affected or impaired thereby.
+# NO IMPLIED WAIVERS: No failure or delay by Licensor in enforcing any right or remedy under this Agreement shall be construed as a waiver of any future or other exercise of such right or remedy by Licensor.
+# GOVERNING LAW: This Agreement shall be construed and enforced in accordance with the laws of Germany without reference to conflict of laws principles.  You consent to the personal jurisdiction of the courts of this country and waive their rights to venue outside of Germany.
+# ENTIRE AGREEMENT AND AMENDMENTS: This Agreement constitutes the sole and entire agreement between Licensee and Licensor as to the matter set forth herein and supersedes any previous agreements, understandings, and arrangements between the parties relating hereto.
+###
+""" Derive a pruned vocabulary for new `min_df` and `max_df` thresholds and
+recreate the bags of words for each episode, without cleaning the notes again.
+
+`create-mimic-notes-bow` (with the count vectorizer) must be run first. It
+writes the raw, unpruned document frequencies of all tokens and a token store
+with the unpruned (chunk-local) token ids of each note. This script prunes the
+document frequencies, remaps the token ids of each note to the new vocabulary
+and then combines the notes for each episode as in `create-mimic-notes-bow`.
+
+The count vectorizer, the bag-of-words store, the combined notes and the
+final records of each episode are replaced. The episodes are taken from the
+existing complete dataset.
+"""
+import logging
+import pyllars.logging_utils as logging_utils
+logger = logging.getLogger(__name__)
+
+import argparse
+import joblib
+import numpy as np
+import pandas as pd
+import pyllars.dask_utils as dask_utils
+import pyllars.utils
+
+from pyllars.sklearn_transformers.incremental_count_vectorizer import IncrementalCountVectorizer
+
+import mimic_preprocessing.create_mimic_notes_bow as create_mimic_notes_bow
+import mimic_preprocessing.mp_broadcast as mp_broadcast
+import mimic_preprocessing.mp_filenames as mp_filenames
+import mimic_preprocessing.mp_note_store as mp_note_store
+import mimic_preprocessing.mp_notes_matrix as mp_notes_matrix
+import mimic_preprocessing.mp_notes_nlp as mp_notes_nlp
+
+from mimic_preprocessing.create_mimic_notes_bow import NOTE_CLEANED_BOW
+from mimic_preprocessing.create_mimic_notes_bow import NOTE_CLEANED_TOKENS
+from mimic_preprocessing.create_mimic_notes_bow import NOTE_TYPES
+
+def get_pruned_count_vectorizer(document_frequencies, min_df, max_df):
+    """ Create a count vectorizer from the raw document frequencies using
+    the given thresholds
+    """
+    icv = IncrementalCountVectorizer(
+        min_df=min_df,
+        max_df=max_df,
+        num_docs=document_frequencies['num_docs'],
+        token_count=dict(document_frequencies['token_count']),
+        get_tokens=create_mimic_notes_bow.get_tokens
+    )
+
+    icv.prune_tokens()
+    icv.create_token_mapping()
+    return icv
+
+def process_batch_remap(df_batch, config, vocabulary, num_partitions=1):
+    """ Remap the unpruned token ids in a batch of shards of the token store
+    to the new vocabulary (a `CompactVocabulary`) and write them to the same
+    batch of the (partitioned) bag-of-words store
+    """
+    note_store_path = create_mimic_notes_bow.get_note_store_path(
+        config, NOTE_CLEANED_TOKENS
+    )
+
+    all_notes = []
+    for shard in np.unique(df_batch['SHARD']):
+        shard = int(shard)
+        df_notes = mp_note_store.read_note_shard(note_store_path, shard)
+
+        chunk_tokens = {
+            'vocabulary': mp_note_store.read_note_vocabulary(
+                note_store_path, shard
+            ),
+            'token_ids': [
+                np.array(ids, dtype=np.int64) for ids in df_notes['TEXT']
+            ]
+        }
+
+        df_notes['TEXT'] = mp_notes_nlp.transform_chunk_tokens(
+            chunk_tokens, vocabulary
+        )
+        all_notes.append(df_notes)
+
+    df_notes = pd.concat(all_notes, ignore_index=True)
+
+    note_store_path = create_mimic_notes_bow.get_note_store_path(
+        config, NOTE_CLEANED_BOW
+    )
+    batch = int(df_batch['SHARD'].min())
+    df_index = mp_note_store.write_note_partitions(
+        df_notes, note_store_path, batch, num_partitions
+    )
+    return df_index
+
+def load_episodes(args, config):
+    """ Load the episodes (without the bags of words) of the existing
+    complete dataset
+    """
+    notes_bow_format = args.notes_bow_format
+    if notes_bow_format is None:
+        notes_bow_format = mp_notes_matrix.get_notes_bow_format(config)
+
+    if notes_bow_format == 'npz':
+        f = mp_filenames.get_notes_bow_matrix_filename(
+            config['complete_episodes'], "episodes"
+        )
+        df_episodes = pd.read_csv(f)
+    else:
+        df_episodes = joblib.load(config['complete_episodes'])
+        df_episodes = df_episodes.drop(columns=NOTE_TYPES)
+
+    return df_episodes
+
+###
+# The main program
+###
+def parse_arguments() -> argparse.Namespace:
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description=__doc__
+    )
+
+    parser.add_argument('config', help="The path to the yaml configuration "
+        "file.")
+
+    parser.add_argument('--min-df', type=float, default=None, help="The "
+        "minimum document frequency of the kept tokens. As for the count "
+        "vectorizer, values of at most 1 are fractions of the number of "
+        "notes. Default: min_df from the config.")
+
+    parser.add_argument('--max-df', type=float, default=None, help="The "
+        "maximum document frequency of the kept tokens. Default: max_df from "
+        "the config.")
+
+    parser.add_argument('--chunk-size', type=int, default=100, help="The size "
+        "of chunks for parallelization")
+
+    parser.add_argument('--num-partitions', type=int, default=None,
+        help="The number of partitions (by HADM_ID) of the bag-of-words "
+        "store. Default: one partition for each thread of the dask workers.")
+
+    parser.add_argument('--partition-file-size', type=int,
+        default=create_mimic_notes_bow.DEFAULT_PARTITION_FILE_SIZE,
+        help="The (approximate) number of notes in each file of the "
+        "bag-of-words store")
+
+    parser.add_argument('--notes-bow-format', default=None,
+        choices=mp_notes_matrix.VALID_FORMATS, help="The format of the "
+        "complete dataset (for both the existing episodes and the output). "
+        "Default: notes_bow_format from the config, or \"jpkl\".")
+
+    dask_utils.add_dask_options(parser)
+    logging_utils.add_logging_options(parser)
+    args = parser.parse_args()
+    logging_utils.update_logging(args)
+    return args
+
+def main():
+    args = parse_arguments()
+    config = pyllars.utils.load_config(args.config)
+
+    # the thresholds are written with the count vectorizer
+    args.vectorizer = 'count'
+
+    min_df = args.min_df
+    if min_df is None:
+        min_df = config['min_df']
+
+    max_df = args.max_df
+    if max_df is None:
+        max_df = config['max_df']
+
+    msg = "Connecting to dask client"
+    logger.info(msg)
+    client, cluster = dask_utils.connect(args)
+
+    f = mp_filenames.get_mimic_notes_document_frequencies_filename(
+        config['analysis_basepath']
+    )
+    msg = "Loading the raw document frequencies: '{}'".format(f)
+    logger.info(msg)
+    document_frequencies = mp_notes_nlp.load_document_frequencies(f)
+
+    icv_fit = get_pruned_count_vectorizer(document_frequencies, min_df, max_df)
+
+    msg = "Keeping {} of {} tokens with min_df: {}, max_df: {}".format(
+        len(icv_fit.token_mapping_), len(document_frequencies['token_count']),
+        min_df, max_df)
+    logger.info(msg)
+    create_mimic_notes_bow.write_vectorizer(icv_fit, args, config)
+
+    msg = "Loading the episodes from the complete dataset: '{}'".format(
+        config['complete_episodes'])
+    logger.info(msg)
+    df_episodes = load_episodes(args, config)
+    args.num_partitions = create_mimic_notes_bow.get_num_partitions(
+        args, client
+    )
+
+    msg = "Remapping the bag-of-words for the notes"
+    logger.info(msg)
+    note_store_path = create_mimic_notes_bow.get_note_store_path(
+        config, NOTE_CLEANED_TOKENS
+    )
+    df_index = mp_note_store.load_note_index(note_store_path)
+
+    note_store_path = create_mimic_notes_bow.get_note_store_path(
+        config, NOTE_CLEANED_BOW
+    )
+    mp_note_store.remove_note_store(note_store_path)
+
+    g_batches = mp_note_store.get_batch_groups(
+        df_index, create_mimic_notes_bow.get_batch_num_chunks(args)
+    )
+    all_index_dfs = dask_utils.apply_groups(
+        g_batches,
+        client,
+        process_batch_remap,
+        mp_broadcast.broadcast(client, config),
+        create_mimic_notes_bow.get_shared_vectorizer(icv_fit, client),
+        args.num_partitions,
+        progress_bar=True
+    )
+    df_index = mp_note_store.write_note_index(all_index_dfs, note_store_path)
+
+    msg = "Combining bag-of-words types per episode"
+    logger.info(msg)
+    create_mimic_notes_bow.combine_episode_notes(df_index, args, config, client)
+
+    create_mimic_notes_bow.write_complete_dataset(
+        df_episodes, args, config, client
+    )
+
+if __name__ == '__main__':
+    main()
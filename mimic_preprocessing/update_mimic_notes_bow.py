@@ -0,0 +1,558 @@
+###
+# 
+# NAME OF THE PROGRAM THIS FILE BELONGS TO 
+#  
+# file: mimic-preprocessing
+#  
+# Authors: Brandon Malone (Brandon.malone@neclab.eu
+#               Jun Cheng (jun.cheng@neclab.eu)
+# 
+# NEC Laboratories Europe GmbH, Copyright (c) 2020, All rights reserved. 
+#     THIS HEADER MAY NOT BE EXTRACTED OR MODIFIED IN ANY WAY.
+#  
+#     PROPRIETARY INFORMATION --- 
+# 
+# SOFTWARE LICENSE AGREEMENT
+# ACADEMIC OR NON-PROFIT ORGANIZATION NONCOMMERCIAL RESEARCH USE ONLY
+# BY USING OR DOWNLOADING THE SOFTWARE, YOU ARE AGREEING TO THE TERMS OF THIS LICENSE AGREEMENT.  IF YOU DO NOT AGREE WITH THESE TERMS, YOU MAY NOT USE OR DOWNLOAD THE SOFTWARE.
+# 
+# This is a license agreement ("Agreement") between your academic institution or non-profit organization or self (called "Licensee" or "You" in this Agreement) and NEC Laboratories Europe GmbH (called "Licensor" in this Agreement).  All rights not specifically granted to you in this Agreement are reserved for Licensor. 
+# RESERVATION OF OWNERSHIP AND GRANT OF LICENSE: Licensor retains exclusive ownership of any copy of the Software (as defined below) licensed under this Agreement and hereby grants to Licensee a personal, non-exclusive, non-transferable license to use the Software for noncommercial research purposes, without the right to sublicense, pursuant to the terms and conditions of this Agreement. NO EXPRESS OR IMPLIED LICENSES TO ANY OF LICENSOR’S PATENT RIGHTS ARE GRANTED BY THIS LICENSE. As used in this Agreement, the term "Software" means (i) the actual copy of all or any portion of code for program routines made accessible to Licensee by Licensor pursuant to this Agreement, inclusive of backups, updates, and/or merged copies permitted hereunder or subsequently supplied by Licensor,  including all or any file structures, programming instructions, user interfaces and screen formats and sequences as well as any and all documentation and instructions related to it, and (ii) all or any derivatives and/or modifications created or made by You to any of the items specified in (i).
+# CONFIDENTIALITY/PUBLICATIONS: Licensee acknowledges that the Software is proprietary to Licensor, and as such, Licensee agrees to receive all such materials and to use the Software only in accordance with the terms of this Agreement.  Licensee agrees to use reasonable effort to protect the Software from unauthorized use, reproduction, distribution, or publication. All publication materials mentioning features or use of this software must explicitly include an acknowledgement the software was developed by NEC Laboratories Europe GmbH.
+# COPYRIGHT: The Software is owned by Licensor.  
+# PERMITTED USES:  The Software may be used for your own noncommercial internal research purposes. You understand and agree that Licensor is not obligated to implement any suggestions and/or feedback you might provide regarding the Software, but to the extent Licensor does so, you are not entitled to any compensation related thereto.
+# DERIVATIVES: You may create derivatives of or make modifications to the Software, however, You agree that all and any such derivatives and modifications will be owned by Licensor and become a part of the Software licensed to You under this Agreement.  You may only use such derivatives and modifications for your own noncommercial internal research purposes, and you may not otherwise use, distribute or copy such derivatives and modifications in violation of this Agreement.
+# BACKUPS:  If Licensee is an organization, it may make that number of copies of the Software necessary for internal noncommercial use at a single site within its organization provided that all information appearing in or on the original labels, including the copyright and trademark notices are copied onto the labels of the copies.
+# USES NOT PERMITTED:  You may not distribute, copy or use the Software except as explicitly permitted herein. Licensee has not been granted any trademark license as part of this Agreement. Neither the name of NEC Laboratories Europe GmbH nor the names of its contributors may be used to endorse or promote products derived from this Software without specific prior written permission.
+# You may not sell, rent, lease, sublicense, lend, time-share or transfer, in whole or in part, or provide third parties access to prior or present versions (or any parts thereof) of the Software.
+# ASSIGNMENT: You may not assign this Agreement or your rights hereunder without the prior written consent of Licensor. Any attempted assignment without such consent shall be null and void.
+# TERM: The term of the license granted by this Agreement is from Licensee's acceptance of this Agreement by downloading the Software or by using the Software until terminated as provided below.
+# The Agreement automatically terminates without notice if you fail to comply with any provision of this Agreement.  Licensee may terminate this Agreement by ceasing using the Software.  Upon any termination of this Agreement, Licensee will delete any and all copies of the Software. You agree that all provisions which operate to protect the proprietary rights of Licensor shall remain in force should breach occur and that the obligation of confidentiality described in this Agreement is binding in perpetuity and, as such, survives the term of the Agreement.
+# FEE: Provided Licensee abides completely by the terms and conditions of this Agreement, there is no fee due to Licensor for Licensee's use of the Software in accordance with this Agreement.
+# DISCLAIMER OF WARRANTIES:  THE SOFTWARE IS PROVIDED "AS-IS" WITHOUT WARRANTY OF ANY KIND INCLUDING ANY WARRANTIES OF PERFORMANCE OR MERCHANTABILITY OR FITNESS FOR A PARTICULAR USE OR PURPOSE OR OF NON-INFRINGEMENT.  LICENSEE BEARS ALL RISK RELATING TO QUALITY AND PERFORMANCE OF THE SOFTWARE AND RELATED MATERIALS.
+# SUPPORT AND MAINTENANCE: No Software support or training by the Licensor is provided as part of this Agreement.  
+# EXCLUSIVE REMEDY AND LIMITATION OF LIABILITY: To the maximum extent permitted under applicable law, Licensor shall not be liable for direct, indirect, special, incidental, or consequential damages or lost profits related to Licensee's use of and/or inability to use the Software, even if Licensor is advised of the possibility of such damage.
+# EXPORT REGULATION: Licensee agrees to comply with any and all applicable export control laws, regulations, and/or other laws related to embargoes and sanction programs administered by law.
+# SEVERABILITY: If any provision(s) of this Agreement shall be held to be invalid, illegal, or unenforceable by a court or other tribunal of competent jurisdiction, the validity, legality and enforceability of the remaining provisions shall not in any way be affected or impaired thereby.
+# NO IMPLIED WAIVERS: No failure or delay by Licensor in enforcing any right or remedy under this Agreement shall be construed as a waiver of any future or other exercise of such right or remedy by Licensor.
+# GOVERNING LAW: This Agreement shall be construed and enforced in accordance with the laws of Germany without reference to conflict of laws principles.  You consent to the personal jurisdiction of the courts of this country and waive their rights to venue outside of Germany.
+# ENTIRE AGREEMENT AND AMENDMENTS: This Agreement constitutes the sole and entire agreement between Licensee and Licensor as to the matter set forth herein and supersedes any previous agreements, understandings, and arrangements between the parties relating hereto.
+###
+""" Add newly arriving notes to the bags of words of the complete dataset,
+without cleaning the existing notes again.
+
+`create-mimic-notes-bow` (with the count vectorizer) must be run first. The
+notes in NOTEEVENTS which are not yet in the token store are cleaned and
+counted, and their document frequencies are merged into the raw document
+frequencies. The vocabulary of the count vectorizer is then extended with the
+tokens which now pass the thresholds. The ids of the existing tokens do not
+change, so the existing bags of words stay valid.
+
+The existing notes are only transformed again (from their unpruned token ids
+in the token store) if their batch of shards in the bag-of-words store
+includes one of the new tokens. The
+timelines and the final records are only recreated for the affected
+admissions, and the affected episodes are replaced in (or added to) the
+complete dataset.
+
+Tokens are never removed from the vocabulary, even if they no longer pass the
+thresholds. Please use `prune-mimic-notes-bow` to recreate the vocabulary
+from scratch. The new notes are not deduplicated.
+"""
+import logging
+import pyllars.logging_utils as logging_utils
+logger = logging.getLogger(__name__)
+
+import argparse
+import joblib
+import numpy as np
+import pandas as pd
+import pyllars.dask_utils as dask_utils
+import pyllars.utils
+import scipy.sparse
+
+from pyllars.sklearn_transformers.incremental_count_vectorizer import IncrementalCountVectorizer
+
+import mimic_preprocessing.create_mimic_notes_bow as create_mimic_notes_bow
+import mimic_preprocessing.mp_broadcast as mp_broadcast
+import mimic_preprocessing.mp_filenames as mp_filenames
+import mimic_preprocessing.mp_note_store as mp_note_store
+import mimic_preprocessing.mp_notes_matrix as mp_notes_matrix
+import mimic_preprocessing.mp_notes_nlp as mp_notes_nlp
+import mimic_preprocessing.prune_mimic_notes_bow as prune_mimic_notes_bow
+
+from mimic_preprocessing.create_mimic_notes_bow import NOTE_CLEANED_BOW
+from mimic_preprocessing.create_mimic_notes_bow import NOTE_CLEANED_TOKENS
+
+EPISODE_KEY_COLUMNS = ['SUBJECT_ID', 'EPISODE']
+
+###
+# Extending the vocabulary
+###
+def merge_document_frequencies(document_frequencies, icv_new):
+    """ Add the document frequencies of the new notes (from an unpruned count
+    vectorizer) to the existing raw document frequencies
+
+    Returns
+    -------
+    icv_merged: IncrementalCountVectorizer
+        The merged, unpruned vectorizer
+    """
+    icv = IncrementalCountVectorizer(
+        num_docs=document_frequencies['num_docs'],
+        token_count=document_frequencies['token_count']
+    )
+
+    icv_merged = IncrementalCountVectorizer.merge(
+        [icv, icv_new],
+        prune=False,
+        create_mapping=False
+    )
+    return icv_merged
+
+def get_new_tokens(icv_merged, token_mapping, min_df, max_df):
+    """ Get the tokens which are not in `token_mapping` but pass the
+    thresholds with the merged document frequencies
+
+    As for the count vectorizer, thresholds of at most 1 are fractions of the
+    number of notes.
+    """
+    num_docs = icv_merged.num_docs
+
+    if min_df <= 1:
+        min_df = num_docs * min_df
+
+    if max_df <= 1:
+        max_df = num_docs * max_df
+
+    new_tokens = sorted(
+        token for token, count in icv_merged.token_count_.items()
+            if (token not in token_mapping) and (min_df <= count <= max_df)
+    )
+    return new_tokens
+
+def extend_count_vectorizer(icv_fit, icv_merged, new_tokens):
+    """ Append the `new_tokens` to the vocabulary of the fitted count
+    vectorizer, keeping the ids of the existing tokens
+    """
+    token_mapping = dict(icv_fit.token_mapping_)
+    for token in new_tokens:
+        token_mapping[token] = len(token_mapping)
+
+    icv_fit.token_mapping_ = token_mapping
+    icv_fit.token_count_ = {
+        token: icv_merged.token_count_.get(token, 0) for token in token_mapping
+    }
+    icv_fit.num_docs = icv_merged.num_docs
+    icv_fit.get_tokens = create_mimic_notes_bow.get_tokens
+
+    return icv_fit
+
+###
+# Reading and transforming the new notes
+###
+def shift_note_chunks(note_chunks, offset):
+    """ Shift the (pandas) index of each chunk of notes by `offset`, so the
+    shards of the new notes do not overlap with the existing shards
+    """
+    for df_chunk in note_chunks:
+        df_chunk = df_chunk.copy()
+        df_chunk.index = df_chunk.index + offset
+        yield df_chunk
+
+def get_num_partitions(args, df_index):
+    """ Get the number of partitions of the existing bag-of-words store
+
+    Unless given with `--num-partitions`, it is derived from the index and
+    checked against the partition of each admission.
+    """
+    if args.num_partitions is not None:
+        return args.num_partitions
+
+    num_partitions = int(df_index['PARTITION'].max()) + 1
+    partitions = mp_note_store.get_note_partitions(
+        df_index['HADM_ID'], num_partitions
+    )
+
+    if not np.array_equal(partitions, df_index['PARTITION'].values):
+        msg = ("Could not determine the number of partitions of the "
+            "bag-of-words store. Please use --num-partitions.")
+        raise ValueError(msg)
+
+    return num_partitions
+
+def process_batch_extend(df_batch, config, vocabulary, new_tokens,
+        num_partitions=1):
+    """ Transform the notes in a batch of shards of the token store again if
+    the vocabulary of any of its shards includes any of the `new_tokens`
+
+    The batch must be the same as the batch of the notes in the bag-of-words
+    store, so that the existing index entries of the notes do not change.
+
+    Returns
+    -------
+    hadm_ids: np.array of ints
+        The admissions of the notes which include a new token
+    """
+    note_store_path = create_mimic_notes_bow.get_note_store_path(
+        config, NOTE_CLEANED_TOKENS
+    )
+
+    all_hadm_ids = []
+    for shard in np.unique(df_batch['SHARD']):
+        shard = int(shard)
+        shard_vocabulary = mp_note_store.read_note_vocabulary(
+            note_store_path, shard
+        )
+        local_new_ids = np.array([
+            i for i, token in enumerate(shard_vocabulary) if token in new_tokens
+        ], dtype=np.int64)
+
+        if len(local_new_ids) == 0:
+            continue
+
+        df_notes = mp_note_store.read_note_shard(
+            note_store_path, shard, columns=['HADM_ID', 'TEXT']
+        )
+        m_affected = np.array([
+            np.isin(ids, local_new_ids).any() for ids in df_notes['TEXT']
+        ], dtype=bool)
+        all_hadm_ids.append(df_notes.loc[m_affected, 'HADM_ID'])
+
+    if len(all_hadm_ids) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    prune_mimic_notes_bow.process_batch_remap(
+        df_batch, config, vocabulary, num_partitions
+    )
+
+    hadm_ids = np.unique(np.concatenate(all_hadm_ids).astype(np.int64))
+    return hadm_ids
+
+###
+# Updating the complete dataset
+###
+def get_merged_episode_order(df_old, df_new):
+    """ Find the rows of `df_old` which are replaced by rows of `df_new` (with
+    the same `EPISODE_KEY_COLUMNS`) and the order of the merged rows
+
+    The merged rows are `df_old[m_kept]` followed by `df_new`. In the merged
+    order, the replaced rows keep their position, and the other rows of
+    `df_new` are appended.
+
+    Returns
+    -------
+    m_kept: np.array of bools
+        Whether each row of `df_old` is kept
+
+    order: np.array of ints
+        The permutation of the merged rows
+    """
+    old_keys = pd.MultiIndex.from_frame(df_old[EPISODE_KEY_COLUMNS])
+    new_keys = pd.MultiIndex.from_frame(df_new[EPISODE_KEY_COLUMNS])
+
+    m_kept = ~old_keys.isin(new_keys)
+
+    new_positions = old_keys.get_indexer(new_keys).astype(np.float64)
+    m_appended = new_positions < 0
+    new_positions[m_appended] = len(df_old) + np.arange(np.sum(m_appended))
+
+    positions = np.concatenate([np.where(m_kept)[0], new_positions])
+    order = np.argsort(positions, kind='stable')
+
+    return m_kept, order
+
+def get_affected_episodes(df_episodes, df_complete, hadm_ids, subject_ids):
+    """ Get the episodes of the affected admissions and all episodes of the
+    subjects which had no notes before
+    """
+    m_hadm = df_episodes['HADM_ID'].isin(hadm_ids)
+
+    new_subject_ids = set(subject_ids) - set(df_complete['SUBJECT_ID'])
+    m_new_subject = df_episodes['SUBJECT_ID'].isin(new_subject_ids)
+
+    df_affected = df_episodes[m_hadm | m_new_subject]
+    return df_affected
+
+def update_complete_dataset(df_episodes, hadm_ids, subject_ids, args, config,
+        client):
+    """ Recreate the final records of the affected episodes and replace them
+    in (or add them to) the complete dataset
+    """
+    df_complete = prune_mimic_notes_bow.load_episodes(args, config)
+    df_affected = get_affected_episodes(
+        df_episodes, df_complete, hadm_ids, subject_ids
+    )
+
+    if len(df_affected) == 0:
+        msg = "There are no affected episodes"
+        logger.info(msg)
+        return
+
+    msg = "Recreating the final records of {} episodes".format(len(df_affected))
+    logger.info(msg)
+
+    notes_bow_format = args.notes_bow_format
+    if notes_bow_format is None:
+        notes_bow_format = mp_notes_matrix.get_notes_bow_format(config)
+
+    if notes_bow_format == 'npz':
+        num_features = create_mimic_notes_bow.get_num_features(args, config)
+        df_new, new_matrices = create_mimic_notes_bow.create_all_combined_records(
+            df_affected, args, config, client, num_features
+        )
+
+        df_old, old_matrices, metadata = mp_notes_matrix.read_bow_matrices(
+            config['complete_episodes']
+        )
+        m_kept, order = get_merged_episode_order(df_old, df_new)
+
+        df_all_episodes = pd.concat([df_old[m_kept], df_new])
+        df_all_episodes = df_all_episodes.iloc[order]
+
+        # the new tokens are new columns
+        bow_matrices = {}
+        for nt, old_matrix in old_matrices.items():
+            old_matrix = old_matrix[m_kept]
+            old_matrix.resize((old_matrix.shape[0], num_features))
+            bow_matrix = scipy.sparse.vstack(
+                [old_matrix, new_matrices[nt]], format='csr'
+            )
+            bow_matrices[nt] = bow_matrix[order]
+
+        for key in ['note_types', 'num_episodes', 'num_features']:
+            metadata.pop(key, None)
+
+        mp_notes_matrix.write_bow_matrices(df_all_episodes, bow_matrices,
+            config['complete_episodes'], metadata)
+        return
+
+    df_new = create_mimic_notes_bow.create_all_combined_records(
+        df_affected, args, config, client
+    )
+
+    df_old = joblib.load(config['complete_episodes'])
+    m_kept, order = get_merged_episode_order(df_old, df_new)
+
+    df_all_records = pd.concat([df_old[m_kept], df_new])
+    df_all_records = df_all_records.iloc[order]
+
+    msg = "Writing complete dataset to disk: '{}'".format(
+        config['complete_episodes'])
+    logger.info(msg)
+    joblib.dump(df_all_records, config['complete_episodes'])
+
+###
+# The main program
+###
+def parse_arguments() -> argparse.Namespace:
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description=__doc__
+    )
+
+    parser.add_argument('config', help="The path to the yaml configuration "
+        "file.")
+
+    parser.add_argument('--min-df', type=float, default=None, help="The "
+        "minimum document frequency of the new tokens. As for the count "
+        "vectorizer, values of at most 1 are fractions of the number of "
+        "notes. Default: min_df from the config.")
+
+    parser.add_argument('--max-df', type=float, default=None, help="The "
+        "maximum document frequency of the new tokens. Default: max_df from "
+        "the config.")
+
+    parser.add_argument('--chunk-size', type=int, default=100, help="The size "
+        "of chunks for parallelization")
+
+    parser.add_argument('--num-notes', type=int, default=None, help="The "
+        "number of notes to read in. This is mostly for debugging purposes.")
+
+    parser.add_argument('--read-chunk-size', type=int, default=100000,
+        help="The number of rows of NOTEEVENTS to read at a time")
+
+    parser.add_argument('--notes-horizon', type=float, default=None,
+        help="Only notes within this many hours after the admission time are "
+        "added to the records. Default: notes_horizon from the config, or {} "
+        "hours.".format(create_mimic_notes_bow.DEFAULT_NOTES_HORIZON))
+
+    parser.add_argument('--keep-late-notes', action='store_true', help="If "
+        "this flag is given, then all new notes are cleaned and counted. This "
+        "should match the flag of `create-mimic-notes-bow`.")
+
+    parser.add_argument('--num-partitions', type=int, default=None,
+        help="The number of partitions of the existing bag-of-words store. "
+        "Default: derived from its index.")
+
+    parser.add_argument('--partition-file-size', type=int,
+        default=create_mimic_notes_bow.DEFAULT_PARTITION_FILE_SIZE,
+        help="The (approximate) number of notes in each new file of the "
+        "bag-of-words store")
+
+    parser.add_argument('--notes-bow-format', default=None,
+        choices=mp_notes_matrix.VALID_FORMATS, help="The format of the "
+        "existing complete dataset. Default: notes_bow_format from the "
+        "config, or \"jpkl\".")
+
+    dask_utils.add_dask_options(parser)
+    logging_utils.add_logging_options(parser)
+    args = parser.parse_args()
+    logging_utils.update_logging(args)
+    return args
+
+def main():
+    args = parse_arguments()
+    config = pyllars.utils.load_config(args.config)
+
+    # only the count vectorizer has a vocabulary
+    args.vectorizer = 'count'
+
+    min_df = args.min_df
+    if min_df is None:
+        min_df = config['min_df']
+
+    max_df = args.max_df
+    if max_df is None:
+        max_df = config['max_df']
+
+    msg = "Connecting to dask client"
+    logger.info(msg)
+    client, cluster = dask_utils.connect(args)
+
+    msg = "Loading the episode information"
+    logger.info(msg)
+    df_episodes = pd.read_csv(config['extended_episodes'])
+
+    token_store_path = create_mimic_notes_bow.get_note_store_path(
+        config, NOTE_CLEANED_TOKENS
+    )
+    df_token_index = mp_note_store.load_note_index(token_store_path)
+
+    bow_store_path = create_mimic_notes_bow.get_note_store_path(
+        config, NOTE_CLEANED_BOW
+    )
+    df_bow_index = mp_note_store.load_note_index(bow_store_path)
+    args.num_partitions = get_num_partitions(args, df_bow_index)
+
+    msg = "Cleaning and tokenizing the new notes"
+    logger.info(msg)
+    subject_ids = set()
+    note_chunks = create_mimic_notes_bow.iterate_note_chunks(
+        args, config, df_episodes, subject_ids,
+        known_row_ids=set(df_token_index['ROW_ID'])
+    )
+
+    shard_offset = int(df_token_index['SHARD'].max()) + 1
+    note_chunks = shift_note_chunks(note_chunks, shard_offset)
+
+    shared_config = mp_broadcast.broadcast(client, config)
+    chunk_futures = mp_broadcast.submit_iter(
+        note_chunks,
+        client,
+        create_mimic_notes_bow.process_chunk_clean_tokens,
+        shared_config,
+        progress_bar=True
+    )
+
+    if len(chunk_futures) == 0:
+        msg = "There are no new notes"
+        logger.info(msg)
+        return
+
+    msg = "Counting the tokens of the new notes"
+    logger.info(msg)
+    icv_futures = client.map(
+        create_mimic_notes_bow.process_chunk_count_tokens,
+        chunk_futures
+    )
+    icv_new = create_mimic_notes_bow.tree_merge_count_vectorizers(
+        icv_futures, config, client, final=False
+    )
+
+    f = mp_filenames.get_mimic_notes_document_frequencies_filename(
+        config['analysis_basepath']
+    )
+    document_frequencies = mp_notes_nlp.load_document_frequencies(f)
+    icv_merged = merge_document_frequencies(document_frequencies, icv_new)
+
+    msg = "Writing the updated raw document frequencies: '{}'".format(f)
+    logger.info(msg)
+    mp_notes_nlp.write_document_frequencies(icv_merged, f)
+
+    f = create_mimic_notes_bow.get_vectorizer_filename(args, config)
+    icv_fit = joblib.load(f)
+    new_tokens = get_new_tokens(
+        icv_merged, icv_fit.token_mapping_, min_df, max_df
+    )
+
+    msg = "Adding {} tokens to the {} tokens of the vocabulary".format(
+        len(new_tokens), len(icv_fit.token_mapping_))
+    logger.info(msg)
+    icv_fit = extend_count_vectorizer(icv_fit, icv_merged, new_tokens)
+    create_mimic_notes_bow.write_vectorizer(icv_fit, args, config)
+
+    vectorizer = create_mimic_notes_bow.get_shared_vectorizer(icv_fit, client)
+
+    msg = "Transforming the new notes to bags of words"
+    logger.info(msg)
+    all_indices = create_mimic_notes_bow.transform_chunk_batches(
+        chunk_futures,
+        args,
+        client,
+        config=shared_config,
+        vectorizer=vectorizer,
+        num_partitions=args.num_partitions
+    )
+
+    # release the tokens on the workers
+    client.cancel(chunk_futures)
+
+    hadm_ids = set()
+    for df_index, _ in all_indices:
+        hadm_ids.update(df_index['HADM_ID'].astype(np.int64))
+
+    if len(new_tokens) > 0:
+        msg = "Transforming the existing notes with new tokens again"
+        logger.info(msg)
+        # the same batches of shards as in the bag-of-words store
+        df_bow_batches = df_bow_index[['ROW_ID', 'SHARD']].rename(
+            columns={'SHARD': 'BATCH'}
+        )
+        df_batches = df_token_index.merge(df_bow_batches, on='ROW_ID')
+
+        all_hadm_ids = dask_utils.apply_groups(
+            df_batches.groupby('BATCH'),
+            client,
+            process_batch_extend,
+            shared_config,
+            vectorizer,
+            mp_broadcast.broadcast(client, frozenset(new_tokens)),
+            args.num_partitions,
+            progress_bar=True
+        )
+        for shard_hadm_ids in all_hadm_ids:
+            hadm_ids.update(shard_hadm_ids)
+
+    # the existing entries of the indices do not change
+    df_bow_index = create_mimic_notes_bow.write_bow_index(
+        [(df_bow_index, df_token_index)] + all_indices, args, config
+    )
+
+    m_affected = df_bow_index['HADM_ID'].isin(hadm_ids)
+    partitions = df_bow_index.loc[m_affected, 'PARTITION'].unique()
+
+    msg = "Combining bag-of-words types for {} admissions in {} partitions".format(
+        len(hadm_ids), len(partitions))
+    logger.info(msg)
+    create_mimic_notes_bow.combine_episode_notes(
+        df_bow_index, args, config, client, partitions=partitions
+    )
+
+    update_complete_dataset(
+        df_episodes, hadm_ids, subject_ids, args, config, client
+    )
+
+if __name__ == '__main__':
+    main()
@@ -57,7 +57,11 @@ console_scripts = [
     'create-extended-listfile=mimic_preprocessing.create_extended_listfile:main',
     'create-extended-mimic-dataset=mimic_preprocessing.create_extended_mimic_dataset:main',
     'create-mimic-notes-bow=mimic_preprocessing.create_mimic_notes_bow:main',
+    'create-mimic-ts-store=mimic_preprocessing.create_mimic_ts_store:main',
+    'create-mimic-ts-tensor=mimic_preprocessing.create_mimic_ts_tensor:main',
     'extract-mimic-time-series-features=mimic_preprocessing.extract_mimic_time_series_features:main',
+    'prune-mimic-notes-bow=mimic_preprocessing.prune_mimic_notes_bow:main',
+    'update-mimic-notes-bow=mimic_preprocessing.update_mimic_notes_bow:main',
 ]
 
 install_requires = _safe_read_lines("./requirements.txt")
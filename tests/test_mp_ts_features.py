@@ -0,0 +1,195 @@
+""" Regression checks for the rolling time series features against the
+per-series (pandas) features
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+import mimic_preprocessing.extract_mimic_time_series_features as extract_mimic_time_series_features
+import mimic_preprocessing.mp_ts_features as mp_ts_features
+
+from mimic_preprocessing.extract_mimic_time_series_features import FEATURE_EXTRACTORS
+from mimic_preprocessing.extract_mimic_time_series_features import PERIOD_LENGTH
+from mimic_preprocessing.extract_mimic_time_series_features import SUBSEQUENCES
+
+# (mean, standard deviation) of each kind. the tiny deviations of the weight
+# are sensitive to any loss of precision in the moments
+KINDS = {
+    'Glucose': (150, 50),
+    'Heart Rate': (80, 15),
+    'Temperature': (37, 0.5),
+    'Weight': (80, 0.001),
+    'pH': (7.4, 0.05)
+}
+
+def get_ts_data(num_stays=20, max_observations=50, num_hours=60, seed=8675309):
+    rng = np.random.RandomState(seed)
+
+    all_ts_dfs = []
+    for stay in range(num_stays):
+        for kind, (mean, std) in KINDS.items():
+            num_observations = rng.randint(1, max_observations)
+            values = mean + std * rng.randn(num_observations)
+
+            # include some constant time series
+            if (kind == 'Temperature') and (stay % 3 == 0):
+                values[:] = mean
+
+            df = pd.DataFrame({
+                'stay': "stay_{}".format(stay),
+                'kind': kind,
+                'Hours': np.round(rng.uniform(0, num_hours, num_observations), 2),
+                'num_value': values
+            })
+            all_ts_dfs.append(df)
+
+    df_ts_data = pd.concat(all_ts_dfs, ignore_index=True)
+    df_ts_data['SUBJECT_ID'] = df_ts_data['stay'].str.slice(5).astype(int)
+    df_ts_data['EPISODE'] = 1
+    return df_ts_data
+
+def get_window_feature_names(df_rolling, prediction_time):
+    """ Rename the rolling features from fractions to hours """
+    names = {}
+    for c in df_rolling.columns:
+        if '__' not in c:
+            continue
+        kind, window, feature_name = c.split('__')
+        start, end = [float(w) * prediction_time for w in window.split('-')]
+        names[c] = mp_ts_features.get_feature_name(
+            kind, start, end, feature_name
+        )
+    return names
+
+@pytest.mark.parametrize('prediction_time', [PERIOD_LENGTH, 7, 30.5])
+def test_rolling_features_match_pandas(prediction_time):
+    df_ts_data = get_ts_data()
+
+    df_expected = extract_mimic_time_series_features.extract_all_episode_time_series_features(
+        df_ts_data, SUBSEQUENCES * prediction_time
+    )
+
+    df_rolling = mp_ts_features.extract_all_rolling_time_series_features(
+        df_ts_data,
+        SUBSEQUENCES,
+        prediction_times=[prediction_time],
+        feature_names=list(FEATURE_EXTRACTORS.keys())
+    )
+    df_rolling = df_rolling.rename(
+        columns=get_window_feature_names(df_rolling, prediction_time)
+    )
+
+    df_expected = df_expected.sort_values('stay').reset_index(drop=True)
+    df_rolling = df_rolling.sort_values('stay').reset_index(drop=True)
+
+    feature_columns = [c for c in df_expected.columns if '__' in c]
+    assert set(feature_columns) <= set(df_rolling.columns)
+
+    for c in feature_columns:
+        np.testing.assert_allclose(
+            df_rolling[c].astype(float),
+            df_expected[c].astype(float),
+            rtol=1e-7,
+            atol=1e-7,
+            err_msg=c
+        )
+
+def get_sparse_ts_data(seed=8675309, **kwargs):
+    """ Get time series data with missing values and unobserved kinds """
+    rng = np.random.RandomState(seed)
+    df_ts_data = get_ts_data(seed=seed, **kwargs)
+
+    m_missing = rng.uniform(size=len(df_ts_data)) < 0.1
+    df_ts_data.loc[m_missing, 'num_value'] = np.nan
+
+    # only missing values of a kind, and a kind which is never observed
+    m_stay = df_ts_data['stay'] == "stay_1"
+    df_ts_data.loc[m_stay & (df_ts_data['kind'] == 'pH'), 'num_value'] = np.nan
+    m_weight = m_stay & (df_ts_data['kind'] == 'Weight')
+    df_ts_data = df_ts_data[~m_weight].reset_index(drop=True)
+
+    return df_ts_data
+
+def assert_same_features(df_actual, df_expected, stay_column='stay'):
+    df_actual = df_actual.sort_values(stay_column).reset_index(drop=True)
+    df_expected = df_expected.sort_values(stay_column).reset_index(drop=True)
+
+    assert set(df_actual.columns) == set(df_expected.columns)
+    # the identifiers may differ in dtype (e.g., the int32 compact STAY_ID)
+    for c in df_expected.columns:
+        if '__' not in c:
+            assert df_actual[c].tolist() == df_expected[c].tolist(), c
+            continue
+
+        np.testing.assert_allclose(
+            df_actual[c].astype(float),
+            df_expected[c].astype(float),
+            rtol=1e-7,
+            atol=1e-7,
+            err_msg=c
+        )
+
+def test_vectorized_features_match_pandas():
+    df_ts_data = get_sparse_ts_data()
+    subsequence_timepoints = SUBSEQUENCES * PERIOD_LENGTH
+
+    df_expected = extract_mimic_time_series_features.extract_all_episode_time_series_features(
+        df_ts_data, subsequence_timepoints
+    )
+    df_vectorized = extract_mimic_time_series_features.extract_all_episode_time_series_features_vectorized(
+        df_ts_data, subsequence_timepoints
+    )
+
+    # including the quantiles
+    assert "pH__0.00-48.00__PERCENTILE_5" in df_vectorized.columns
+    assert "pH__0.00-48.00__INTERQUARTILE_RANGE" in df_vectorized.columns
+    assert_same_features(df_vectorized, df_expected)
+
+def test_vectorized_compact_features_match_pandas():
+    df_ts_data = get_sparse_ts_data()
+    subsequence_timepoints = SUBSEQUENCES * PERIOD_LENGTH
+
+    df_stays = extract_mimic_time_series_features.get_stay_table(
+        df_ts_data[['stay', 'SUBJECT_ID', 'EPISODE']].drop_duplicates()
+    )
+    df_compact = extract_mimic_time_series_features.get_compact_ts_data(
+        df_ts_data, df_stays
+    )
+
+    # pandas calculates the moments of float32 values in float32
+    df_expected = extract_mimic_time_series_features.extract_all_episode_time_series_features(
+        df_compact.astype({'Hours': float, 'num_value': float}),
+        subsequence_timepoints, stay_column='STAY_ID',
+        id_columns=[]
+    )
+    df_vectorized = extract_mimic_time_series_features.extract_all_episode_time_series_features_vectorized(
+        df_compact, subsequence_timepoints, stay_column='STAY_ID',
+        id_columns=[]
+    )
+
+    assert_same_features(df_vectorized, df_expected, stay_column='STAY_ID')
+
+def test_hourly_rolling_features_match_pandas():
+    df_ts_data = get_sparse_ts_data(num_stays=4, num_hours=10)
+
+    df_rolling = mp_ts_features.extract_all_rolling_time_series_features(
+        df_ts_data,
+        SUBSEQUENCES,
+        hourly=True,
+        feature_names=list(FEATURE_EXTRACTORS.keys())
+    )
+
+    # every hour up to the first full hour after the last observation
+    last_hours = np.ceil(df_ts_data.groupby('stay')['Hours'].max())
+    num_hours = df_rolling.groupby('stay')['PERIOD_LENGTH'].max()
+    assert num_hours.equals(last_hours.loc[num_hours.index])
+
+    for prediction_time, df in df_rolling.groupby('PERIOD_LENGTH'):
+        m_stays = df_ts_data['stay'].isin(df['stay'])
+        df_expected = extract_mimic_time_series_features.extract_all_episode_time_series_features(
+            df_ts_data[m_stays], SUBSEQUENCES * prediction_time
+        )
+
+        df = df.rename(columns=get_window_feature_names(df, prediction_time))
+        df = df[df_expected.columns]
+        assert_same_features(df, df_expected)
@@ -0,0 +1,483 @@
+""" End-to-end checks of the bag-of-words pipeline of the notes on a small,
+synthetic NOTEEVENTS table
+"""
+import collections
+import sys
+
+import dask.distributed
+import joblib
+import numpy as np
+import pandas as pd
+import pyllars.dask_utils as dask_utils
+import pytest
+import yaml
+
+import mimic_preprocessing.create_mimic_notes_bow as create_mimic_notes_bow
+import mimic_preprocessing.mp_filenames as mp_filenames
+import mimic_preprocessing.mp_note_timeline as mp_note_timeline
+import mimic_preprocessing.mp_notes_matrix as mp_notes_matrix
+import mimic_preprocessing.prune_mimic_notes_bow as prune_mimic_notes_bow
+import mimic_preprocessing.update_mimic_notes_bow as update_mimic_notes_bow
+
+from mimic_preprocessing.create_mimic_notes_bow import NOTE_TYPES
+
+WORDS = (
+    "patient stable heart rate pressure blood improved worsening breathing "
+    "oxygen saturation sedated intubated extubated lungs clear bilateral "
+    "crackles abdomen soft fever chills pain medication morphine heparin "
+    "insulin glucose sodium potassium creatinine kidney liver failure sepsis "
+    "antibiotics vancomycin cultures pending chest xray effusion edema wound "
+    "dressing family meeting discharge plan nutrition feeding ventilator"
+).split()
+
+STOP_WORDS = "the and of to was is in with for on at by a an no not".split()
+OTHER_WORDS = [",", ".", "(", ")", "--", "[**2101-1-1**]", "pt's", "b/l", "5mg"]
+
+CATEGORIES = [
+    "Nursing", "Nursing/other", "Radiology", "Physician ", "ECG", "Echo",
+    "Respiratory ", "Social Work", "Discharge summary"
+]
+
+# the last notes of NOTEEVENTS: a few notes of a handful of admissions, and
+# then notes of subjects without episodes
+NUM_NEW_ADMISSIONS = 3
+NUM_NEW_NOTES_PER_ADMISSION = 2
+NUM_UNMATCHED_NOTES = 3
+
+def get_text(rng):
+    words = []
+    for _ in range(rng.randint(5, 60)):
+        r = rng.uniform()
+        if r < 0.6:
+            w = rng.choice(WORDS)
+        elif r < 0.85:
+            w = rng.choice(STOP_WORDS)
+        else:
+            w = rng.choice(OTHER_WORDS)
+
+        if rng.uniform() < 0.1:
+            w = w.capitalize()
+        words.append(w)
+
+    return " ".join(words)
+
+def get_note(rng, row_id, subject_id, hadm_id, chart_time, category, text):
+    note = {
+        'ROW_ID': row_id,
+        'SUBJECT_ID': subject_id,
+        'HADM_ID': hadm_id,
+        'CHARTDATE': chart_time.strftime("%Y-%m-%d"),
+        'CHARTTIME': chart_time.strftime("%Y-%m-%d %H:%M:%S"),
+        'STORETIME': chart_time.strftime("%Y-%m-%d %H:%M:%S"),
+        'CATEGORY': category,
+        'DESCRIPTION': "Report",
+        'CGID': 1,
+        'ISERROR': np.nan,
+        'TEXT': text
+    }
+
+    # some notes only have a chart date
+    if rng.uniform() < 0.1:
+        note['CHARTTIME'] = np.nan
+
+    return note
+
+def write_notes_data(path, num_subjects=12, seed=8675309):
+    """ Write a small NOTEEVENTS table and the extended episodes to `path`
+
+    Some notes have the same text as the previous note of their admission, so
+    they are removed with `--dedup-notes`. The notes are spread from before
+    the admission until several days after it, so the horizon matters.
+
+    Returns
+    -------
+    num_notes: int
+        The number of rows of NOTEEVENTS
+    """
+    rng = np.random.RandomState(seed)
+
+    all_episodes = []
+    notes = []
+    for s in range(num_subjects):
+        subject_id = 100 + s
+        for e in range(rng.randint(1, 3)):
+            hadm_id = 100000 + 10*s + e
+            admit_time = pd.Timestamp("2101-01-01") + pd.Timedelta(
+                days=int(rng.randint(0, 300)) + 400*e,
+                hours=int(rng.randint(0, 24))
+            )
+
+            all_episodes.append({
+                'SUBJECT_ID': subject_id,
+                'HADM_ID': hadm_id,
+                'ICUSTAY_ID': 200000 + 10*s + e,
+                'EPISODE': "episode{}".format(e+1),
+                'ADMITTIME': str(admit_time),
+                'GENDER': "F",
+                'AGE': 60,
+                'DIAGNOSIS': "SEPSIS",
+                'LOS': 3.2,
+                'MORTALITY_INHOSPITAL': 0,
+                'SPLIT': "train" if s % 4 else "test"
+            })
+
+            text = None
+            for _ in range(rng.randint(1, 12)):
+                chart_time = admit_time + pd.Timedelta(
+                    hours=float(rng.uniform(-12, 120))
+                )
+                if (text is None) or (rng.uniform() > 0.25):
+                    text = get_text(rng)
+
+                notes.append((
+                    subject_id, hadm_id, chart_time,
+                    rng.choice(CATEGORIES), text
+                ))
+
+    order = rng.permutation(len(notes))
+    notes = [notes[i] for i in order]
+
+    # the new notes of a handful of admissions, within the horizon
+    df_episodes = pd.DataFrame(all_episodes)
+    new_episodes = rng.choice(
+        len(df_episodes), NUM_NEW_ADMISSIONS, replace=False
+    )
+    for i in new_episodes:
+        episode = df_episodes.iloc[i]
+        for _ in range(NUM_NEW_NOTES_PER_ADMISSION):
+            chart_time = pd.Timestamp(episode['ADMITTIME']) + pd.Timedelta(
+                hours=float(rng.uniform(0, 40))
+            )
+            notes.append((
+                episode['SUBJECT_ID'], episode['HADM_ID'], chart_time,
+                "Nursing", get_text(rng)
+            ))
+
+    # and the notes of subjects without episodes
+    for k in range(NUM_UNMATCHED_NOTES):
+        notes.append((
+            900 + k, 900000 + k, pd.Timestamp("2101-01-01 10:00:00"),
+            "Nursing", get_text(rng)
+        ))
+
+    notes = [
+        get_note(rng, row_id+1, *note) for row_id, note in enumerate(notes)
+    ]
+
+    (path / "mimic").mkdir(parents=True, exist_ok=True)
+    pd.DataFrame(notes).to_csv(path / "mimic" / "NOTEEVENTS.csv.gz", index=False)
+    df_episodes.to_csv(path / "episodes.csv", index=False)
+
+    return len(notes)
+
+@pytest.fixture(scope='module')
+def notes_data(tmp_path_factory):
+    path = tmp_path_factory.mktemp("notes_data")
+    num_notes = write_notes_data(path)
+    return path, num_notes
+
+@pytest.fixture(scope='module')
+def client():
+    client = dask.distributed.Client(
+        processes=False, n_workers=1, threads_per_worker=2,
+        dashboard_address=None
+    )
+    yield client
+    client.close()
+
+def write_config(notes_data, path, name, **kwargs):
+    """ Write a config for a separate run of the pipeline on the notes data
+    """
+    data_path, _ = notes_data
+    analysis_path = path / name
+
+    config = {
+        'mimic_basepath': str(data_path / "mimic"),
+        'analysis_basepath': str(analysis_path),
+        'extended_episodes': str(data_path / "episodes.csv"),
+        'complete_episodes': str(analysis_path / "complete.jpkl"),
+        'min_df': 0.0,
+        'max_df': 1.0
+    }
+    config.update(kwargs)
+
+    config_file = path / "{}.yaml".format(name)
+    with open(config_file, 'w') as out:
+        yaml.safe_dump(config, out)
+
+    return config_file, config
+
+def run_script(module, client, config_file, *flags):
+    """ Run the main program of `module` with the dask `client` """
+    argv = [module.__name__, str(config_file), '--logging-level', 'WARNING']
+    argv.extend(flags)
+
+    with pytest.MonkeyPatch.context() as m:
+        m.setattr(sys, 'argv', argv)
+        m.setattr(dask_utils, 'connect', lambda args: (client, None))
+        module.main()
+
+@pytest.fixture(scope='module')
+def default_config(notes_data, client, tmp_path_factory):
+    """ Create the bags of words with the default options """
+    path = tmp_path_factory.mktemp("default")
+    config_file, config = write_config(notes_data, path, "default")
+    run_script(create_mimic_notes_bow, client, config_file)
+    return config
+
+def load_records(config):
+    df_records = joblib.load(config['complete_episodes'])
+    df_records = df_records.sort_values(['SUBJECT_ID', 'EPISODE'])
+    df_records = df_records.reset_index(drop=True)
+    return df_records
+
+def get_tokens(config):
+    """ Get the token of each id of the count vectorizer """
+    f = mp_filenames.get_mimic_notes_count_vectorizer_filename(
+        config['analysis_basepath']
+    )
+    tokens = {
+        i: token for token, i in joblib.load(f).token_mapping_.items()
+    }
+    return tokens
+
+def get_token_lists(config, df_records):
+    """ Get the (sorted) tokens of each note type of each episode """
+    tokens = get_tokens(config)
+    token_lists = {
+        nt: [sorted(tokens[i] for i in ids) for ids in df_records[nt]]
+            for nt in NOTE_TYPES
+    }
+    return token_lists
+
+def assert_same_bags(config, other_config):
+    """ Check that both complete datasets have the same episodes and tokens
+    """
+    df_records = load_records(config)
+    df_other = load_records(other_config)
+
+    key = ['SUBJECT_ID', 'EPISODE']
+    assert len(df_records) > 0
+    assert df_records[key].equals(df_other[key])
+    assert (
+        get_token_lists(config, df_records) ==
+        get_token_lists(other_config, df_other)
+    )
+
+###
+# Creating the bags of words
+###
+@pytest.mark.parametrize("flags", [
+    ['--fused'],
+    ['--dedup-notes'],
+    ['--fused', '--dedup-notes']
+])
+def test_create_options_match_default(notes_data, client, default_config,
+        tmp_path, flags):
+    config_file, config = write_config(notes_data, tmp_path, "options")
+    run_script(create_mimic_notes_bow, client, config_file, *flags)
+    assert_same_bags(config, default_config)
+
+def test_matrices_match_lists(notes_data, client, default_config, tmp_path):
+    config_file, config = write_config(notes_data, tmp_path, "matrices")
+    run_script(
+        create_mimic_notes_bow, client, config_file,
+        '--notes-bow-format', 'npz'
+    )
+
+    df_episodes, bow_matrices, metadata = mp_notes_matrix.read_bow_matrices(
+        config['complete_episodes']
+    )
+    assert metadata['note_types'] == NOTE_TYPES
+
+    df_records = load_records(default_config)
+    key = ['SUBJECT_ID', 'EPISODE']
+    df_episodes = df_episodes.reset_index().sort_values(key)
+    assert df_episodes[key].values.tolist() == df_records[key].values.tolist()
+
+    tokens = get_tokens(config)
+    default_tokens = get_tokens(default_config)
+    for nt in NOTE_TYPES:
+        m = bow_matrices[nt]
+        assert m.shape == (len(df_episodes), metadata['num_features'])
+
+        for row, ids in zip(df_episodes['index'], df_records[nt]):
+            counts = m.getrow(row)
+            matrix_counts = {
+                tokens[j]: c for j, c in zip(counts.indices, counts.data)
+            }
+            list_counts = collections.Counter(default_tokens[i] for i in ids)
+            assert matrix_counts == list_counts
+
+def test_prune_with_same_thresholds(notes_data, client, tmp_path):
+    config_file, config = write_config(
+        notes_data, tmp_path, "prune", min_df=2, max_df=0.5
+    )
+    run_script(create_mimic_notes_bow, client, config_file)
+
+    df_before = load_records(config)
+    token_lists = get_token_lists(config, df_before)
+    num_tokens = len(get_tokens(config))
+
+    # the config thresholds, which were already applied
+    run_script(prune_mimic_notes_bow, client, config_file)
+
+    df_after = load_records(config)
+    assert len(get_tokens(config)) == num_tokens
+    assert get_token_lists(config, df_after) == token_lists
+
+###
+# Selecting the notes from the timelines
+###
+def get_timeline_notes(num_admissions=10, num_notes=200, seed=8675309):
+    rng = np.random.RandomState(seed)
+
+    hadm_ids = rng.randint(0, num_admissions, num_notes)
+    admit_times = pd.Timestamp("2101-01-01") + pd.to_timedelta(
+        rng.randint(0, 100, num_admissions), unit='D'
+    )
+
+    chart_times = admit_times[hadm_ids] + pd.to_timedelta(
+        rng.uniform(-12, 72, num_notes), unit='h'
+    ).round('h')
+
+    df_notes = pd.DataFrame({
+        'ROW_ID': np.arange(num_notes),
+        'SUBJECT_ID': hadm_ids,
+        'HADM_ID': hadm_ids,
+        'CHARTTIME': chart_times,
+        'NOTE_TYPE': rng.randint(0, len(NOTE_TYPES), num_notes),
+        'TEXT': [
+            list(rng.randint(0, 50, rng.randint(0, 5)))
+                for _ in range(num_notes)
+        ]
+    })
+    df_notes.loc[rng.uniform(size=num_notes) < 0.1, 'CHARTTIME'] = pd.NaT
+
+    # one admission which is not in the timeline
+    admit_times = pd.Series(admit_times.append(admit_times[:1]))
+    hadm_ids = np.arange(num_admissions + 1)
+
+    return df_notes, hadm_ids, admit_times
+
+def get_brute_force_groups(df_notes, hadm_ids, start_times, end_times):
+    """ Filter the notes of each window and note type, in their order """
+    times = pd.to_datetime(df_notes['CHARTTIME'])
+    groups = []
+    for t in range(len(NOTE_TYPES)):
+        for h, s, e in zip(hadm_ids, start_times, end_times):
+            m = (
+                (df_notes['HADM_ID'] == h) & (df_notes['NOTE_TYPE'] == t) &
+                (times >= s) & (times < e)
+            )
+            groups.append(sum(df_notes.loc[m, 'TEXT'], []))
+    return groups
+
+def get_timeline_groups(timeline, windows):
+    token_ids, group_sizes = windows
+    groups = np.split(token_ids, np.cumsum(group_sizes)[:-1])
+    return [g.tolist() for g in groups]
+
+def write_timeline(df_notes, tmp_path):
+    mp_note_timeline.write_note_timeline_part(df_notes, NOTE_TYPES, tmp_path, 0)
+    timeline = mp_note_timeline.read_note_timeline_part(tmp_path, 0)
+    return timeline
+
+@pytest.mark.parametrize("horizon", [0, 6, 24, 48.5])
+def test_horizon_groups_match_brute_force(tmp_path, horizon):
+    df_notes, hadm_ids, admit_times = get_timeline_notes()
+    timeline = write_timeline(df_notes, tmp_path)
+
+    horizon = pd.Timedelta(hours=horizon)
+    windows = timeline.get_horizon_groups(hadm_ids, admit_times, horizon)
+
+    start_times = [pd.Timestamp.min] * len(hadm_ids)
+    expected = get_brute_force_groups(
+        df_notes, hadm_ids, start_times, admit_times + horizon
+    )
+    assert get_timeline_groups(timeline, windows) == expected
+
+@pytest.mark.parametrize("bucket_size,num_buckets", [(6, 4), (1, 50), (24, 1)])
+def test_time_bucket_groups_match_brute_force(tmp_path, bucket_size,
+        num_buckets):
+    df_notes, hadm_ids, admit_times = get_timeline_notes()
+    timeline = write_timeline(df_notes, tmp_path)
+
+    bucket_size = pd.Timedelta(hours=bucket_size)
+    windows = timeline.get_time_bucket_groups(
+        hadm_ids, admit_times, bucket_size, num_buckets
+    )
+
+    start_times = [
+        admit_time + b*bucket_size
+            for admit_time in admit_times for b in range(num_buckets)
+    ]
+    end_times = [s + bucket_size for s in start_times]
+    expected = get_brute_force_groups(
+        df_notes, np.repeat(hadm_ids, num_buckets), start_times, end_times
+    )
+    assert get_timeline_groups(timeline, windows) == expected
+
+###
+# Updating the bags of words
+###
+def test_update_matches_full_rebuild(notes_data, client, tmp_path):
+    _, num_notes = notes_data
+    num_new_notes = (
+        NUM_NEW_ADMISSIONS * NUM_NEW_NOTES_PER_ADMISSION + NUM_UNMATCHED_NOTES
+    )
+
+    full_file, full_config = write_config(notes_data, tmp_path, "full")
+    run_script(create_mimic_notes_bow, client, full_file, '--keep-late-notes')
+
+    # fewer episodes are affected than --chunk-size
+    update_file, update_config = write_config(notes_data, tmp_path, "update")
+    run_script(
+        create_mimic_notes_bow, client, update_file, '--keep-late-notes',
+        '--num-notes', str(num_notes - num_new_notes)
+    )
+    df_before = load_records(update_config)
+
+    run_script(
+        update_mimic_notes_bow, client, update_file, '--keep-late-notes'
+    )
+
+    df_full = load_records(full_config)
+    df_updated = load_records(update_config)
+
+    key = ['SUBJECT_ID', 'EPISODE']
+    assert df_updated[key].equals(df_full[key])
+    assert (
+        get_token_lists(update_config, df_updated) ==
+        get_token_lists(full_config, df_full)
+    )
+
+    # only a handful of episodes changed
+    df_before = df_before.set_index(key)
+    df_updated = df_updated.set_index(key).loc[df_before.index]
+    num_changed = sum(
+        any(list(before[nt]) != list(updated[nt]) for nt in NOTE_TYPES)
+            for (_, before), (_, updated) in zip(
+                df_before.iterrows(), df_updated.iterrows()
+            )
+    )
+
+    assert 0 < num_changed <= NUM_NEW_ADMISSIONS
+
+def test_update_without_affected_episodes(notes_data, client, tmp_path):
+    _, num_notes = notes_data
+
+    config_file, config = write_config(notes_data, tmp_path, "unmatched")
+    run_script(
+        create_mimic_notes_bow, client, config_file, '--keep-late-notes',
+        '--num-notes', str(num_notes - NUM_UNMATCHED_NOTES)
+    )
+    df_before = load_records(config)
+
+    # the new notes are only from subjects without episodes
+    run_script(
+        update_mimic_notes_bow, client, config_file, '--keep-late-notes'
+    )
+
+    df_after = load_records(config)
+    pd.testing.assert_frame_equal(df_after, df_before)